@@ -0,0 +1,149 @@
+"""
+Fixtures shared by the pytest-benchmark suites (`test_bench_*.py`).
+
+They run offline: against mongomock, or a local mongod when MATHCLIPS_BENCH_MONGO_URL is set, and with
+`StubOCRModel` standing in for LatexOCR everywhere except the model latency cases, which use the real model
+when its weights are already downloaded.
+
+Runs saved with `--benchmark-save` / `--benchmark-autosave` go to benchmarks/.benchmarks wherever pytest is
+started from.  The committed baseline, run 0001, covers every case but the model latency ones;
+`--benchmark-compare=0001 --benchmark-compare-fail=mean:20%` fails on regressions against it.  Timings are only
+comparable on the same machine, elsewhere save a baseline of your own first and compare against that run.
+
+usage:
+    python -m pytest benchmarks/test_bench_*.py --benchmark-compare=0001 --benchmark-compare-fail=mean:20%
+    python -m pytest benchmarks/test_bench_*.py --benchmark-save=baseline
+"""
+from __future__ import annotations
+
+import hashlib
+import os
+import uuid
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Iterator, List
+
+import pytest
+from PIL import Image, ImageDraw
+from pymongo import UpdateOne
+
+BENCHMARK_STORAGE = Path(__file__).parent.joinpath(".benchmarks")
+DEFAULT_BENCHMARK_STORAGE = "file://./.benchmarks"
+MONGO_URL: str|None = os.environ.get("MATHCLIPS_BENCH_MONGO_URL")
+BENCH_DATABASE_NAME: str = "mathclips_bench"
+
+@pytest.hookimpl(tryfirst = True)
+def pytest_configure(config: pytest.Config):
+    # before pytest-benchmark opens its storage, only when no other location was asked for
+    if getattr(config.option, "benchmark_storage", None) == DEFAULT_BENCHMARK_STORAGE:
+        config.option.benchmark_storage = f"file://{BENCHMARK_STORAGE}"
+
+class StubOCRModel:
+    """
+    Stands in for LatexOCR: the same call signature and `args`, a deterministic answer per image and
+    no inference cost, so the benchmarks measure everything around the model.
+    """
+
+    def __init__(self, max_dimensions: List[int] = (672, 192), min_dimensions: List[int] = (32, 32)):
+        self.args = SimpleNamespace(max_dimensions = list(max_dimensions), min_dimensions = list(min_dimensions))
+
+    def __call__(self, image: Image.Image) -> str:
+        return f"x_{{{hashlib.blake2b(image.tobytes(), digest_size = 4).hexdigest()}}}"
+
+    def batch(self, images: List[Image.Image]) -> List[str]:
+        return [self(image) for image in images]
+
+def equation_image(width: int, height: int, seed: int = 0) -> Image.Image:
+    """
+    An RGBA canvas with dark strokes, like the uploads of the draw widget.
+    """
+    image = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(image)
+    for stroke in range(4):
+        offset = (seed * 7 + stroke * 13) % max(1, width // 4)
+        draw.line((width // 8 + offset, height // 4, width // 2 + offset, height * 3 // 4),
+                  fill = (0, 0, 0, 255), width = max(1, height // 40))
+    # one pixel placed by the seed, so different seeds never hit each other in the OCR result cache
+    draw.point((seed % width, (seed // width) % height), fill = (0, 0, 0, 255))
+    return image
+
+@pytest.fixture
+def make_equation_image():
+    return equation_image
+
+def bulk_write_per_operation(collection, operations: List[UpdateOne], ordered: bool = True, **kwargs):
+    # the services only bulk write UpdateOnes, ordered or not makes no difference applied in sequence
+    for operation in operations:
+        collection.update_one(operation._filter, operation._doc, upsert = operation._upsert)
+
+@pytest.fixture(scope = "session")
+def mongo_client():
+    """
+    A local mongod client when MATHCLIPS_BENCH_MONGO_URL is set, otherwise an in-memory mongomock one.
+    """
+    if MONGO_URL:
+        pymongo = pytest.importorskip("pymongo")
+        client = pymongo.MongoClient(MONGO_URL, serverSelectionTimeoutMS = 2000)
+        try:
+            client.admin.command("ping")
+        except pymongo.errors.PyMongoError as ex:
+            pytest.skip(f"no mongod reachable at {MONGO_URL}: {ex}")
+        yield client
+        client.close()
+        return
+    mongomock = pytest.importorskip("mongomock")
+    import mongomock.gridfs
+    mongomock.gridfs.enable_gridfs_integration()
+    client = mongomock.MongoClient()
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        # mongomock's bulk_write rejects the operations of pymongo 4, the services' bulk upserts run one by one
+        monkeypatch.setattr(mongomock.collection.Collection, "bulk_write", bulk_write_per_operation)
+        yield client
+    client.close()
+
+@pytest.fixture
+def bench_db(mongo_client) -> Iterator:
+    # a fresh database per benchmark, so collection sizes do not carry over between cases
+    database_name = f"{BENCH_DATABASE_NAME}_{uuid.uuid4().hex[:8]}"
+    yield mongo_client[database_name]
+    mongo_client.drop_database(database_name)
+
+@pytest.fixture
+def service_modules(mongo_client, bench_db, monkeypatch: pytest.MonkeyPatch):
+    """
+    The ML pipeline and ingest modules, with their database handles pointed at `bench_db` and
+    `StubOCRModel` loaded in place of the OCR weights.  Skipped without torch and pix2tex.
+    """
+    pytest.importorskip("torch")
+    pytest.importorskip("pix2tex")
+    import mathclips.services.mongodb as mongodb
+    # the service modules connect on import, to the bench server instead of the deployment's
+    monkeypatch.setattr(mongodb, "MongoClient", lambda *args, **kwargs: mongo_client)
+    from mathclips.services import image_to_equation_interface as interface
+    from mathclips.services import ingest
+    from mathclips.services.image_to_equation_interface import MLPipelineInterface, ModelVersion
+
+    image_db = mongodb.MathSymbolImageDatabase(db = bench_db)
+    for name, database in (("image_db", image_db),
+                           ("result_db", mongodb.MathSymbolResultDatabase(db = bench_db)),
+                           ("checkpoint_db", mongodb.MLCheckpointDatabase(db = bench_db)),
+                           ("ocr_cache_db", mongodb.OCRResultCacheDatabase(db = bench_db))):
+        monkeypatch.setattr(MLPipelineInterface, name, database)
+    monkeypatch.setattr(ingest, "notebook_db", mongodb.NotebookDatabase(db = bench_db))
+    monkeypatch.setattr(MLPipelineInterface, "checkpoint_cache", None)
+
+    stub_model = StubOCRModel()
+    monkeypatch.setattr(MLPipelineInterface, "get_current_model_version",
+                        staticmethod(lambda: ModelVersion(weights_path = Path("stub_weights.pth"))))
+    monkeypatch.setattr(MLPipelineInterface, "load_model_version",
+                        staticmethod(lambda model_version, backend = None: stub_model))
+    extract_equations = MLPipelineInterface._extract_equations_from_images
+
+    def extract_equations_with_stub(self, images: List[Image.Image]) -> List[str]:
+        # batched inference drives the torch model directly, the stub answers for the whole batch instead
+        if isinstance(self.ocr_model, StubOCRModel):
+            return self.ocr_model.batch(images)
+        return extract_equations(self, images)
+
+    monkeypatch.setattr(MLPipelineInterface, "_extract_equations_from_images", extract_equations_with_stub)
+    return SimpleNamespace(interface = interface, ingest = ingest, image_db = image_db, stub_model = stub_model)
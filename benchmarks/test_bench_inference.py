@@ -0,0 +1,52 @@
+"""
+LatexOCR latency for one image, and for batches through `MLPipelineInterface._extract_equations_from_images`.
+
+These are the only benchmarks that run the real model, on CPU.  They are skipped unless the pix2tex weights are
+already downloaded, so the suite never reaches for the network.
+
+usage:
+    python -m pytest benchmarks/test_bench_inference.py [--benchmark-autosave]
+"""
+from __future__ import annotations
+
+from pathlib import Path
+from typing import List
+
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+pytest.importorskip("torch")
+pix2tex = pytest.importorskip("pix2tex")
+from PIL import Image
+
+import mathclips.data
+from mathclips.services.transport import InProcessTransport
+
+BATCH_SIZES = (1, 4, 16)
+test_images_dir = Path(mathclips.data.__path__[0]).joinpath("test_images")
+pix2tex_checkpoints_dir = Path(pix2tex.__path__[0]).joinpath("model", "checkpoints")
+
+@pytest.fixture(scope = "module")
+def ocr_model():
+    if not all(pix2tex_checkpoints_dir.joinpath(name).exists() for name in ("weights.pth", "image_resizer.pth")):
+        pytest.skip(f"pix2tex weights are not downloaded to {pix2tex_checkpoints_dir}")
+    from pix2tex.cli import LatexOCR
+    return LatexOCR()
+
+@pytest.fixture(scope = "module")
+def sample_image() -> Image.Image:
+    return Image.open(test_images_dir.joinpath("moment_of_intertia_snippet.png")).convert("RGB")
+
+def test_latex_ocr_single(benchmark, ocr_model, sample_image: Image.Image):
+    assert benchmark.pedantic(ocr_model, args = (sample_image,), rounds = 5, warmup_rounds = 1)
+
+@pytest.mark.parametrize("batch_size", BATCH_SIZES)
+def test_latex_ocr_batched(benchmark, service_modules, ocr_model, sample_image: Image.Image, batch_size: int):
+    ml_pipeline_interface = service_modules.interface.MLPipelineInterface(transport = InProcessTransport())
+    # the real model in place of the stub the other benchmarks run
+    ml_pipeline_interface.ocr_model = ocr_model
+    images: List[Image.Image] = [sample_image] * batch_size
+    predictions = benchmark.pedantic(ml_pipeline_interface._extract_equations_from_images, args = (images,),
+                                     rounds = 3, warmup_rounds = 1)
+    benchmark.extra_info["images_per_batch"] = batch_size
+    assert len(predictions) == batch_size
@@ -0,0 +1,73 @@
+"""
+Upload to notebook throughput: images are stored and published the way the upload page does, an ML worker
+(with `StubOCRModel`) and a result listener consume them over the in-process transport, and a round ends
+once every equation is in the notebook collection.  Measures the storage, messaging and bookkeeping around
+the model, one-at-a-time and micro-batched.
+
+usage:
+    python -m pytest benchmarks/test_bench_pipeline.py [--benchmark-autosave]
+"""
+from __future__ import annotations
+
+import threading
+import time
+from itertools import count
+
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+from mathclips.proto.pb_py_classes.image_pb2 import Image as ProtoImage
+from mathclips.services import IngestQueueNames
+from mathclips.services.transport import InProcessTransport
+
+IMAGES_PER_ROUND: int = 64
+ROUND_TIMEOUT_S: float = 60.0
+# (ML batch size, result batch size)
+BATCH_SIZES = {"unbatched": (1, 1), "batched": (16, 16)}
+
+@pytest.fixture(params = list(BATCH_SIZES))
+def running_pipeline(request, service_modules):
+    ml_batch_size, result_batch_size = BATCH_SIZES[request.param]
+    transport = InProcessTransport()
+    stop_event = threading.Event()
+    workers = [
+        threading.Thread(target = service_modules.interface.ml_worker, name = "bench_ml_worker", daemon = True,
+                         kwargs = dict(batch_size = ml_batch_size, transport = transport, stop_event = stop_event)),
+        threading.Thread(target = service_modules.ingest.equation_result_listener, name = "bench_result_worker",
+                         daemon = True, kwargs = dict(batch_size = result_batch_size, transport = transport,
+                                                      stop_event = stop_event))]
+    for worker in workers:
+        worker.start()
+    yield transport, request.param
+    stop_event.set()
+    for worker in workers:
+        worker.join(timeout = 10)
+
+def test_upload_to_notebook_throughput(benchmark, service_modules, running_pipeline, make_equation_image):
+    transport, mode = running_pipeline
+    image_db = service_modules.image_db
+    notebook_collection = service_modules.ingest.notebook_db.collection
+    round_numbers = count()
+    image_seeds = count()
+
+    def upload_round() -> str:
+        section = f"round_{next(round_numbers)}"
+        for i in range(IMAGES_PER_ROUND):
+            file_id = image_db.store_image(make_equation_image(800, 200, seed = next(image_seeds)),
+                                           f"{section}_{i}.png", ProtoImage.EquationType.HANDWRITTEN,
+                                           equation_name = f"equation_{i}", equation_section = section,
+                                           author_name = "bench")
+            transport.publish(ProtoImage(uid = file_id, equationType = ProtoImage.EquationType.HANDWRITTEN,
+                                         equation_name = f"equation_{i}", author = "bench",
+                                         parent_section = section), IngestQueueNames.ML_PIPELINE_QUEUE)
+        deadline = time.monotonic() + ROUND_TIMEOUT_S
+        while notebook_collection.count_documents(dict(section = section)) < IMAGES_PER_ROUND:
+            assert time.monotonic() < deadline, f"{section} did not reach the notebook in {ROUND_TIMEOUT_S}s"
+            time.sleep(0.002)
+        return section
+
+    benchmark.pedantic(upload_round, rounds = 5, warmup_rounds = 1)
+    benchmark.extra_info["images_per_round"] = IMAGES_PER_ROUND
+    benchmark.extra_info["images_per_s"] = IMAGES_PER_ROUND / benchmark.stats.stats.mean
+    print(f"\n{mode}: {IMAGES_PER_ROUND / benchmark.stats.stats.mean:.1f} images/s upload to notebook")
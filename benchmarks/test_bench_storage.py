@@ -0,0 +1,47 @@
+"""
+`MathSymbolImageDatabase.store_image` and `get_image` / `get_images` across image sizes,
+against mongomock or MATHCLIPS_BENCH_MONGO_URL (see conftest.py).
+
+usage:
+    python -m pytest benchmarks/test_bench_storage.py [--benchmark-autosave]
+"""
+from __future__ import annotations
+
+from itertools import count
+from typing import Tuple
+
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+from mathclips.proto.pb_py_classes.image_pb2 import Image as ProtoImage
+from mathclips.services.mongodb import MathSymbolImageDatabase
+
+# a pasted symbol, the draw widget canvas and a full screenshot
+IMAGE_SIZES: Tuple[Tuple[int, int], ...] = ((128, 64), (800, 200), (1920, 1080))
+BATCH_SIZE: int = 16
+
+def size_id(size: Tuple[int, int]) -> str:
+    return f"{size[0]}x{size[1]}"
+
+@pytest.mark.parametrize("image_size", IMAGE_SIZES, ids = size_id)
+def test_store_image(benchmark, bench_db, make_equation_image, image_size: Tuple[int, int]):
+    image_db = MathSymbolImageDatabase(db = bench_db)
+    image = make_equation_image(*image_size)
+    names = (f"bench_{i}.png" for i in count())
+    file_id = benchmark(lambda: image_db.store_image(image, next(names), ProtoImage.EquationType.HANDWRITTEN))
+    assert image_db.get_image(file_id).size == image_size
+
+@pytest.mark.parametrize("image_size", IMAGE_SIZES, ids = size_id)
+def test_get_image(benchmark, bench_db, make_equation_image, image_size: Tuple[int, int]):
+    image_db = MathSymbolImageDatabase(db = bench_db)
+    file_id = image_db.store_image(make_equation_image(*image_size), "bench.png", ProtoImage.EquationType.HANDWRITTEN)
+    assert benchmark(image_db.get_image, file_id).size == image_size
+
+@pytest.mark.parametrize("image_size", IMAGE_SIZES, ids = size_id)
+def test_get_images_batch(benchmark, bench_db, make_equation_image, image_size: Tuple[int, int]):
+    image_db = MathSymbolImageDatabase(db = bench_db)
+    file_ids = [image_db.store_image(make_equation_image(*image_size, seed = i), f"bench_{i}.png",
+                                     ProtoImage.EquationType.HANDWRITTEN) for i in range(BATCH_SIZE)]
+    images = benchmark(image_db.get_images, file_ids)
+    assert all(image.size == image_size for image in images)
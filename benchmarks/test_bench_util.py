@@ -0,0 +1,80 @@
+"""
+ObjectId <-> UintPackedBytes conversions, one at a time and a whole list of 1M packed ids, and notebook merges
+(`update_nested_dict` and the YAML export's `update_result_config`) at growing notebook sizes.
+
+usage:
+    python -m pytest benchmarks/test_bench_util.py [--benchmark-autosave]
+"""
+from __future__ import annotations
+
+import copy
+from pathlib import Path
+from typing import Dict, List
+
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+from bson.objectid import ObjectId
+
+from mathclips.services.util import (object_id_from_packed, packed_from_object_id, object_ids_from_packed,
+                                     update_nested_dict)
+
+ID_COUNTS = (1, 1_000)
+# the bulk conversion, per id against one pass over the list.  The other direction has no batch version,
+# constructing the protobuf messages is most of its cost and one pass measured no faster than per id
+BULK_ID_COUNT: int = 1_000_000
+NOTEBOOK_SIZES = (10, 1_000, 10_000)
+EQUATIONS_PER_SECTION: int = 10
+
+def notebook_entry(section: str, equation_name: str) -> Dict:
+    # the shape ingest merges into the notebook, see ingest.notebook_config_entry
+    return {section: {equation_name: dict(author = "bench", latex = "x^2",
+                                          db_id = dict(first_bits = 1, last_bits = 2))}}
+
+def synthetic_notebook(num_equations: int) -> Dict:
+    notebook: Dict = {}
+    for i in range(num_equations):
+        update_nested_dict(notebook, notebook_entry(f"section_{i // EQUATIONS_PER_SECTION}", f"equation_{i}"))
+    return notebook
+
+@pytest.mark.parametrize("num_ids", ID_COUNTS)
+def test_packed_from_object_id(benchmark, num_ids: int):
+    object_ids: List[ObjectId] = [ObjectId() for _ in range(num_ids)]
+    packed = benchmark(lambda: [packed_from_object_id(object_id) for object_id in object_ids])
+    assert object_id_from_packed(packed[-1]) == object_ids[-1]
+
+@pytest.mark.parametrize("num_ids", ID_COUNTS)
+def test_object_id_from_packed(benchmark, num_ids: int):
+    object_ids: List[ObjectId] = [ObjectId() for _ in range(num_ids)]
+    packed = [packed_from_object_id(object_id) for object_id in object_ids]
+    assert benchmark(lambda: [object_id_from_packed(uid) for uid in packed]) == object_ids
+
+@pytest.mark.parametrize("notebook_size", NOTEBOOK_SIZES)
+def test_update_nested_dict(benchmark, notebook_size: int):
+    notebook = synthetic_notebook(notebook_size)
+    # a new equation in an existing section, the common case for a result
+    entry = notebook_entry("section_0", "new_equation")
+    benchmark(update_nested_dict, notebook, copy.deepcopy(entry))
+    assert notebook["section_0"]["new_equation"]["latex"] == "x^2"
+
+@pytest.mark.parametrize("notebook_size", NOTEBOOK_SIZES)
+def test_update_result_config(benchmark, service_modules, tmp_path: Path, monkeypatch: pytest.MonkeyPatch,
+                              notebook_size: int):
+    ingest = service_modules.ingest
+    # the YAML export is rewritten in full on every call
+    session_config = ingest.SessionResultConfig(config_path = tmp_path.joinpath("notebook.yml"),
+                                                config_data = synthetic_notebook(notebook_size))
+    monkeypatch.setitem(ingest.SESSION_RESULT_CONFIG_MAP, "default", session_config)
+    benchmark(ingest.update_result_config, notebook_entry("section_0", "new_equation"))
+    assert session_config.config_path.exists()
+
+@pytest.fixture(scope = "module")
+def million_object_ids() -> List[ObjectId]:
+    return [ObjectId() for _ in range(BULK_ID_COUNT)]
+
+@pytest.mark.parametrize("conversion", ["per_id", "batch"])
+def test_bulk_object_ids_from_packed(benchmark, million_object_ids: List[ObjectId], conversion: str):
+    packed = [packed_from_object_id(object_id) for object_id in million_object_ids]
+    convert = object_ids_from_packed if conversion == "batch" else \
+        lambda uids: [object_id_from_packed(uid) for uid in uids]
+    assert benchmark.pedantic(convert, args = (packed,), rounds = 3) == million_object_ids
@@ -0,0 +1,96 @@
+"""
+Wall time of building the training datasets (and optionally training) through the pix2tex CLIs in subprocesses
+versus in memory, in process.  See mathclips.services.training_data.
+
+Uses synthetic equation images, no database needed.  The training comparison runs one epoch from the
+pix2tex template config on each path and is slow, set MATHCLIPS_BENCH_TRAIN=1 to include it.
+
+usage:
+    python -m pytest benchmarks/test_dataset_build.py -s
+"""
+from __future__ import annotations
+
+import os
+import tempfile
+import time
+from pathlib import Path
+from typing import List, Tuple
+
+import pytest
+
+pytest.importorskip("pix2tex")
+import yaml
+from munch import Munch
+from PIL import Image, ImageDraw
+
+from mathclips.services.training_data import (pix2tex_root, InMemoryIm2LatexDataset, build_pickled_dataset,
+                                              resolve_tokenizer_path, run_training_in_process,
+                                              run_training_subprocess)
+
+SAMPLE_COUNTS = (8, 64, 256)
+RUN_TRAINING: bool = os.environ.get("MATHCLIPS_BENCH_TRAIN", "0") == "1"
+
+def synthetic_samples(num_samples: int) -> Tuple[List[Image.Image], List[str]]:
+    images: List[Image.Image] = []
+    labels: List[str] = []
+    for i in range(num_samples):
+        label = f"x_{{{i}}} = \\frac{{{i}}}{{{i + 1}}}"
+        image = Image.new("L", (64 + 16 * (i % 4), 32 + 16 * (i % 3)), color = 255)
+        ImageDraw.Draw(image).text((4, 4), f"x{i}={i}/{i + 1}", fill = 0)
+        image.info["filename"] = f"{i}.png"
+        images.append(image)
+        labels.append(label)
+    return images, labels
+
+def template_config() -> Munch:
+    with open(pix2tex_root / "model" / "settings" / "config.yaml", 'r') as config_template_file:
+        return Munch(yaml.safe_load(config_template_file))
+
+def one_epoch_config(work_dir: Path, num_samples: int) -> Munch:
+    train_config = template_config()
+    train_config.update(name = "mathclips_bench", model_path = str(work_dir), epochs = 1, num_epochs = 1,
+                        batchsize = min(64, num_samples), valbatches = 1, max_width = 512, max_height = 512,
+                        pad = True, debug = True)
+    return train_config
+
+@pytest.mark.parametrize("num_samples", SAMPLE_COUNTS)
+def test_dataset_build_wall_time(num_samples: int):
+    images, labels = synthetic_samples(num_samples)
+    tokenizer_path = resolve_tokenizer_path(template_config().tokenizer)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        work_dir = Path(temp_dir)
+        start_time = time.perf_counter()
+        train_path = build_pickled_dataset(images, labels, work_dir, "train")
+        val_path = build_pickled_dataset(images, labels, work_dir, "val")
+        subprocess_s = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        train_dataset = InMemoryIm2LatexDataset.from_images(images, labels, tokenizer = tokenizer_path)
+        val_dataset = InMemoryIm2LatexDataset.from_images(images, labels, tokenizer = tokenizer_path)
+        in_process_s = time.perf_counter() - start_time
+
+        print(f"[{num_samples:>4} samples] dataset build: subprocess {subprocess_s:8.2f} s  "
+              f"in process {in_process_s:8.2f} s  ({subprocess_s / max(in_process_s, 1e-9):.1f}x)")
+        assert train_path.exists() and val_path.exists()
+        # every synthetic image is within the default dimensions, nothing is filtered out
+        assert sum(len(samples) for samples in train_dataset.data.values()) == num_samples
+
+        if not RUN_TRAINING:
+            return
+
+        config_path = work_dir.joinpath("bench_config.yml")
+        subprocess_config = one_epoch_config(work_dir.joinpath("subprocess"), num_samples)
+        subprocess_config.update(data = str(train_path), valdata = str(val_path))
+        with open(config_path, 'w') as config_file:
+            yaml.safe_dump(dict(subprocess_config), config_file)
+        start_time = time.perf_counter()
+        run_training_subprocess(config_path)
+        subprocess_train_s = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        run_training_in_process(one_epoch_config(work_dir.joinpath("in_process"), num_samples),
+                                train_dataset, val_dataset)
+        in_process_train_s = time.perf_counter() - start_time
+        print(f"[{num_samples:>4} samples] one epoch:     subprocess {subprocess_train_s:8.2f} s  "
+              f"in process {in_process_train_s:8.2f} s")
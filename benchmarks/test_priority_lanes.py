@@ -0,0 +1,68 @@
+"""
+Latency of interactive ML pipeline messages while a bulk import saturates the workers,
+with everything on one FIFO queue versus on separate interactive and bulk lanes (see transport.QueueLanes).
+
+Runs on the in-process transport with simulated workers that spend a fixed time per message, no broker or model needed.
+A bulk backlog is published up front, interactive messages trickle in while it drains.
+
+usage:
+    python -m pytest benchmarks/test_priority_lanes.py -s
+"""
+from __future__ import annotations
+
+import statistics
+import threading
+import time
+from typing import Dict, List
+
+from mathclips.proto.pb_py_classes.image_pb2 import Image as ProtoImage
+from mathclips.services import ML_PIPELINE_LANE_WEIGHTS
+from mathclips.services.transport import InProcessTransport, QueueLanes, consume
+
+NUM_WORKERS = 2
+SERVICE_TIME_S = 0.005
+BULK_BACKLOG = 400
+NUM_INTERACTIVE = 30
+INTERACTIVE_INTERVAL_S = 0.05
+
+def interactive_latencies_ms(use_lanes: bool) -> List[float]:
+    transport = InProcessTransport()
+    lanes = QueueLanes(queue_names = ("interactive", "bulk"), weights = ML_PIPELINE_LANE_WEIGHTS)
+    bulk_queue = "bulk" if use_lanes else "interactive"
+    published_at: Dict[str, float] = {}
+    latencies_ms: List[float] = []
+    results_lock = threading.Lock()
+    stop_event = threading.Event()
+
+    def on_delivery(delivery):
+        time.sleep(SERVICE_TIME_S)
+        name = delivery.decode(ProtoImage).equation_name
+        transport.ack(delivery)
+        if name in published_at:
+            with results_lock:
+                latencies_ms.append((time.perf_counter() - published_at[name]) * 1000.0)
+                if len(latencies_ms) == NUM_INTERACTIVE:
+                    stop_event.set()
+
+    transport.publish_many([ProtoImage(equation_name = f"bulk{i}") for i in range(BULK_BACKLOG)], bulk_queue)
+    queue = lanes if use_lanes else "interactive"
+    workers = [threading.Thread(target = consume, args = (transport, queue, on_delivery),
+                                kwargs = dict(stop_event = stop_event)) for _ in range(NUM_WORKERS)]
+    for worker in workers:
+        worker.start()
+    for i in range(NUM_INTERACTIVE):
+        name = f"interactive{i}"
+        published_at[name] = time.perf_counter()
+        transport.publish(ProtoImage(equation_name = name), "interactive")
+        time.sleep(INTERACTIVE_INTERVAL_S)
+    for worker in workers:
+        worker.join()
+    return latencies_ms
+
+def test_interactive_latency_under_bulk_load():
+    for use_lanes in (False, True):
+        latencies_ms = sorted(interactive_latencies_ms(use_lanes))
+        p99_ms = latencies_ms[min(len(latencies_ms) - 1, int(0.99 * len(latencies_ms)))]
+        print(f"{'lanes' if use_lanes else 'fifo':>5}: interactive p50 {statistics.median(latencies_ms):8.1f} ms  "
+              f"p99 {p99_ms:8.1f} ms  ({BULK_BACKLOG} bulk messages queued ahead)")
+        assert len(latencies_ms) == NUM_INTERACTIVE
@@ -0,0 +1,176 @@
+"""
+Query plan checks for the hot Mathclips queries at 10k, 100k and 1M records.
+
+Every hot query is run through `explain()` against a scratch database filled with synthetic records,
+and fails if its winning plan contains a COLLSCAN.  Needs a real mongod (mongomock has no query planner),
+set MATHCLIPS_BENCH_MONGO_URL to point at one, the tests are skipped when it cannot be reached.
+
+usage:
+    python -m pytest benchmarks/test_query_plans.py -s
+"""
+from __future__ import annotations
+
+import os
+import random
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Iterator, List
+
+import pytest
+
+pymongo = pytest.importorskip("pymongo")
+from bson.objectid import ObjectId
+from pymongo.database import Database
+
+from mathclips.services.mongodb import (MathSymbolImageDatabase, MathSymbolResultDatabase, MLCheckpointDatabase,
+                                        TrainingCandidateDatabase, TrainingJobDatabase, ensure_all_indexes)
+from mathclips.services.util import packed_from_object_id
+
+MONGO_URL: str = os.environ.get("MATHCLIPS_BENCH_MONGO_URL", "mongodb://localhost:27017/")
+BENCH_DATABASE_NAME: str = "mathclips_query_plan_bench"
+RECORD_COUNTS = (10_000, 100_000, 1_000_000)
+# fraction of images waiting for training, the partial index only ever holds these
+NEEDS_TRAIN_FRACTION: float = 0.001
+INSERT_CHUNK_SIZE: int = 10_000
+
+def connect() -> pymongo.MongoClient:
+    client = pymongo.MongoClient(MONGO_URL, serverSelectionTimeoutMS = 2000)
+    try:
+        client.admin.command("ping")
+    except pymongo.errors.PyMongoError as ex:
+        pytest.skip(f"no mongod reachable at {MONGO_URL}: {ex}")
+    return client
+
+def plan_stages(plan: Dict) -> Iterator[str]:
+    """
+    Every stage name in an explain plan tree, classic and slot based engine layouts alike.
+    """
+    if "stage" in plan:
+        yield plan["stage"]
+    for key in ("inputStage", "queryPlan", "winningPlan"):
+        if isinstance(plan.get(key), dict):
+            yield from plan_stages(plan[key])
+    for child_plan in plan.get("inputStages", []):
+        yield from plan_stages(child_plan)
+
+def winning_plan(explain_output: Dict) -> Dict:
+    query_planner = explain_output.get("queryPlanner")
+    if query_planner is None:
+        # aggregate explains nest the planner under the first pipeline stage
+        query_planner = explain_output["stages"][0]["$cursor"]["queryPlanner"]
+    return query_planner["winningPlan"]
+
+def insert_in_chunks(collection, documents: Iterator[Dict]):
+    chunk: List[Dict] = []
+    for document in documents:
+        chunk.append(document)
+        if len(chunk) == INSERT_CHUNK_SIZE:
+            collection.insert_many(chunk, ordered = False)
+            chunk = []
+    if chunk:
+        collection.insert_many(chunk, ordered = False)
+
+def populate(db: Database, num_records: int) -> Dict:
+    """
+    Fill the collections through the database classes, after creating their declared indexes,
+    returning a few ids the hot queries look up.
+    """
+    ensure_all_indexes(db)
+    image_db = MathSymbolImageDatabase(db)
+    result_db = MathSymbolResultDatabase(db)
+    checkpoint_db = MLCheckpointDatabase(db)
+    candidate_db = TrainingCandidateDatabase(db)
+    job_db = TrainingJobDatabase(db)
+
+    file_storage_ids = [ObjectId() for _ in range(num_records)]
+    needs_train_count = max(1, int(num_records * NEEDS_TRAIN_FRACTION))
+    insert_in_chunks(image_db.collection, (
+        dict(image_filename = f"{i:07d}.png", file_storage_id = file_id, image_size = [800, 200], image_mode = "L",
+             needs_train = i < needs_train_count, train_label = "x" if i < needs_train_count else None,
+             equation_type = 0, equation_name = f"equation {i}", equation_section = f"section {i % 50}",
+             author_name = "benchmark")
+        for i, file_id in enumerate(file_storage_ids)))
+    result_ids = [ObjectId() for _ in range(num_records)]
+    insert_in_chunks(result_db.collection, (
+        dict(_id = result_id, input_entry_id = file_id, is_correct = True, latex_label = "x", checkpoint_id = "bench")
+        for result_id, file_id in zip(result_ids, file_storage_ids)))
+    start_date = datetime(2024, 1, 1)
+    insert_in_chunks(checkpoint_db.collection, (
+        dict(file_storage_id = ObjectId(), checkpoint_filename = f"{i}.pth",
+             date_created = start_date + timedelta(minutes = i), training_file_ids = [])
+        for i in range(max(1, num_records // 100))))
+    # candidates from past batches are deleted, only the pending ones are left around
+    insert_in_chunks(candidate_db.collection, (
+        dict(file_storage_id = file_id, train_label = "x", pending = True, batch_id = None, date_marked = start_date)
+        for file_id in file_storage_ids[:needs_train_count]))
+    candidate_db.recount()
+    insert_in_chunks(job_db.collection, (
+        dict(batch_id = ObjectId(), status = "succeeded", date_created = start_date + timedelta(minutes = i))
+        for i in range(max(1, num_records // 100))))
+
+    sample_index = random.randrange(num_records)
+    return dict(image_db = image_db, result_db = result_db, checkpoint_db = checkpoint_db,
+                candidate_db = candidate_db, job_db = job_db, file_storage_id = file_storage_ids[sample_index], result_id = result_ids[sample_index])
+
+def hot_query_explains(bench: Dict) -> Dict[str, Callable[[], Dict]]:
+    image_collection = bench["image_db"].collection
+    result_collection = bench["result_db"].collection
+    checkpoint_collection = bench["checkpoint_db"].collection
+    candidate_collection = bench["candidate_db"].collection
+    job_collection = bench["job_db"].collection
+    db: Database = image_collection.database
+    return {
+        # MathSymbolImageDatabase.get_image legacy fallback
+        "get_image find_one(file_storage_id)": lambda: image_collection.find(
+            dict(file_storage_id = bench["file_storage_id"])).limit(1).explain(),
+        # TrainingCandidateDatabase.seed_from_images
+        "find(needs_train = True)": lambda: image_collection.find(dict(needs_train = True)).explain(),
+        # TrainingCandidateDatabase.mark_candidate
+        "pending candidate by file_storage_id": lambda: candidate_collection.find(
+            dict(file_storage_id = bench["file_storage_id"], pending = True)).limit(1).explain(),
+        # TrainingCandidateDatabase.snapshot_batch
+        "update_many(pending = True)": lambda: db.command(
+            "explain", {"update": candidate_collection.name,
+                        "updates": [{"q": dict(pending = True),
+                                     "u": {'$set': dict(pending = False, batch_id = ObjectId())},
+                                     "multi": True}]}),
+        "candidates by batch_id": lambda: candidate_collection.find(dict(batch_id = ObjectId())).explain(),
+        # TrainingJobDatabase.claim_next
+        "oldest queued training job": lambda: job_collection.find(
+            dict(status = "queued")).sort("date_created", 1).limit(1).explain(),
+        # TrainingJobDatabase.recent_jobs
+        "recent training jobs": lambda: job_collection.find({}).sort("date_created", -1).limit(20).explain(),
+        # complete_training_batch unmarking the trained samples
+        "update_many(file_storage_id $in)": lambda: db.command(
+            "explain", {"update": image_collection.name,
+                        "updates": [{"q": dict(file_storage_id = {'$in': [bench["file_storage_id"]]}),
+                                     "u": {'$set': dict(needs_train = False)}, "multi": True}]}),
+        # MathclipsDatabase.record_from_id
+        "record_from_id(_id)": lambda: result_collection.find(
+            dict(_id = bench["result_id"])).limit(1).explain(),
+        "results by input_entry_id": lambda: result_collection.find(
+            dict(input_entry_id = bench["file_storage_id"])).explain(),
+        # MLPipelineInterface.get_current_model_version
+        "newest checkpoint": lambda: checkpoint_collection.find({}).sort("date_created", -1).limit(1).explain(),
+    }
+
+@pytest.mark.parametrize("num_records", RECORD_COUNTS)
+def test_hot_queries_use_indexes(num_records: int):
+    client = connect()
+    client.drop_database(BENCH_DATABASE_NAME)
+    try:
+        bench = populate(client[BENCH_DATABASE_NAME], num_records)
+        # sanity check that the packed id path resolves against the populated collection
+        assert bench["result_db"].record_from_id(packed_from_object_id(bench["result_id"])) is not None
+        collection_scans: List[str] = []
+        for query_name, explain in hot_query_explains(bench).items():
+            start_time = time.perf_counter()
+            explain_output = explain()
+            elapsed_ms = (time.perf_counter() - start_time) * 1000.0
+            stages = list(plan_stages(winning_plan(explain_output)))
+            print(f"[{num_records:>9,} records] {query_name:<40} {elapsed_ms:8.2f} ms  plan: {' <- '.join(stages)}")
+            if "COLLSCAN" in stages:
+                collection_scans.append(query_name)
+        assert not collection_scans, f"collection scans at {num_records} records: {collection_scans}"
+    finally:
+        client.drop_database(BENCH_DATABASE_NAME)
@@ -0,0 +1,88 @@
+"""
+Aggregate OCR throughput of one machine for different ML worker layouts: number of worker processes times
+torch threads per worker, pinned or not.  See mathclips.services.cpu_budget.
+
+Each worker is a forked process that applies its CPU budget, loads the pix2tex model and, once all workers
+are ready, runs the same synthetic equation images.  The "default" layouts leave torch to size its own thread
+pools, the way the ML workers ran before budgets, and show the oversubscription.
+
+usage:
+    python -m pytest benchmarks/test_worker_thread_layout.py -s
+"""
+from __future__ import annotations
+
+import multiprocessing
+import time
+from typing import List, Tuple
+
+import pytest
+
+pytest.importorskip("pix2tex")
+from PIL import Image, ImageDraw
+
+from mathclips.services.cpu_budget import CPUBudget, available_cores, apply_cpu_budget, plan_cpu_budgets
+
+IMAGES_PER_WORKER = 8
+
+def synthetic_images(num_images: int) -> List[Image.Image]:
+    images: List[Image.Image] = []
+    for i in range(num_images):
+        image = Image.new("RGB", (240, 64), color = (255, 255, 255))
+        ImageDraw.Draw(image).text((8, 24), f"x_{i} = {i}/{i + 1} + y^2", fill = (0, 0, 0))
+        images.append(image)
+    return images
+
+def layout_worker(budget: CPUBudget|None, ready: multiprocessing.Barrier, results: multiprocessing.Queue):
+    if budget is not None:
+        apply_cpu_budget(budget)
+    # the model directly, the interface module would connect to the databases on import
+    from pix2tex.cli import LatexOCR
+    model = LatexOCR()
+    images = synthetic_images(IMAGES_PER_WORKER)
+    # warm up outside the timed section
+    model(images[0])
+    ready.wait()
+    start_time = time.perf_counter()
+    for image in images:
+        model(image)
+    results.put((start_time, time.perf_counter()))
+
+def run_layout(num_workers: int, budgets: List[CPUBudget|None]) -> float:
+    """
+    Images per second over all workers, from the first worker starting to the last one finishing.
+    """
+    context = multiprocessing.get_context("fork")
+    ready = context.Barrier(num_workers)
+    results = context.Queue()
+    processes = [context.Process(target = layout_worker, args = (budget, ready, results)) for budget in budgets]
+    for process in processes:
+        process.start()
+    spans: List[Tuple[float, float]] = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    wall_time = max(end for _, end in spans) - min(start for start, _ in spans)
+    return num_workers * IMAGES_PER_WORKER / wall_time
+
+def layouts() -> List[Tuple[str, int, List[CPUBudget|None]]]:
+    num_cores = len(available_cores())
+    candidates: List[Tuple[str, int, List[CPUBudget|None]]] = []
+    for num_workers in sorted({1, 2, 4, num_cores}):
+        if num_workers > num_cores:
+            continue
+        candidates.append((f"{num_workers} workers, default threads", num_workers, [None] * num_workers))
+        for threads_per_worker in sorted({1, max(1, num_cores // num_workers)}):
+            for pin in (False, True):
+                budgets = plan_cpu_budgets(num_workers, threads_per_worker, pin = pin)
+                name = f"{num_workers} workers x {threads_per_worker} threads{', pinned' if pin else ''}"
+                candidates.append((name, num_workers, budgets))
+    return candidates
+
+def test_worker_thread_layout_throughput():
+    throughputs: List[Tuple[str, float]] = []
+    for name, num_workers, budgets in layouts():
+        images_per_second = run_layout(num_workers, budgets)
+        throughputs.append((name, images_per_second))
+        print(f"{name:>40}: {images_per_second:7.2f} images/s")
+    best_name, best_throughput = max(throughputs, key = lambda named: named[1])
+    print(f"best layout on {len(available_cores())} cores: {best_name} ({best_throughput:.2f} images/s)")
+    assert best_throughput > 0
@@ -2,6 +2,8 @@ required_dependencies = (
     "pika",
     "pymongo",
     "pytest",
+    "pytest-benchmark",
+    "mongomock",
     "pillow",
     "protobuf",
     "grpcio",
@@ -3,22 +3,20 @@ from __future__ import annotations
 from typing import List, Dict, TypeAlias
 from pathlib import Path
 import uuid
-import datetime
 
 import streamlit as st
 from streamlit.delta_generator import DeltaGenerator
-import yaml
 import pymongo
 from pymongo.database import Database
-from munch import Munch
 import pyperclip
 
 import mathclips.front_end
 from mathclips.services.rmq import publish_proto_message
-from mathclips.services import IngestQueueNames
-from mathclips.services.ingest import default_result_config_filename
+from mathclips.services import IngestQueueNames, MESSAGE_TRANSPORT, TransportBackend
 from mathclips.services.logger import logger
-from mathclips.services.mongodb import MathSymbolResultDatabase
+from mathclips.services.mongodb import MathSymbolResultDatabase, NotebookDatabase
+from mathclips.services.notebook_yaml import import_notebook_if_empty
+from mathclips.services.util import packed_from_object_id
 from mathclips.proto.pb_py_classes.image_pb2 import Image as ProtoImage
 from mathclips.proto.pb_py_classes.ocr_result_pb2 import OCR_Result
 from mathclips.proto.pb_py_classes.uint_packed_bytes_pb2 import UintPackedBytes as UintPacked
@@ -29,8 +27,6 @@ IdType: TypeAlias = str | int
 
 mathclips_root_dir = Path(mathclips.__path__[0]).resolve()
 front_end_dir = mathclips_root_dir / "front_end"
-default_config_filename = mathclips.front_end.notebook_config_path
-print(default_config_filename)
 
 st.set_page_config("Math Equation Notebook",
                    page_icon = str(front_end_dir / "static" / "mathclips_logo_small.png"))
@@ -43,42 +39,36 @@ def init_mongo_db_connection():
 def init_result_database(_db: Database):
     return MathSymbolResultDatabase(_db)
 
+@st.cache_resource
+def init_notebook_database(_db: Database):
+    notebook_db = NotebookDatabase(_db)
+    # the page may load before the ingest service first starts after the upgrade
+    import_notebook_if_empty(notebook_db, mathclips.front_end.notebook_config_path)
+    return notebook_db
+
 mongo_client = init_mongo_db_connection()
 db: Database = mongo_client["mathclips_data"]
 result_db = init_result_database(db)
+notebook_db = init_notebook_database(db)
 
-def get_config_file_timestamp(config_filename: Path = default_config_filename):
-    return datetime.datetime.fromtimestamp(config_filename.stat().st_mtime)
+if MESSAGE_TRANSPORT == TransportBackend.IN_PROCESS:
+    # small deployments run the backend services as threads of the streamlit server process
+    from mathclips.services.fused import start_fused_services
+    start_fused_services()
 
 def on_equation_copy(latex_equation: str):
     pyperclip.copy(latex_equation)
     st.toast(body = f"Successfully Copied: {latex_equation}", icon = "✅")
 
 def on_delete_click(result: OCR_Result, widget_keys: List[IdType]):
-    section_config = st.session_state.section_config_data
-    database_id: UintPacked = None
-    if result.input_image_data.parent_section in section_config:
-        if result.input_image_data.equation_name in section_config[result.input_image_data.parent_section]:
-            database_id = UintPacked(\
-                first_bits = int(section_config[result.input_image_data.parent_section][result.input_image_data.equation_name]\
-                    ["db_id"]["first_bits"]),
-                last_bits = int(section_config[result.input_image_data.parent_section][result.input_image_data.equation_name]\
-                    ["db_id"]["last_bits"]))
-            del section_config[result.input_image_data.parent_section][result.input_image_data.equation_name]
-
     for widget_key in widget_keys:
         if widget_key in st.session_state:
             del st.session_state[widget_key]
 
-    if not bool(section_config[result.input_image_data.parent_section]):
-        # remove page if completely empty
-        del section_config[result.input_image_data.parent_section]
-
-    result_db.delete(database_id)
-
-    # reconstruct the config file after removing relevant section data
-    with open(default_config_filename, 'w') as config_file:
-        yaml.safe_dump(section_config, config_file)
+    # a section disappears on its own once its last equation is removed
+    notebook_db.delete_equation(section = result.input_image_data.parent_section,
+                                equation_name = result.input_image_data.equation_name)
+    result_db.delete(result.uid)
 
     st.toast(body = f"Successfully Removed: {result.input_image_data.equation_name}", icon = "✅")
 
@@ -120,25 +110,15 @@ def add_equation_result(result: OCR_Result) -> DeltaGenerator:
                        key = train_widget_id, disabled = disable_retrain_button)
 
 
-def update_session_section_data(config_filename: str = default_config_filename):
+def page_generator(level_one_section_name: str):
     """
     The current prototype only supports one level of Section Headings.
+    Only the equations of the displayed section are loaded from the notebook collection.
 
     TODO - add support for nested headings
     """
-    with open(config_filename, 'r') as config_file:
-        st.session_state['section_config_data'] = yaml.safe_load(config_file)
-        st.session_state['config_file_timestamp'] = get_config_file_timestamp()
-
-if 'section_config_data' not in st.session_state:
-    update_session_section_data()
-# check if the contents of the files have changed recently
-if get_config_file_timestamp() > st.session_state.config_file_timestamp:
-    update_session_section_data()
-
-def page_generator(level_one_section_name: str):
-    equation_train_options = \
-        [str(eq_key) for eq_key in st.session_state.section_config_data[level_one_section_name]]
+    section_equations: List[Dict] = notebook_db.equations_in_section(level_one_section_name)
+    equation_train_options = [str(equation["equation_name"]) for equation in section_equations]
     container = st.sidebar.container(border = True)
     container.subheader(body = "OCR ML Model Retrain Options", divider = "red")
     container.selectbox(label = "Retrain Equation Selection", options = equation_train_options, label_visibility = 'hidden',
@@ -149,23 +129,20 @@ def page_generator(level_one_section_name: str):
                     key = "train_label",
                     placeholder = "Training Label")
 
-    section_data = st.session_state.section_config_data[level_one_section_name]
-    equation_name: str
     equation_data: Dict
-    for equation_name, equation_data_dict in section_data.items():
+    for equation_data in section_equations:
+        equation_name: str = equation_data["equation_name"]
         try:
-            equation_data = Munch(equation_data_dict)
             # not putting this on the wire, but rather, abusing the api of the class to pass data around.
             equation_entry = OCR_Result(
-                uid = UintPacked(first_bits = equation_data.db_id["first_bits"],
-                                 last_bits = equation_data.db_id["last_bits"]),
+                uid = packed_from_object_id(equation_data["result_id"]),
                 input_image_data = ProtoImage(
                     equationType=ProtoImage.EquationType.UNKNOWN,
                     equation_name = equation_name,
-                    author = equation_data.author,
+                    author = equation_data["author"],
                     parent_section = level_one_section_name
                 ),
-                latex = equation_data.latex
+                latex = equation_data["latex"]
             )
             add_equation_result(equation_entry)
 
@@ -174,6 +151,9 @@ def page_generator(level_one_section_name: str):
                           f"in Section: {level_one_section_name}\n"
                          f"ERROR MESSAGE: {ex}"))
 
-pages = list(st.session_state.section_config_data.keys())
+pages = notebook_db.sections()
 selected_page: str = st.sidebar.selectbox("Equation Section", options = pages)
-page_generator(selected_page)
+if selected_page is not None:
+    page_generator(selected_page)
+else:
+    st.info("The notebook is empty, upload an equation image to get started!")
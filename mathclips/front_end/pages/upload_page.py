@@ -16,7 +16,7 @@ from mathclips.services.mongodb import MathSymbolImageDatabase
 from mathclips.proto.pb_py_classes.image_pb2 import Image as ProtoImage
 from mathclips.proto.pb_py_classes.uint_packed_bytes_pb2 import UintPackedBytes as UintPacked
 from mathclips.services.rmq import publish_proto_message
-from mathclips.services import IngestQueueNames
+from mathclips.services import IngestQueueNames, MESSAGE_TRANSPORT, TransportBackend
 
 @st.cache_resource
 def init_mongo_db_connection():
@@ -37,6 +37,11 @@ db = mongo_client["mathclips_data"]
 grid_fs = init_mongo_gridfs(db)
 image_db: MathSymbolImageDatabase = init_image_database(db, grid_fs)
 
+if MESSAGE_TRANSPORT == TransportBackend.IN_PROCESS:
+    # small deployments run the backend services as threads of the streamlit server process
+    from mathclips.services.fused import start_fused_services
+    start_fused_services()
+
 @dataclass
 class PageFunctionMap:
     upload_raw_image: Callable = None
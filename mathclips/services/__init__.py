@@ -1,16 +1,117 @@
+from pathlib import Path
+from typing import Tuple
+
 # cache the image database and ml weights
 # namespace class
 # adding to init to avoid circular referencing
 class IngestQueueNames:
     RESULT_QUEUE: str = "ml_result"
     TRAIN_QUEUE: str = "training_queue"
+    # interactive uploads from the front end
     ML_PIPELINE_QUEUE: str = "ml_pipeline"
+    # bulk imports, consumed by the same workers at a lower priority, see ML_PIPELINE_LANE_WEIGHTS
+    ML_PIPELINE_BULK_QUEUE: str = "ml_pipeline_bulk"
+
+# namespace class for the message transport backends, see mathclips.services.transport
+class TransportBackend:
+    # RabbitMQ, for deployments where services run as separate processes/containers
+    AMQP: str = "amqp"
+    # in-process queues, every consumer runs as a thread of one process and messages are handed over by reference
+    IN_PROCESS: str = "in_process"
+
+# namespace class for the encodings an image can be stored with in GridFS
+class ImageCodec:
+    # legacy format, the uncompressed pillow pixel buffer
+    RAW: str = "raw"
+    PNG: str = "png"
+    WEBP_LOSSLESS: str = "webp_lossless"
+    # PNG of a single luminance channel, used when every pixel is already gray and opaque
+    GRAYSCALE_PNG: str = "grayscale_png"
+
+# namespace class for how the ML workers run the OCR model, see mathclips.services.quantization
+class InferenceBackend:
+    FP32: str = "fp32"
+    # dynamically quantized int8 Linear layers, compare accuracy first with: python -m mathclips.services.quantization --compare
+    INT8_DYNAMIC: str = "int8_dynamic"
+
+# namespace class for the lifecycle of a training job, see mathclips.services.training_jobs
+class TrainingJobStatus:
+    QUEUED: str = "queued"
+    RUNNING: str = "running"
+    SUCCEEDED: str = "succeeded"
+    FAILED: str = "failed"
 
 # TODO - Make these configurable
+# (width, height) the OCR model is fine-tuned at, the training images are preprocessed to the same size
+TRAIN_MAX_DIMENSIONS: Tuple[int, int] = (512, 512)
 MIN_TRAIN_BATCH_SIZE: int = 2
 NUM_TRAIN_WORKERS: int = 2
 NUM_ML_PIPELINES: int = 2
 NUM_RESULT_WORKERS: int = 1
+# how often a resident ML worker checks for newly promoted weights between messages
+CHECKPOINT_POLL_INTERVAL_S: float = 5.0
+# micro-batching for the ML pipeline consumer, a batch size of 1 keeps the one-message-at-a-time behaviour.
+# a batch is run once it is full, or once ML_BATCH_WAIT_MS has passed since its first message arrived.
+ML_BATCH_SIZE: int = 1
+ML_BATCH_WAIT_MS: int = 50
+# ML workers take up to this many interactive messages for every bulk message while both queues have a backlog,
+# see mathclips.services.transport.QueueLanes
+ML_PIPELINE_LANE_WEIGHTS: Tuple[int, int] = (8, 1)
+# number of OCR results each ML worker remembers in memory, in front of the shared mongo cache
+OCR_CACHE_SIZE: int = 1024
+IMAGE_STORAGE_CODEC: str = ImageCodec.GRAYSCALE_PNG
+# the pooled publisher keeps its connection open between publishes, the broker drops it after two missed heartbeats
+RMQ_HEARTBEAT_S: int = 60
+MESSAGE_TRANSPORT: str = TransportBackend.AMQP
+# the notebook lives in mongo, set to True to also keep the legacy YAML notebook file up to date
+EXPORT_NOTEBOOK_YAML: bool = False
+# batched result ingestion, a batch size of 1 keeps the one-message-at-a-time behaviour.
+# a batch is flushed once it is full, or RESULT_FLUSH_INTERVAL_MS after its first result arrived.
+RESULT_BATCH_SIZE: int = 1
+RESULT_FLUSH_INTERVAL_MS: int = 200
+# training runs are queued as jobs and run by a dedicated pool, only one run at a time holds the training lease.
+# the lease is renewed every third of its duration, a worker that dies mid run loses it once it expires.
+NUM_TRAIN_JOB_WORKERS: int = 1
+TRAIN_LEASE_DURATION_S: float = 60.0
+TRAIN_JOB_POLL_INTERVAL_S: float = 5.0
+# a job orphaned by a dead worker is re-run this many times before it is marked failed
+TRAIN_JOB_MAX_ATTEMPTS: int = 3
+# build the training datasets in memory and run pix2tex.train as a library, False runs the pix2tex CLIs in subprocesses
+TRAIN_IN_PROCESS: bool = True
+# node local cache of decoded training samples (grayscale pixels and token ids) shared across training runs,
+# only used when training in process. None disables it.
+TRAIN_SHARD_CACHE_DIR: Path|None = Path.home().joinpath(".cache", "mathclips", "train_shards")
+# ML workers fetch the newest promoted checkpoint from mongo into this node local cache, shared by every
+# worker process on the node.  None makes them read the weights the training process promotes on its filesystem.
+CHECKPOINT_CACHE_DIR: Path|None = Path.home().joinpath(".cache", "mathclips", "checkpoints")
+# checkpoints kept in the node local cache, older ones are removed as new ones arrive
+CHECKPOINT_CACHE_KEEP: int = 3
+ML_INFERENCE_BACKEND: str = InferenceBackend.FP32
+# torch/OpenMP/MKL threads per ML worker process, None splits the available cores evenly between NUM_ML_PIPELINES
+ML_THREADS_PER_WORKER: int|None = None
+# pin each ML worker process to its own cores
+ML_PIN_WORKER_CORES: bool = False
+# run the queue consumers under the autoscaling supervisor (mathclips.services.autoscale) instead of the fixed
+# NUM_ML_PIPELINES, NUM_TRAIN_WORKERS and NUM_RESULT_WORKERS processes, each pool scales between its (min, max) bounds
+AUTOSCALE_WORKERS: bool = False
+ML_PIPELINE_WORKER_BOUNDS: Tuple[int, int] = (1, 8)
+RESULT_WORKER_BOUNDS: Tuple[int, int] = (1, 4)
+TRAIN_WORKER_BOUNDS: Tuple[int, int] = (1, 2)
+AUTOSCALE_POLL_INTERVAL_S: float = 5.0
+# scale up when the backlog would take longer than this to drain at the rate the workers are measured to handle it
+AUTOSCALE_TARGET_DRAIN_S: float = 30.0
+# new ML workers spend a while loading the model, wait this long after scaling up before scaling up again
+AUTOSCALE_SCALE_UP_COOLDOWN_S: float = 30.0
+# drain one worker once the queue has been empty, with the workers busy less than the given fraction, for this long
+AUTOSCALE_SCALE_DOWN_IDLE_S: float = 60.0
+AUTOSCALE_SCALE_DOWN_UTILIZATION: float = 0.5
+# a drained worker still running after this long is terminated, its unacked messages go back to the queue
+AUTOSCALE_DRAIN_TIMEOUT_S: float = 120.0
+# crashed workers are restarted after a backoff that doubles with each crash, up to the maximum.
+# a worker that ran for WORKER_STABLE_AFTER_S before crashing restarts after the base backoff again
+WORKER_RESTART_BACKOFF_S: float = 1.0
+WORKER_RESTART_BACKOFF_MAX_S: float = 60.0
+WORKER_STABLE_AFTER_S: float = 60.0
 
 # to enable localhost while debugging, set to True
 #LOCAL_MODE: bool = True
@@ -0,0 +1,285 @@
+"""
+Autoscaling supervisor for the queue consumer processes: ML pipeline, result ingest and train request workers.
+
+NUM_ML_PIPELINES, NUM_RESULT_WORKERS and NUM_TRAIN_WORKERS start a fixed number of workers, which sit idle most of
+the time and fall behind when uploads come in bursts (e.g. around exams).  With AUTOSCALE_WORKERS, `main()` of
+image_to_equation_interface and ingest run their workers under this supervisor instead.  Every
+AUTOSCALE_POLL_INTERVAL_S it reads the depth of each pool's queue and how busy the pool's consumers were since
+the last poll (see `ConsumerStats`), then:
+
+- scales up when the backlog would take longer than AUTOSCALE_TARGET_DRAIN_S to drain at the measured rate,
+  straight to the number of workers that would drain it in time, within the pool's bounds.
+- drains one worker at a time once the queue has been empty, and the consumers under-used,
+  for AUTOSCALE_SCALE_DOWN_IDLE_S.  The worker's stop event is set, it finishes the message (or batch) in hand
+  and exits, anything it had prefetched goes back to the queue when its connection closes.
+- restarts crashed workers, with a backoff that doubles while they keep crashing soon after starting.
+
+usage:
+    python -m mathclips.services.autoscale [--pools ml_pipeline result train_request]
+"""
+from __future__ import annotations
+
+import argparse
+import math
+import multiprocessing
+import multiprocessing.synchronize
+import threading
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Sequence, Tuple
+
+from mathclips.services import (AUTOSCALE_POLL_INTERVAL_S, AUTOSCALE_TARGET_DRAIN_S, AUTOSCALE_SCALE_UP_COOLDOWN_S,
+                                AUTOSCALE_SCALE_DOWN_IDLE_S, AUTOSCALE_SCALE_DOWN_UTILIZATION,
+                                AUTOSCALE_DRAIN_TIMEOUT_S, WORKER_RESTART_BACKOFF_S, WORKER_RESTART_BACKOFF_MAX_S,
+                                WORKER_STABLE_AFTER_S)
+from mathclips.services.logger import logger
+from mathclips.services.transport import ConsumerStats, MessageTransport, create_transport
+
+@dataclass
+class WorkerPoolSpec:
+    name: str
+    # the backlog of the pool is the total of these queues
+    queue_names: Sequence[str]
+    # the consumer loop run by each worker process, called with `stop_event` and `consumer_stats` keyword arguments
+    target: Callable
+    min_workers: int
+    max_workers: int
+    # extra keyword arguments for the worker in a slot (0 to max_workers - 1), e.g. its CPU budget
+    slot_kwargs: Callable[[int], dict] = lambda slot: {}
+
+@dataclass
+class ManagedWorker:
+    slot: int
+    process: multiprocessing.Process
+    stop_event: multiprocessing.synchronize.Event
+    started_at: float
+    draining_since: float|None = None
+
+@dataclass
+class PoolLoad:
+    backlog: int
+    # fraction of the time since the last poll the running workers spent handling messages
+    utilization: float
+    # messages one worker handles per second while busy, None until the pool has handled any
+    service_rate: float|None
+
+    def drain_time_s(self, num_workers: int) -> float:
+        if self.backlog == 0:
+            return 0.0
+        if not self.service_rate or num_workers == 0:
+            return math.inf
+        return self.backlog / (self.service_rate * num_workers)
+
+class WorkerPool:
+    """
+    The worker processes of one queue.  Each worker has a slot, a crashed worker keeps its slot
+    (and counts towards the size of the pool) until it is restarted.
+    """
+
+    def __init__(self, spec: WorkerPoolSpec):
+        self.spec = spec
+        self.consumer_stats = ConsumerStats()
+        self.workers: Dict[int, ManagedWorker] = {}
+        self.draining: List[ManagedWorker] = []
+        # slot -> monotonic time its crashed worker is restarted at
+        self.restart_at: Dict[int, float] = {}
+        self.crash_counts: Dict[int, int] = defaultdict(int)
+        self.service_rate: float|None = None
+        self.idle_since: float|None = None
+        self.last_scale_up: float = -math.inf
+        self._last_snapshot: Tuple[int, float] = self.consumer_stats.snapshot()
+        self._last_measured: float = time.monotonic()
+
+    @property
+    def size(self) -> int:
+        return len(self.workers) + len(self.restart_at)
+
+    def _free_slot(self) -> int:
+        return min(set(range(self.spec.max_workers)) - set(self.workers) - set(self.restart_at))
+
+    def _spawn(self, slot: int):
+        stop_event = multiprocessing.Event()
+        process = multiprocessing.Process(
+            target = self.spec.target, name = f"{self.spec.name}_worker_{slot}",
+            kwargs = dict(stop_event = stop_event, consumer_stats = self.consumer_stats,
+                          **self.spec.slot_kwargs(slot)))
+        process.start()
+        self.workers[slot] = ManagedWorker(slot = slot, process = process, stop_event = stop_event,
+                                           started_at = time.monotonic())
+
+    def _drain(self, slot: int, now: float):
+        worker = self.workers.pop(slot)
+        worker.stop_event.set()
+        worker.draining_since = now
+        self.draining.append(worker)
+
+    def reap(self, now: float):
+        """
+        Schedule restarts for crashed workers, restart those that are due and clean up drained ones.
+        """
+        for slot, worker in list(self.workers.items()):
+            if worker.process.is_alive():
+                continue
+            worker.process.join()
+            del self.workers[slot]
+            if now - worker.started_at >= WORKER_STABLE_AFTER_S:
+                self.crash_counts[slot] = 0
+            self.crash_counts[slot] += 1
+            backoff_s = min(WORKER_RESTART_BACKOFF_MAX_S,
+                            WORKER_RESTART_BACKOFF_S * 2 ** (self.crash_counts[slot] - 1))
+            self.restart_at[slot] = now + backoff_s
+            logger.error(f"{self.spec.name} worker {slot} exited with code {worker.process.exitcode} after "
+                         f"{now - worker.started_at:.1f}s, restarting it in {backoff_s:.1f}s")
+
+        for slot, restart_time in list(self.restart_at.items()):
+            if restart_time <= now:
+                del self.restart_at[slot]
+                self._spawn(slot)
+
+        for worker in list(self.draining):
+            if worker.process.is_alive() and now - worker.draining_since > AUTOSCALE_DRAIN_TIMEOUT_S:
+                logger.warning(f"{self.spec.name} worker {worker.slot} did not drain in "
+                               f"{AUTOSCALE_DRAIN_TIMEOUT_S:.0f}s, terminating it")
+                worker.process.terminate()
+            if not worker.process.is_alive():
+                worker.process.join()
+                self.draining.remove(worker)
+
+    def measure(self, transport: MessageTransport, now: float) -> PoolLoad:
+        num_handled, busy_s = self.consumer_stats.snapshot()
+        handled_delta, busy_delta = num_handled - self._last_snapshot[0], busy_s - self._last_snapshot[1]
+        elapsed_s = max(now - self._last_measured, 1e-9)
+        self._last_snapshot, self._last_measured = (num_handled, busy_s), now
+        if handled_delta > 0 and busy_delta > 0:
+            # the last measured rate is kept through quiet polls
+            self.service_rate = handled_delta / busy_delta
+        utilization = min(1.0, busy_delta / (elapsed_s * max(1, len(self.workers))))
+        backlog = sum(transport.queue_stats(queue_name).message_count for queue_name in self.spec.queue_names)
+        return PoolLoad(backlog = backlog, utilization = utilization, service_rate = self.service_rate)
+
+    def desired_size(self, load: PoolLoad, now: float) -> int:
+        size = self.size
+        drain_time_s = load.drain_time_s(len(self.workers))
+        if load.backlog > 0 and drain_time_s > AUTOSCALE_TARGET_DRAIN_S:
+            self.idle_since = None
+            if now - self.last_scale_up < AUTOSCALE_SCALE_UP_COOLDOWN_S:
+                return size
+            if load.service_rate:
+                desired = math.ceil(load.backlog / (load.service_rate * AUTOSCALE_TARGET_DRAIN_S))
+            else:
+                # nothing handled yet (e.g. the workers are still loading the model), one worker at a time
+                desired = size + 1
+            return min(self.spec.max_workers, max(self.spec.min_workers, size, desired))
+
+        if load.backlog == 0 and load.utilization < AUTOSCALE_SCALE_DOWN_UTILIZATION:
+            if self.idle_since is None:
+                self.idle_since = now
+            if now - self.idle_since >= AUTOSCALE_SCALE_DOWN_IDLE_S and size > self.spec.min_workers:
+                # the next worker is only drained after another idle period
+                self.idle_since = now
+                return size - 1
+        else:
+            self.idle_since = None
+        return max(self.spec.min_workers, min(self.spec.max_workers, size))
+
+    def scale_to(self, desired: int, load: PoolLoad, now: float):
+        size = self.size
+        if desired > size:
+            service_rate = "rate not measured yet" if not load.service_rate else \
+                f"{load.service_rate:.2f} msg/s per worker"
+            logger.info(f"Scaling {self.spec.name} up {size} -> {desired} workers: backlog {load.backlog} messages, "
+                        f"utilization {load.utilization:.0%}, {service_rate}, "
+                        f"estimated drain time {load.drain_time_s(size):.0f}s with {size} workers, "
+                        f"{load.drain_time_s(desired):.0f}s with {desired}")
+            for _ in range(desired - size):
+                self._spawn(self._free_slot())
+            self.last_scale_up = now
+        elif desired < size:
+            logger.info(f"Scaling {self.spec.name} down {size} -> {desired} workers: queue empty, "
+                        f"utilization {load.utilization:.0%}")
+            for _ in range(size - desired):
+                # a crashed worker waiting for its restart goes first
+                if self.restart_at:
+                    del self.restart_at[max(self.restart_at)]
+                else:
+                    self._drain(max(self.workers), now)
+
+    def start(self):
+        for _ in range(self.spec.min_workers):
+            self._spawn(self._free_slot())
+
+    def stop(self, timeout_s: float = AUTOSCALE_DRAIN_TIMEOUT_S):
+        now = time.monotonic()
+        self.restart_at.clear()
+        for slot in list(self.workers):
+            self._drain(slot, now)
+        deadline = now + timeout_s
+        for worker in self.draining:
+            worker.process.join(timeout = max(0.0, deadline - time.monotonic()))
+            if worker.process.is_alive():
+                worker.process.terminate()
+                worker.process.join()
+        self.draining.clear()
+
+class AutoscalingSupervisor:
+
+    def __init__(self, pool_specs: List[WorkerPoolSpec], transport: MessageTransport|None = None,
+                 poll_interval_s: float = AUTOSCALE_POLL_INTERVAL_S):
+        self.pools = [WorkerPool(spec) for spec in pool_specs]
+        self.transport = transport
+        self.poll_interval_s = poll_interval_s
+
+    def step(self, now: float|None = None):
+        if now is None:
+            now = time.monotonic()
+        for pool in self.pools:
+            pool.reap(now)
+            load = pool.measure(self.transport, now)
+            pool.scale_to(pool.desired_size(load, now), load, now)
+
+    def run(self, stop_event: threading.Event|None = None):
+        if self.transport is None:
+            # only used for queue depths, the workers open their own connections
+            self.transport = create_transport()
+        if stop_event is None:
+            stop_event = threading.Event()
+        for pool in self.pools:
+            pool.start()
+            logger.info(f"Supervising {pool.spec.name} workers on {', '.join(pool.spec.queue_names)}, "
+                        f"{pool.spec.min_workers} to {pool.spec.max_workers}")
+        try:
+            while not stop_event.wait(self.poll_interval_s):
+                self.step()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for pool in self.pools:
+                pool.stop()
+            self.transport.close()
+
+POOL_NAMES = ("ml_pipeline", "result", "train_request")
+
+def pool_spec(pool_name: str) -> WorkerPoolSpec:
+    # imported on demand, the service modules connect to the databases on import
+    if pool_name == "ml_pipeline":
+        from mathclips.services.image_to_equation_interface import ml_worker_pool_spec
+        return ml_worker_pool_spec()
+    if pool_name == "result":
+        from mathclips.services.ingest import result_worker_pool_spec
+        return result_worker_pool_spec()
+    if pool_name == "train_request":
+        from mathclips.services.ingest import train_request_worker_pool_spec
+        return train_request_worker_pool_spec()
+    raise ValueError(f"Unknown worker pool: {pool_name}")
+
+def main():
+    parser = argparse.ArgumentParser(description = "Run queue consumer pools that scale with their queue depth")
+    parser.add_argument("--pools", nargs = "+", choices = POOL_NAMES, default = list(POOL_NAMES))
+    args = parser.parse_args()
+    from mathclips.services.mongodb import ensure_all_indexes
+    ensure_all_indexes()
+    AutoscalingSupervisor([pool_spec(pool_name) for pool_name in args.pools]).run()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+"""
+Import a directory, zip or tar archive of equation images in bulk.
+
+Images are streamed out of the source one at a time, stored through `MathSymbolImageDatabase` by a pool of threads
+and published to the bulk ML pipeline lane in batches, so a large import neither holds the archive in memory
+nor starves interactive uploads.  The equation name of each image is its file name without the suffix.
+
+A labels file maps images (by path within the source, or by file name) to their latex, as a JSON object,
+a CSV file of `path,latex` rows or tab separated `path<TAB>latex` lines.  Labelled images are stored with
+`needs_train` and marked as training candidates, they are picked up by the next train request's batch check.
+
+usage:
+    python -m mathclips.services.bulk_import images/ --author "Jane Doe" [--section "Chapter 3"]
+    python -m mathclips.services.bulk_import scans.zip --labels labels.csv --equation-type handwritten
+    python -m mathclips.services.bulk_import export.tar.gz --labels labels.json --skip-ocr
+"""
+from __future__ import annotations
+
+import argparse
+import csv
+import io
+import json
+import tarfile
+import time
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from pathlib import Path, PurePosixPath
+from typing import Dict, Iterator, List, Tuple
+
+from bson import ObjectId
+from PIL import Image
+
+from mathclips.proto.pb_py_classes.image_pb2 import Image as ProtoImage
+from mathclips.proto.pb_py_classes.uint_packed_bytes_pb2 import UintPackedBytes
+from mathclips.services import IngestQueueNames
+from mathclips.services.logger import logger
+from mathclips.services.mongodb import MathSymbolImageDatabase, TrainingCandidateDatabase, ensure_all_indexes
+from mathclips.services.transport import MessageTransport, create_transport
+from mathclips.services.util import object_id_from_packed
+
+IMAGE_SUFFIXES = (".png", ".jpg", ".jpeg", ".bmp", ".gif", ".tif", ".tiff", ".webp")
+EQUATION_TYPES = dict(digital = ProtoImage.EquationType.DIGITAL, handwritten = ProtoImage.EquationType.HANDWRITTEN)
+
+@dataclass
+class ImportItem:
+    # path within the source, posix style
+    name: str
+    data: bytes
+
+@dataclass
+class ImportProgress:
+    num_stored: int = 0
+    num_published: int = 0
+    num_labelled: int = 0
+    num_failed: int = 0
+    num_bytes: int = 0
+    start_time: float = 0.0
+
+    def report(self) -> str:
+        elapsed_s = max(time.monotonic() - self.start_time, 1e-9)
+        return (f"{self.num_stored} stored, {self.num_published} published, {self.num_labelled} labelled, "
+                f"{self.num_failed} failed in {elapsed_s:.1f}s: {self.num_stored / elapsed_s:.1f} images/s, "
+                f"{self.num_bytes / elapsed_s / 1e6:.2f} MB/s")
+
+def is_image_name(name: str) -> bool:
+    return PurePosixPath(name).suffix.lower() in IMAGE_SUFFIXES and not PurePosixPath(name).name.startswith(".")
+
+def iterate_source(source: Path) -> Iterator[ImportItem]:
+    """
+    The images of a directory (recursively), zip or tar (optionally compressed) archive, read one at a time.
+    """
+    source = Path(source)
+    if source.is_dir():
+        for path in sorted(source.rglob("*")):
+            if path.is_file() and is_image_name(path.name):
+                yield ImportItem(name = path.relative_to(source).as_posix(), data = path.read_bytes())
+    elif zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as archive:
+            for member in archive.infolist():
+                if not member.is_dir() and is_image_name(member.filename):
+                    yield ImportItem(name = member.filename, data = archive.read(member))
+    elif tarfile.is_tarfile(source):
+        # stream mode reads the members in archive order without seeking, compressed tars are not unpacked first
+        with tarfile.open(source, mode = "r|*") as archive:
+            for member in archive:
+                if member.isfile() and is_image_name(member.name):
+                    yield ImportItem(name = member.name, data = archive.extractfile(member).read())
+    else:
+        raise ValueError(f"Not a directory, zip or tar archive: {source}")
+
+def load_labels(labels_path: Path) -> Dict[str, str]:
+    """
+    Image path -> latex label, from a JSON object, a `path,latex` CSV file or tab separated `path<TAB>latex` lines.
+    """
+    labels_path = Path(labels_path)
+    with labels_path.open(newline = "", encoding = "utf-8") as labels_file:
+        if labels_path.suffix.lower() == ".json":
+            return {str(name): str(label) for name, label in json.load(labels_file).items()}
+        if labels_path.suffix.lower() == ".csv":
+            rows = csv.reader(labels_file)
+        else:
+            rows = (line.rstrip("\r\n").split("\t", 1) for line in labels_file if line.strip())
+        return {row[0].strip(): row[1] for row in rows if len(row) >= 2 and row[0].strip()}
+
+def label_for(labels: Dict[str, str], name: str) -> str|None:
+    label = labels.get(name)
+    if label is None:
+        label = labels.get(PurePosixPath(name).name)
+    return label if label else None
+
+def store_item(image_db: MathSymbolImageDatabase, item: ImportItem, equation_type: ProtoImage.EquationType,
+               author_name: str, section: str, label: str|None) -> UintPackedBytes:
+    image = Image.open(io.BytesIO(item.data))
+    image.load()
+    return image_db.store_image(image = image, image_basename = PurePosixPath(item.name).name,
+                                equation_type = equation_type, needs_train = label is not None,
+                                equation_name = PurePosixPath(item.name).stem, equation_section = section,
+                                author_name = author_name, train_label = label)
+
+def bulk_import(source: Path, image_db: MathSymbolImageDatabase, transport: MessageTransport|None,
+                author_name: str, section: str, equation_type: ProtoImage.EquationType,
+                labels: Dict[str, str]|None = None, num_workers: int = 8, publish_batch_size: int = 100,
+                progress_interval_s: float = 5.0) -> ImportProgress:
+    """
+    Store every image of `source` and publish them to the bulk ML pipeline lane, none are published without
+    a `transport`.  Images that cannot be decoded or stored are logged and counted, the import carries on.
+    """
+    labels = labels or {}
+    candidate_db = TrainingCandidateDatabase(db = image_db.db)
+    progress = ImportProgress(start_time = time.monotonic())
+    pending_messages: List[ProtoImage] = []
+    pending_labels: Dict[ObjectId, str] = {}
+    last_report: float = progress.start_time
+
+    def flush():
+        if pending_messages and transport is not None:
+            progress.num_published += transport.publish_many(pending_messages,
+                                                             IngestQueueNames.ML_PIPELINE_BULK_QUEUE)
+        pending_messages.clear()
+        if pending_labels:
+            candidate_db.bulk_mark_candidates(pending_labels)
+            progress.num_labelled += len(pending_labels)
+        pending_labels.clear()
+
+    def collect(future: Future, item_name: str, num_bytes: int, label: str|None):
+        try:
+            file_id: UintPackedBytes = future.result()
+        except Exception as ex:
+            progress.num_failed += 1
+            logger.error(f"Could not import {item_name}: {ex}")
+            return
+        progress.num_stored += 1
+        progress.num_bytes += num_bytes
+        pending_messages.append(ProtoImage(uid = file_id, equationType = equation_type,
+                                           equation_name = PurePosixPath(item_name).stem,
+                                           author = author_name, parent_section = section))
+        if label is not None:
+            pending_labels[object_id_from_packed(file_id)] = label
+        if len(pending_messages) >= publish_batch_size:
+            flush()
+
+    in_flight: Dict[Future, Tuple[str, int, str|None]] = {}
+    with ThreadPoolExecutor(max_workers = num_workers, thread_name_prefix = "bulk_import") as executor:
+        for item in iterate_source(source):
+            label = label_for(labels, item.name)
+            future = executor.submit(store_item, image_db, item, equation_type, author_name, section, label)
+            in_flight[future] = (item.name, len(item.data), label)
+            # a few images per thread are read ahead, the rest of the source stays unread
+            while len(in_flight) >= 2 * num_workers:
+                done, _ = wait(in_flight, return_when = FIRST_COMPLETED)
+                for done_future in done:
+                    collect(done_future, *in_flight.pop(done_future))
+            if time.monotonic() - last_report >= progress_interval_s:
+                last_report = time.monotonic()
+                logger.info(f"Importing {source}: {progress.report()}")
+        for done_future in list(in_flight):
+            collect(done_future, *in_flight.pop(done_future))
+    flush()
+    logger.info(f"Imported {source}: {progress.report()}")
+    return progress
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("source", type = Path, help = "directory, zip or tar archive of images")
+    parser.add_argument("--author", required = True, help = "author name stored with every image")
+    parser.add_argument("--section", default = None, help = "equation section, the name of the source by default")
+    parser.add_argument("--equation-type", choices = list(EQUATION_TYPES), default = "digital")
+    parser.add_argument("--labels", type = Path, default = None, help = "JSON, CSV or tab separated latex labels")
+    parser.add_argument("--workers", type = int, default = 8, help = "images stored concurrently")
+    parser.add_argument("--publish-batch-size", type = int, default = 100)
+    parser.add_argument("--skip-ocr", action = "store_true", help = "store the images without publishing them")
+    args = parser.parse_args()
+
+    section: str = args.section or args.source.name.split(".")[0]
+    labels = load_labels(args.labels) if args.labels is not None else {}
+    image_db = MathSymbolImageDatabase()
+    ensure_all_indexes(image_db.db)
+    transport = None if args.skip_ocr else create_transport()
+    try:
+        progress = bulk_import(args.source, image_db, transport, author_name = args.author,
+                               section = section, equation_type = EQUATION_TYPES[args.equation_type],
+                               labels = labels, num_workers = args.workers,
+                               publish_batch_size = args.publish_batch_size)
+    finally:
+        if transport is not None:
+            transport.close()
+    print(progress.report())
+
+if __name__ == "__main__":
+    main()
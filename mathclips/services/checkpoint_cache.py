@@ -0,0 +1,106 @@
+"""
+Node local, content addressed cache of promoted OCR checkpoints.
+
+ML workers used to only see new weights when they shared a filesystem with the training process.
+Instead they look up the newest checkpoint record in mongo and fetch it through this cache,
+keyed on the SHA-256 stored with the record.  The first worker process on a node to need a checkpoint
+downloads it while holding a per-checkpoint fcntl lock, the others wait on the lock and then find it in place,
+so rolling out new weights costs one transfer per node.
+"""
+from __future__ import annotations
+
+from pathlib import Path
+from typing import Callable, List, Tuple
+
+import pix2tex
+
+from mathclips.services import CHECKPOINT_CACHE_DIR, CHECKPOINT_CACHE_KEEP
+from mathclips.services.logger import logger
+from mathclips.services.mongodb import MLCheckpointDatabase
+from mathclips.services.util import atomic_copy, atomic_write_text, file_lock
+
+pix2tex_root = Path(pix2tex.__path__[0]).resolve()
+
+class CheckpointCache:
+
+    # LatexOCR loads the resizer from the directory the checkpoint is in
+    resizer_filename: str = "image_resizer.pth"
+
+    def __init__(self, cache_dir: Path = CHECKPOINT_CACHE_DIR, keep: int = CHECKPOINT_CACHE_KEEP):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents = True, exist_ok = True)
+        self.keep = keep
+
+    @staticmethod
+    def cache_key(checkpoint_record: dict) -> str:
+        # checkpoints stored before digests were recorded are keyed on their GridFS id instead
+        return checkpoint_record.get("sha256") or str(checkpoint_record["file_storage_id"])
+
+    def weights_path(self, checkpoint_record: dict) -> Path:
+        return self.cache_dir.joinpath(f"{CheckpointCache.cache_key(checkpoint_record)}.pth")
+
+    def config_path(self, checkpoint_record: dict) -> Path:
+        return self.cache_dir.joinpath(f"{CheckpointCache.cache_key(checkpoint_record)}.config.yaml")
+
+    @property
+    def resizer_path(self) -> Path:
+        return self.cache_dir.joinpath(CheckpointCache.resizer_filename)
+
+    def _ensure_resizer(self):
+        seed_resizer_path = pix2tex_root.joinpath("model", "checkpoints", CheckpointCache.resizer_filename)
+        if not self.resizer_path.exists() and seed_resizer_path.exists():
+            atomic_copy(seed_resizer_path, self.resizer_path)
+
+    def fetch(self, checkpoint_db: MLCheckpointDatabase, checkpoint_record: dict) -> Tuple[Path, Path|None]:
+        """
+        Local paths of the checkpoint weights and its config (None for records stored without one),
+        downloading them first if no process on this node has yet.
+        """
+        weights_path = self.weights_path(checkpoint_record)
+        config_path = self.config_path(checkpoint_record) if checkpoint_record.get("model_config_yaml") else None
+        if weights_path.exists() and (config_path is None or config_path.exists()) and self.resizer_path.exists():
+            return weights_path, config_path
+
+        lock_path = self.cache_dir.joinpath(f".{CheckpointCache.cache_key(checkpoint_record)}.lock")
+        with file_lock(lock_path):
+            # whoever held the lock before us may have fetched it already
+            if not weights_path.exists():
+                logger.info(f"Fetching checkpoint {checkpoint_record['_id']} into {self.cache_dir}")
+                checkpoint_db.download_checkpoint(checkpoint_record["file_storage_id"], weights_path)
+            if config_path is not None and not config_path.exists():
+                atomic_write_text(checkpoint_record["model_config_yaml"], config_path)
+            self._ensure_resizer()
+        self.prune()
+        return weights_path, config_path
+
+    def derived_path(self, checkpoint_record: dict, suffix: str, build: Callable[[Path], None]) -> Path:
+        """
+        A file derived from a fetched checkpoint (e.g. its quantized copy), built by `build(out_path)`
+        once per node, under the same lock as the download.  Pruned together with its checkpoint.
+        """
+        derived_path = self.cache_dir.joinpath(f"{CheckpointCache.cache_key(checkpoint_record)}.{suffix}")
+        if derived_path.exists():
+            return derived_path
+        with file_lock(self.cache_dir.joinpath(f".{CheckpointCache.cache_key(checkpoint_record)}.lock")):
+            if not derived_path.exists():
+                build(derived_path)
+        return derived_path
+
+    def prune(self) -> List[Path]:
+        """
+        Remove all but the `keep` most recently fetched checkpoints.  Safe while a worker still loads an older one,
+        the open file outlives its directory entry.
+        """
+        removed: List[Path] = []
+        # worker processes prune after every fetch, one at a time
+        with file_lock(self.cache_dir.joinpath(".prune.lock")):
+            checkpoints = sorted(self.cache_dir.glob("*.pth"), key = lambda path: path.stat().st_mtime, reverse = True)
+            # derived files are named <cache key>.<suffix>.pth, only the plain <cache key>.pth is a checkpoint
+            checkpoints = [path for path in checkpoints
+                           if path.name != CheckpointCache.resizer_filename and "." not in path.stem]
+            for weights_path in checkpoints[self.keep:]:
+                for derived_path in self.cache_dir.glob(f"{weights_path.stem}.*"):
+                    derived_path.unlink(missing_ok = True)
+                weights_path.with_name(f".{weights_path.stem}.lock").unlink(missing_ok = True)
+                removed.append(weights_path)
+        return removed
@@ -0,0 +1,78 @@
+"""
+CPU thread budgeting for the ML worker processes on one machine.
+
+Left alone, torch gives every worker process as many intra-op threads as the machine has cores,
+so with a few workers per box the threads oversubscribe the CPU and adding workers lowers throughput.
+The supervisor (`image_to_equation_interface.main`) splits the cores available to it between its workers,
+each worker caps its torch / OpenMP / MKL thread pools to its share and can be pinned to its own cores.
+"""
+from __future__ import annotations
+
+import os
+from dataclasses import dataclass, field
+from typing import List
+
+from mathclips.services.logger import logger
+
+# read by OpenMP, MKL and OpenBLAS when their thread pools start, set in case they have not started yet
+THREAD_COUNT_ENVIRONMENT_VARIABLES = ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS")
+
+@dataclass
+class CPUBudget:
+    num_threads: int
+    # cores the worker is pinned to, empty to leave the affinity alone
+    cores: List[int] = field(default_factory = list)
+
+def available_cores() -> List[int]:
+    """
+    The cores this process may run on, which respects container cpusets unlike os.cpu_count().
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+def plan_cpu_budgets(num_workers: int, threads_per_worker: int|None = None, pin: bool = False,
+                     cores: List[int]|None = None) -> List[CPUBudget]:
+    """
+    Split `cores` (all available cores by default) between `num_workers` workers.
+
+    Without `threads_per_worker` each worker gets an equal share, at least one thread.
+    Pinned workers get contiguous, disjoint runs of cores for as long as there are enough cores,
+    past that the runs wrap around and are shared.
+    """
+    if cores is None:
+        cores = available_cores()
+    num_workers = max(1, num_workers)
+    if threads_per_worker is None:
+        threads_per_worker = max(1, len(cores) // num_workers)
+    budgets: List[CPUBudget] = []
+    for worker_index in range(num_workers):
+        worker_cores: List[int] = []
+        if pin:
+            start = worker_index * threads_per_worker
+            worker_cores = sorted({cores[(start + i) % len(cores)] for i in range(threads_per_worker)})
+        budgets.append(CPUBudget(num_threads = threads_per_worker, cores = worker_cores))
+    if num_workers * threads_per_worker > len(cores):
+        logger.warning(f"{num_workers} workers x {threads_per_worker} threads oversubscribe {len(cores)} cores")
+    return budgets
+
+def apply_cpu_budget(budget: CPUBudget):
+    """
+    Cap the thread pools of the calling process, and pin it, according to `budget`.
+    Call it at the start of a worker process, before the model runs anything.
+    """
+    import torch
+
+    for variable in THREAD_COUNT_ENVIRONMENT_VARIABLES:
+        os.environ[variable] = str(budget.num_threads)
+    torch.set_num_threads(budget.num_threads)
+    try:
+        # inter-op parallelism is not used by the OCR model, one thread avoids another oversized pool
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # can only be set before the first parallel work in the process, e.g. not after forking a busy parent
+        pass
+    if budget.cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, budget.cores)
+    logger.info(f"Process {os.getpid()} limited to {budget.num_threads} threads"
+                + (f", pinned to cores {budget.cores}" if budget.cores else ""))
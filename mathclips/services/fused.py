@@ -0,0 +1,69 @@
+"""
+Single process ("fused") deployment of the backend services.
+
+The ML pipeline worker, the result listener, the train request listener and a training job worker run as threads
+of one process,
+connected by the in-process transport, so no RabbitMQ broker is needed and messages are handed over by reference.
+Meant for small deployments, local development and CI throughput tests.
+
+usage:
+    python -m mathclips.services.fused
+"""
+from __future__ import annotations
+
+import threading
+from typing import List
+
+from mathclips.services.logger import logger
+from mathclips.services.transport import MessageTransport, get_in_process_transport
+from mathclips.services.mongodb import ensure_all_indexes
+from mathclips.services.image_to_equation_interface import ml_worker
+from mathclips.services.notebook_yaml import import_notebook_if_empty
+from mathclips.services.ingest import (image_db, notebook_db, default_result_config_filename, equation_result_listener,
+                                       train_message_listener)
+from mathclips.services.training_jobs import training_job_worker
+
+_fused_threads: List[threading.Thread] = []
+_fused_threads_lock = threading.Lock()
+fused_stop_event = threading.Event()
+
+def start_fused_services(transport: MessageTransport|None = None,
+                         stop_event: threading.Event = fused_stop_event) -> List[threading.Thread]:
+    """
+    Start one thread per backend service, does nothing if they are already running in this process.
+    """
+    if transport is None:
+        transport = get_in_process_transport()
+    with _fused_threads_lock:
+        if not _fused_threads:
+            ensure_all_indexes(image_db.db)
+            import_notebook_if_empty(notebook_db, default_result_config_filename)
+            for target, name in ((ml_worker, "ml_pipeline_worker"),
+                                 (equation_result_listener, "equation_result_worker"),
+                                 (train_message_listener, "train_message_worker"),
+                                 (training_job_worker, "training_job_worker")):
+                worker_thread = threading.Thread(target = target, name = name, daemon = True,
+                                                 kwargs = dict(transport = transport, stop_event = stop_event))
+                worker_thread.start()
+                _fused_threads.append(worker_thread)
+            logger.info("Started fused mathclips services on the in-process transport")
+        return list(_fused_threads)
+
+def stop_fused_services(timeout: float|None = None):
+    fused_stop_event.set()
+    with _fused_threads_lock:
+        for worker_thread in _fused_threads:
+            worker_thread.join(timeout = timeout)
+        _fused_threads.clear()
+    fused_stop_event.clear()
+
+def main():
+    worker_threads = start_fused_services()
+    try:
+        for worker_thread in worker_threads:
+            worker_thread.join()
+    except KeyboardInterrupt:
+        stop_fused_services()
+
+if __name__ == "__main__":
+    main()
@@ -1,34 +1,70 @@
 from __future__ import annotations
 
-from typing import TypeAlias
+from typing import List, Dict, Tuple, Callable
+from dataclasses import dataclass
+from collections import defaultdict
 import multiprocessing
+import threading
+import time
 from pathlib import Path
 
 from PIL import Image
+import numpy as np
+import torch
 import pix2tex
-from pix2tex.cli import LatexOCR
-import pika
-from pika.channel import Channel
-from pika.spec import BasicProperties
-from pika.spec import Basic
+from pix2tex.cli import LatexOCR, minmax_size
+from pix2tex.utils import pad, post_process, token2str
+from pix2tex.dataset.transforms import test_transform
 from munch import Munch
+from bson.objectid import ObjectId
+import yaml
 
-from mathclips.services import LOCAL_MODE
+from mathclips.services import (CHECKPOINT_POLL_INTERVAL_S, ML_BATCH_SIZE, ML_BATCH_WAIT_MS,
+                                OCR_CACHE_SIZE, CHECKPOINT_CACHE_DIR, ML_INFERENCE_BACKEND, InferenceBackend,
+                                ML_PIPELINE_LANE_WEIGHTS)
 from mathclips.services.logger import logger
-from mathclips.services.mongodb import (MathSymbolImageDatabase, MathSymbolResultDatabase, MLCheckpointDatabase)
-from mathclips.services.rmq import get_rmq_connection_parameters
+from mathclips.services.mongodb import (MathSymbolImageDatabase, MathSymbolResultDatabase, MLCheckpointDatabase,
+                                        OCRResultCacheDatabase, ensure_all_indexes)
+from mathclips.services.util import pixel_content_hash, LRUCache
+from mathclips.services.checkpoint_cache import CheckpointCache
+from mathclips.services.quantization import quantize_ocr_model, save_quantized_weights
+from mathclips.services.cpu_budget import CPUBudget, plan_cpu_budgets, apply_cpu_budget
+from mathclips.services.transport import (MessageTransport, Delivery, ConsumerStats, QueueLanes, create_transport,
+                                          consume, consume_batches)
+from mathclips.services.autoscale import AutoscalingSupervisor, WorkerPoolSpec
 from mathclips.services import IngestQueueNames
 from mathclips.proto.pb_py_classes.image_pb2 import Image as ImageProto
 from mathclips.proto.pb_py_classes.uint_packed_bytes_pb2 import UintPackedBytes
 from mathclips.proto.pb_py_classes.ocr_result_pb2 import OCR_Result
 
-DeliveryProperties: TypeAlias = Basic.Deliver
 # flip to true when debugging during development
 pix2tex_root = Path(pix2tex.__path__[0]).resolve()
 
+# interactive uploads ahead of bulk imports, so a drawn equation does not wait behind an import's backlog
+ml_pipeline_lanes = QueueLanes(
+    queue_names = (IngestQueueNames.ML_PIPELINE_QUEUE, IngestQueueNames.ML_PIPELINE_BULK_QUEUE),
+    weights = ML_PIPELINE_LANE_WEIGHTS)
+
+@dataclass(frozen = True)
+class ModelVersion:
+    """
+    Identifies the weights a resident model was loaded from.
+    Two versions comparing unequal means a training run has promoted new weights.
+    """
+    weights_path: Path
+    weights_mtime_ns: int|None = None
+    weights_size: int|None = None
+    checkpoint_record_id: ObjectId|None = None
+
+    @property
+    def checkpoint_id(self) -> str:
+        return str(self.checkpoint_record_id) if self.checkpoint_record_id is not None else "pretrained"
+
 class MLPipelineInterface:
     """
-    Making this a class in case we need to re-spawn the LatexOCR with updated weights
+    Each ML worker process keeps one instance of this class (and therefore one resident LatexOCR model)
+    for its lifetime.  Between messages the worker calls `refresh_model`, which swaps in a freshly
+    loaded model if a training run has promoted new weights.
 
     Mongo client Interfaces can be shared across class instances, and only need to be loaded once.
     """
@@ -37,6 +73,9 @@ class MLPipelineInterface:
     image_db = MathSymbolImageDatabase()
     result_db = MathSymbolResultDatabase(image_db.db)
     checkpoint_db = MLCheckpointDatabase(image_db.db)
+    ocr_cache_db = OCRResultCacheDatabase(image_db.db)
+    # shared by the worker processes of a node, see mathclips.services.checkpoint_cache
+    checkpoint_cache: CheckpointCache|None = CheckpointCache(CHECKPOINT_CACHE_DIR) if CHECKPOINT_CACHE_DIR else None
 
     # this name is important to config settings other than the weights filename, so we omitt the extension
     # until the extension is needed.
@@ -53,6 +92,11 @@ class MLPipelineInterface:
         return mathclips_weights_path if mathclips_weights_path.exists() \
             else package_checkpoints_dir.joinpath("weights.pth")
 
+    @staticmethod
+    def promoted_checkpoint_path(weights_path: Path) -> Path:
+        # names the checkpoint record of the promoted weights, rewritten last by a training run's promotion
+        return weights_path.with_name(f"{weights_path.stem}.checkpoint.yaml")
+
     @staticmethod
     def get_current_config_path() -> Path:
         if MLPipelineInterface.mathclips_config_path.exists():
@@ -60,39 +104,183 @@ class MLPipelineInterface:
         config_dir = pix2tex_root.joinpath("model").joinpath("settings")
         return config_dir.joinpath("config.yaml")
 
-    def __init__(self):
+    @staticmethod
+    def get_current_model_version() -> ModelVersion:
         """
-        Upon Initializing this interface, the model will reload the weights file.
-        After a training pipeline, the weights will change, so constructing a new interface
-        will automatically load the latest model weights for you.
+        Cheap to evaluate: one small file read or stat call and one indexed lookup of the newest checkpoint record.
+        With the node local checkpoint cache enabled, the newest record alone decides the version.
+        Otherwise promoted weights are only picked up once `promoted_checkpoint_path` names their record,
+        so they are never served under the id of the weights they replaced.
         """
+        newest_checkpoint = MLPipelineInterface.checkpoint_db.newest_checkpoint_record(
+            projection = dict(_id = True, file_storage_id = True, sha256 = True, file_size = True))
+        if MLPipelineInterface.checkpoint_cache is not None and newest_checkpoint is not None:
+            return ModelVersion(weights_path = MLPipelineInterface.checkpoint_cache.weights_path(newest_checkpoint),
+                                weights_size = newest_checkpoint.get("file_size"),
+                                checkpoint_record_id = newest_checkpoint["_id"])
+
+        weights_path = MLPipelineInterface.get_current_weights_path()
+        promoted_checkpoint_path = MLPipelineInterface.promoted_checkpoint_path(weights_path)
+        if promoted_checkpoint_path.exists():
+            with open(promoted_checkpoint_path, 'r') as promoted_checkpoint_file:
+                promoted_checkpoint: dict = yaml.safe_load(promoted_checkpoint_file)
+            return ModelVersion(weights_path = weights_path,
+                                weights_mtime_ns = promoted_checkpoint["weights_mtime_ns"],
+                                weights_size = promoted_checkpoint["weights_size"],
+                                checkpoint_record_id = ObjectId(promoted_checkpoint["checkpoint_record_id"]))
 
+        # the pretrained weights, or weights promoted before their record was named next to them
+        weights_mtime_ns: int|None = None
+        weights_size: int|None = None
+        if weights_path.exists():
+            weights_stat = weights_path.stat()
+            weights_mtime_ns, weights_size = weights_stat.st_mtime_ns, weights_stat.st_size
+        return ModelVersion(weights_path = weights_path,
+                            weights_mtime_ns = weights_mtime_ns,
+                            weights_size = weights_size,
+                            checkpoint_record_id = newest_checkpoint["_id"] if newest_checkpoint else None)
+
+    @staticmethod
+    def load_ocr_model(weights_path: Path, config_path: Path|None = None,
+                       resizer_path: Path|None = None) -> LatexOCR:
+        """
+        Without `resizer_path` the local mathclips resizer is looked for, and the pretrained model is loaded
+        if there is none.  With it (checkpoints fetched into the node local cache) the resizer must be there,
+        falling back to the pretrained weights would serve them under the fetched checkpoint's id.
+        """
         #modifying the config args from the original library
         # we cannot proceed if we were unable to successfully export resizer weights.
         # the model will not update the resizer weights if accuracy was not improved.
-
-        current_checkpoint_path = MLPipelineInterface.get_current_weights_path()
+        if config_path is None:
+            config_path = MLPipelineInterface.mathclips_config_path
+        if resizer_path is not None and not resizer_path.exists():
+            raise FileNotFoundError(f"No image resizer at {resizer_path} to load checkpoint {weights_path} with")
         ocr_arguments: Munch = None
-        if MLPipelineInterface.mathclips_resizer_path.exists():
-            ocr_arguments = Munch({'config': str(MLPipelineInterface.mathclips_config_path),
-                                'checkpoint': str(current_checkpoint_path),
+        if resizer_path is not None or MLPipelineInterface.mathclips_resizer_path.exists():
+            ocr_arguments = Munch({'config': str(config_path),
+                                'checkpoint': str(weights_path),
                                 'no_cuda': True, 'no_resize': False})
+        return LatexOCR(arguments = ocr_arguments)
 
-        self.ocr_model = LatexOCR(arguments = ocr_arguments)
-        # open a connection to the ingest queue
-        self.rmq_connection: pika.connection.Connection = None
-        self.rmq_channel: pika.channel.Channel = None
+    @staticmethod
+    def quantized_weights_path(weights_path: Path) -> Path:
+        return weights_path.with_name(f"{weights_path.stem}.int8.pth")
+
+    @staticmethod
+    def load_model_version(model_version: ModelVersion, backend: str = InferenceBackend.FP32) -> LatexOCR:
+        """
+        Load the weights of `model_version`, fetching them into the node local checkpoint cache first if enabled.
+        For the int8 backend the quantized copy built on promotion is used, it is built here if missing.
+        """
+        if MLPipelineInterface.checkpoint_cache is not None and model_version.checkpoint_record_id is not None:
+            checkpoint_record = MLPipelineInterface.checkpoint_db.collection.find_one(
+                dict(_id = model_version.checkpoint_record_id))
+            weights_path, config_path = MLPipelineInterface.checkpoint_cache.fetch(
+                MLPipelineInterface.checkpoint_db, checkpoint_record)
+            ocr_model = MLPipelineInterface.load_ocr_model(
+                weights_path, config_path, resizer_path = MLPipelineInterface.checkpoint_cache.resizer_path)
+            if backend == InferenceBackend.INT8_DYNAMIC:
+                # built by the first worker process on the node to load this checkpoint
+                quantized_path = MLPipelineInterface.checkpoint_cache.derived_path(
+                    checkpoint_record, "int8.pth", lambda out_path: save_quantized_weights(ocr_model, out_path))
+                quantize_ocr_model(ocr_model, quantized_path)
+            return ocr_model
+
+        ocr_model = MLPipelineInterface.load_ocr_model(model_version.weights_path)
+        if backend == InferenceBackend.INT8_DYNAMIC:
+            quantized_path = MLPipelineInterface.quantized_weights_path(model_version.weights_path)
+            # the copy saved on promotion is only valid if it is newer than the weights
+            is_current = quantized_path.exists() and model_version.weights_mtime_ns is not None and \
+                quantized_path.stat().st_mtime_ns >= model_version.weights_mtime_ns
+            quantize_ocr_model(ocr_model, quantized_path if is_current else None)
+        return ocr_model
+
+    def __init__(self, checkpoint_poll_interval: float = CHECKPOINT_POLL_INTERVAL_S,
+                 transport: MessageTransport|None = None,
+                 inference_backend: str = ML_INFERENCE_BACKEND):
+        """
+        Upon Initializing this interface, the model will load the current weights file.
+        After a training pipeline, the weights will change; `refresh_model` will pick them up
+        without having to construct a new interface.
+        """
+        self.model_version: ModelVersion = MLPipelineInterface.get_current_model_version()
+        self.inference_backend = inference_backend
+        self.ocr_model: LatexOCR = MLPipelineInterface.load_model_version(self.model_version, inference_backend)
+        self.checkpoint_poll_interval = checkpoint_poll_interval
+        self._last_checkpoint_poll: float = time.monotonic()
+        # in-process layer in front of the shared mongo cache, keyed on (pixel hash, checkpoint id)
+        self.ocr_cache = LRUCache(OCR_CACHE_SIZE)
+        # results are published through the transport the worker consumes from
+        self.transport: MessageTransport = transport if transport is not None else create_transport()
+
+    def refresh_model(self, force: bool = False) -> bool:
+        """
+        Swap in a new resident model if newer weights have been promoted since the last load.
+        Only call this between messages, the swap is a single reference assignment so an in-flight
+        inference always finishes on the model it started with.
+
+        Returns
+        -------
+        bool
+            True if a new model was loaded.
+        """
+        now = time.monotonic()
+        if not force and now - self._last_checkpoint_poll < self.checkpoint_poll_interval:
+            return False
+        self._last_checkpoint_poll = now
+
+        latest_version = MLPipelineInterface.get_current_model_version()
+        if latest_version == self.model_version:
+            return False
+        logger.info(f"New OCR weights detected, reloading model from: {latest_version.weights_path} "
+                    f"(checkpoint: {latest_version.checkpoint_id})")
+        try:
+            new_model = MLPipelineInterface.load_model_version(latest_version, self.inference_backend)
+        except Exception as ex:
+            # keep serving with the old weights, the next poll will retry
+            logger.error(f"Could not load new OCR weights, keeping current model. ERROR MESSAGE: {ex}")
+            return False
+        self.ocr_model, self.model_version = new_model, latest_version
+        self.ocr_cache.clear()
+        return True
+
+    def cached_latex(self, pixel_hash: str) -> str|None:
+        checkpoint_id = self.model_version.checkpoint_id
+        latex_str: str|None = self.ocr_cache.get((pixel_hash, checkpoint_id))
+        if latex_str is None:
+            latex_str = MLPipelineInterface.ocr_cache_db.lookup(pixel_hash, checkpoint_id)
+            if latex_str is not None:
+                self.ocr_cache.put((pixel_hash, checkpoint_id), latex_str)
+        return latex_str
+
+    def remember_latex(self, pixel_hash: str, latex_str: str):
+        checkpoint_id = self.model_version.checkpoint_id
+        self.ocr_cache.put((pixel_hash, checkpoint_id), latex_str)
+        MLPipelineInterface.ocr_cache_db.store(pixel_hash, checkpoint_id, latex_str)
+
+    @property
+    def max_dimensions(self) -> Tuple[int, int]:
+        # (width, height) the resident model accepts, images are preprocessed to fit
+        return tuple(self.ocr_model.args.max_dimensions)
 
     def latex_from_image(self, image_msg: ImageProto) -> str:
-        image_data: Image = MLPipelineInterface.image_db.get_image(image_msg.uid)
+        image_data: Image = MLPipelineInterface.image_db.get_preprocessed_images([image_msg.uid],
+                                                                                 self.max_dimensions)[0]
         if image_data is None:
             logger.warning(f"Image does not exist in database: {image_msg.equation_name}")
             return ""
-        latex_str: str | None = self._extract_equation_from_image(image_data)
+        pixel_hash: str = image_data.info.get("pixel_hash") or pixel_content_hash(image_data)
+        latex_str: str | None = self.cached_latex(pixel_hash)
+        if latex_str is not None:
+            logger.info(f"OCR cache hit for: {image_msg.equation_name}")
+            return latex_str
+        latex_str = self._extract_equation_from_image(image_data)
         if latex_str is None:
             error_message: str = f"Could not generate an equation from: {image_data.info['filename']}"
             logger.error(error_message)
             raise RuntimeError(error_message)
+        if latex_str:
+            self.remember_latex(pixel_hash, latex_str)
         return latex_str
     
     def _extract_equation_from_image(self, image_data: Image) -> str:
@@ -117,72 +305,180 @@ class MLPipelineInterface:
         """
         return self.ocr_model(image_data)
 
-    def __enter__(self) -> MLPipelineInterface:
-        self.rmq_connection = pika.BlockingConnection(
-            get_rmq_connection_parameters(LOCAL_MODE))
-        self.rmq_channel = self.rmq_connection.channel()
-        self.rmq_channel.queue_declare(queue = IngestQueueNames.RESULT_QUEUE, durable = True)
-        return self
+    def latex_from_images(self, image_msgs: List[ImageProto],
+                          on_result: Callable[[int, str], None]|None = None) -> List[str]:
+        """
+        Batched counterpart of `latex_from_image`, one entry per message in the same order.
+        Images missing from the database yield an empty string.
+
+        `on_result(index, latex)` is called as soon as each result is known,
+        cache hits are reported before the rest of the batch goes through the model.
+        """
+        latex_results: List[str] = [""] * len(image_msgs)
 
-    def __exit__(self, execute_type, execute_value, execute_traceback):
-        self.rmq_connection.close()
+        def report_result(index: int, latex_str: str):
+            latex_results[index] = latex_str
+            if on_result is not None:
+                on_result(index, latex_str)
 
-    def send_result_to_ingest_service(self, result: OCR_Result):
-        if self.rmq_channel is not None:
-            self.rmq_channel.basic_publish(
-                exchange='',
-                routing_key = IngestQueueNames.RESULT_QUEUE,
-                properties = pika.BasicProperties(delivery_mode = pika.DeliveryMode.Persistent),
-                body = result.SerializeToString())
-            print(f"Sent ML OCR result to ingest queue. Message contents:\n{result}")
+        # cropped to the ink and downscaled, see mathclips.services.preprocessing
+        images: List[Image.Image|None] = MLPipelineInterface.image_db.get_preprocessed_images(
+            [msg.uid for msg in image_msgs], self.max_dimensions)
+        inference_queue: List[Tuple[int, str, Image.Image]] = []
+        for i, (image_msg, image_data) in enumerate(zip(image_msgs, images)):
+            if image_data is None:
+                logger.warning(f"Image does not exist in database: {image_msg.equation_name}")
+                report_result(i, "")
+                continue
+            pixel_hash: str = image_data.info.get("pixel_hash") or pixel_content_hash(image_data)
+            cached_latex_str = self.cached_latex(pixel_hash)
+            if cached_latex_str is not None:
+                logger.info(f"OCR cache hit for: {image_msg.equation_name}")
+                report_result(i, cached_latex_str)
+            else:
+                inference_queue.append((i, pixel_hash, image_data))
+
+        predictions = self._extract_equations_from_images([image_data for _, _, image_data in inference_queue])
+        for (i, pixel_hash, _), latex_str in zip(inference_queue, predictions):
+            if latex_str:
+                self.remember_latex(pixel_hash, latex_str)
+            report_result(i, latex_str)
+        return latex_results
+
+    def _image_to_tensor(self, image_data: Image.Image) -> torch.Tensor:
+        """
+        Mirrors the preprocessing in `LatexOCR.__call__` (padding, min/max sizing and the resizer loop),
+        so that batched inference sees exactly the tensor single-image inference would.
+        """
+        model = self.ocr_model
+        img = minmax_size(pad(image_data), model.args.max_dimensions, model.args.min_dimensions)
+        if model.image_resizer is not None and not model.args.no_resize:
+            with torch.no_grad():
+                input_image = img.convert('RGB').copy()
+                r, w, h = 1, input_image.size[0], input_image.size[1]
+                for _ in range(10):
+                    h = int(h * r)
+                    resample = Image.Resampling.BILINEAR if r > 1 else Image.Resampling.LANCZOS
+                    img = pad(minmax_size(input_image.resize((w, h), resample),
+                                          model.args.max_dimensions, model.args.min_dimensions))
+                    tensor = test_transform(image = np.array(img.convert('RGB')))['image'][:1].unsqueeze(0)
+                    w = (model.image_resizer(tensor.to(model.args.device)).argmax(-1).item() + 1) * 32
+                    if w == img.size[0]:
+                        break
+                    r = w / img.size[0]
         else:
-            logger.warning("Cannot Establish RabbitMQ connection to Ingest Service(s)!")
+            tensor = test_transform(image = np.array(pad(img).convert('RGB')))['image'][:1].unsqueeze(0)
+        return tensor
+
+    def _extract_equations_from_images(self, images: List[Image.Image]) -> List[str]:
+        """
+        Run the encoder and decoder once per group of equally sized inputs.
+        Padding inputs to a common size would change the prediction, so only identical shapes are stacked.
+        """
+        model = self.ocr_model
+        tensors = [self._image_to_tensor(image_data) for image_data in images]
+        shape_groups: Dict[Tuple[int, ...], List[int]] = defaultdict(list)
+        for i, tensor in enumerate(tensors):
+            shape_groups[tuple(tensor.shape)].append(i)
+
+        predictions: List[str] = [""] * len(images)
+        with torch.no_grad():
+            for indexes in shape_groups.values():
+                batch = torch.cat([tensors[i] for i in indexes]).to(model.args.device)
+                decoded = model.model.generate(batch, temperature = model.args.get('temperature', .25))
+                # rows that hit EOS early keep sampling until the whole batch is done,
+                # blank out everything after the first EOS so each row decodes like a batch of one.
+                is_eos = (decoded == model.args.eos_token).long()
+                after_eos = (torch.cumsum(is_eos, dim = 1) - is_eos) > 0
+                decoded = decoded.masked_fill(after_eos, model.args.pad_token)
+                for i, latex_str in zip(indexes, token2str(decoded, model.tokenizer)):
+                    predictions[i] = post_process(latex_str)
+        return predictions
+
+    def send_result_to_ingest_service(self, result: OCR_Result):
+        self.transport.publish(result, IngestQueueNames.RESULT_QUEUE)
+        print(f"Sent ML OCR result to ingest queue. Message contents:\n{result}")
 
-def ml_worker():
+def publish_ocr_result(ml_pipeline_interface: MLPipelineInterface, image_message: ImageProto, latex_equation: str):
+    if latex_equation:
+        # TODO - allow more user intervention to determine correctness.
+        equation_correct: bool = True
+        # the only write of this result, upserted so a redelivered message does not duplicate it
+        result_id: UintPackedBytes = ml_pipeline_interface.result_db.upsert_result(
+            latex_result = latex_equation, input_id = image_message.uid,
+            checkpoint_id = ml_pipeline_interface.model_version.checkpoint_id, correct = equation_correct)
+        result_message = OCR_Result(uid = result_id, latex = latex_equation, input_image_data = image_message)
 
-    def ml_pipeline_callback(channel: Channel, method: DeliveryProperties,
-                             properties: BasicProperties, body: bytes):
+        # send to the ingest queue to be displayed to the front end
+        ml_pipeline_interface.send_result_to_ingest_service(result_message)
+    else:
+        logger.warning(f"Was unable to generate a latex equaion for: {image_message.equation_name}")
 
-        ml_pipeline_interface = MLPipelineInterface()
+def ml_worker(batch_size: int = ML_BATCH_SIZE, batch_wait_ms: int = ML_BATCH_WAIT_MS,
+              transport: MessageTransport|None = None, stop_event: threading.Event|None = None,
+              cpu_budget: CPUBudget|None = None, consumer_stats: ConsumerStats|None = None):
+    if cpu_budget is not None:
+        # before the model is loaded, so its thread pools start at the budgeted size
+        apply_cpu_budget(cpu_budget)
+    if transport is None:
+        transport = create_transport()
+    # the model stays resident for the lifetime of the worker, only inference is paid per message
+    ml_pipeline_interface = MLPipelineInterface(transport = transport)
+
+    def ml_pipeline_callback(delivery: Delivery):
+        ml_pipeline_interface.refresh_model()
         # we are assuming that the image class is stored in its own database, and accessible via its uid property
-        image_message = ImageProto.FromString(body)
+        image_message: ImageProto = delivery.decode(ImageProto)
         print(f"Running ML Pipeline for: {image_message.equation_name}. MESSAGE:\n{image_message}")
         latex_equation: str = ml_pipeline_interface.latex_from_image(image_message)
-        if latex_equation:
-            # TODO - allow more user intervention to determine correctness.
-            equation_correct: bool = True
-            result_id: UintPackedBytes = ml_pipeline_interface.result_db.store_result(
-                latex_result = latex_equation, input_id = image_message.uid, correct = equation_correct)
-            result_message = OCR_Result(uid = result_id, latex = latex_equation, input_image_data = image_message)
-
-            # employing a with context to ensure connection is closed
-            with ml_pipeline_interface:
-                # send to the ingest queue to be displayed to the front end
-                ml_pipeline_interface.send_result_to_ingest_service(result_message)
-        else:
-            logger.warning(f"Was unable to generate a latex equaion for: {image_message.equation_name}")
+        publish_ocr_result(ml_pipeline_interface, image_message, latex_equation)
+        transport.ack(delivery)
 
-        channel.basic_ack(delivery_tag = method.delivery_tag)
-    connection = pika.BlockingConnection(
-        get_rmq_connection_parameters(LOCAL_MODE))
-    channel = connection.channel()
-    channel.queue_declare(queue = IngestQueueNames.ML_PIPELINE_QUEUE, durable = True)
-    print(" [*] Waiting for Messages, CTRL+C to quit.")
+    def ml_pipeline_batch_callback(batch: List[Delivery]):
+        ml_pipeline_interface.refresh_model()
+        image_messages: List[ImageProto] = [delivery.decode(ImageProto) for delivery in batch]
+        print(f"Running ML Pipeline for a batch of {len(batch)} images")
 
-    channel.basic_qos(prefetch_count = 1)
-    channel.basic_consume(queue = IngestQueueNames.ML_PIPELINE_QUEUE,
-                          on_message_callback = ml_pipeline_callback)
-    channel.start_consuming()
+        def on_batch_result(index: int, latex_equation: str):
+            publish_ocr_result(ml_pipeline_interface, image_messages[index], latex_equation)
+            transport.ack(batch[index])
 
+        ml_pipeline_interface.latex_from_images(image_messages, on_result = on_batch_result)
 
-def ml_worker_factory() -> multiprocessing.Process:
-    worker_process = multiprocessing.Process(target = ml_worker, name = "ml_pipeline_worker")
+    print(" [*] Waiting for Messages, CTRL+C to quit.")
+    if batch_size <= 1:
+        consume(transport, ml_pipeline_lanes, ml_pipeline_callback,
+                prefetch_count = 1, stop_event = stop_event, consumer_stats = consumer_stats)
+    else:
+        # micro-batching mode, the broker may hand us up to a full batch of unacked messages
+        consume_batches(transport, ml_pipeline_lanes, ml_pipeline_batch_callback,
+                        batch_size = batch_size, batch_wait_ms = batch_wait_ms, stop_event = stop_event,
+                        consumer_stats = consumer_stats)
+
+def ml_worker_factory(cpu_budget: CPUBudget|None = None) -> multiprocessing.Process:
+    worker_process = multiprocessing.Process(target = ml_worker, name = "ml_pipeline_worker",
+                                             kwargs = dict(cpu_budget = cpu_budget))
     worker_process.start()
     return worker_process
 
+def ml_worker_pool_spec() -> WorkerPoolSpec:
+    from mathclips.services import ML_PIPELINE_WORKER_BOUNDS, ML_THREADS_PER_WORKER, ML_PIN_WORKER_CORES
+    min_workers, max_workers = ML_PIPELINE_WORKER_BOUNDS
+    # budgeted for the most workers the pool can grow to, each slot keeps its share of the cores
+    cpu_budgets = plan_cpu_budgets(max_workers, ML_THREADS_PER_WORKER, pin = ML_PIN_WORKER_CORES)
+    return WorkerPoolSpec(name = "ml_pipeline", queue_names = ml_pipeline_lanes.queue_names, target = ml_worker,
+                          min_workers = min_workers, max_workers = max_workers,
+                          slot_kwargs = lambda slot: dict(cpu_budget = cpu_budgets[slot]))
+
 def main():
-    from mathclips.services import NUM_ML_PIPELINES
-    processes = [ml_worker_factory() for _ in range(NUM_ML_PIPELINES)]
+    from mathclips.services import NUM_ML_PIPELINES, ML_THREADS_PER_WORKER, ML_PIN_WORKER_CORES, AUTOSCALE_WORKERS
+    ensure_all_indexes(MLPipelineInterface.image_db.db)
+    if AUTOSCALE_WORKERS:
+        AutoscalingSupervisor([ml_worker_pool_spec()]).run()
+        return
+    # split the machine between the workers instead of each one sizing its thread pools to every core
+    cpu_budgets = plan_cpu_budgets(NUM_ML_PIPELINES, ML_THREADS_PER_WORKER, pin = ML_PIN_WORKER_CORES)
+    processes = [ml_worker_factory(cpu_budget) for cpu_budget in cpu_budgets]
     for process in processes:
         process.join()
 
@@ -1,41 +1,47 @@
-from typing import Dict, TypeAlias, List
+from typing import Callable, Dict, List
 from pathlib import Path
 from dataclasses import dataclass, field
 import random
 import multiprocessing
+import threading
 from itertools import chain
 import tempfile
-import subprocess
-import sys
 from datetime import datetime
 import shutil
 
-import pika.connection
 import pymongo.results
 import yaml
-import pika
-from pika.channel import Channel
-from pika.spec import BasicProperties
-from pika.spec import Basic
 import pix2tex
 import pymongo
+from pymongo import UpdateOne
+from bson.objectid import ObjectId
 from PIL import Image
 from munch import Munch
-DeliveryProperties: TypeAlias = Basic.Deliver
 
 import mathclips.front_end
 from mathclips.services import (MIN_TRAIN_BATCH_SIZE, NUM_TRAIN_WORKERS,
-                      NUM_RESULT_WORKERS, IngestQueueNames)
-from mathclips.services.rmq import get_rmq_connection_parameters
-from mathclips.services.util import (object_id_from_packed, packed_from_object_id,
-                           find_newest_file, update_nested_dict)
+                      NUM_RESULT_WORKERS, IngestQueueNames, EXPORT_NOTEBOOK_YAML,
+                      RESULT_BATCH_SIZE, RESULT_FLUSH_INTERVAL_MS, TRAIN_IN_PROCESS,
+                      ML_INFERENCE_BACKEND, InferenceBackend, AUTOSCALE_WORKERS,
+                      RESULT_WORKER_BOUNDS, TRAIN_WORKER_BOUNDS, TRAIN_MAX_DIMENSIONS)
+from mathclips.services.transport import (MessageTransport, Delivery, ConsumerStats, create_transport, consume,
+                                          consume_batches)
+from mathclips.services.autoscale import AutoscalingSupervisor, WorkerPoolSpec
+from mathclips.services.util import (object_id_from_packed, packed_from_object_id, object_ids_from_packed,
+                           find_newest_file, update_nested_dict, atomic_copy,
+                           atomic_write_yaml)
 from mathclips.services.mongodb import (MathSymbolImageDatabase, MLCheckpointDatabase,
-                              MathSymbolResultDatabase, MathEquationResultRecord)
+                              MathSymbolResultDatabase, MathEquationResultRecord,
+                              OCRResultCacheDatabase, NotebookDatabase, TrainingCandidateDatabase,
+                              TrainingJobDatabase, TrainingJobRecord, ensure_all_indexes)
 from mathclips.services.image_to_equation_interface import MLPipelineInterface
+from mathclips.services.notebook_yaml import import_notebook_if_empty
+from mathclips.services.quantization import save_quantized_weights
+from mathclips.services.training_data import (build_in_memory_dataset, resolve_tokenizer_path, build_pickled_dataset,
+                                              run_training_in_process, run_training_subprocess)
 from mathclips.proto.pb_py_classes.ocr_result_pb2 import OCR_Result
 from mathclips.proto.pb_py_classes.train_pb2 import TrainRequest
 from mathclips.proto.pb_py_classes.uint_packed_bytes_pb2 import UintPackedBytes as UintPacked
-from mathclips.services import LOCAL_MODE
 import mathclips
 
 pix2tex_root = Path(pix2tex.__path__[0]).resolve()
@@ -44,6 +50,10 @@ pix2tex_root = Path(pix2tex.__path__[0]).resolve()
 image_db = MathSymbolImageDatabase()
 result_db = MathSymbolResultDatabase(db = image_db.db)
 ml_checkpoints_db = MLCheckpointDatabase(db = image_db.db)
+ocr_cache_db = OCRResultCacheDatabase(db = image_db.db)
+notebook_db = NotebookDatabase(db = image_db.db)
+training_candidate_db = TrainingCandidateDatabase(db = image_db.db)
+training_job_db = TrainingJobDatabase(db = image_db.db)
 
 default_result_config_filename = mathclips.front_end.notebook_config_path
 
@@ -57,29 +67,29 @@ class SessionResultConfig:
     config_path: Path = default_result_config_filename
     config_data: Dict = field(default_factory = dict)
 
-# TODO - in future iterations this can be either expanded for authenticated sessions, or replaced with a database.
+# the notebook itself lives in mongo (NotebookDatabase), the YAML file is only kept as an optional export.
+# TODO - in future iterations this can be expanded for authenticated sessions.
 SESSION_RESULT_CONFIG_MAP = {
     "default": SessionResultConfig()
 }
 
-def update_result_config(new_data: dict, session_key: str = "default"):
+def update_result_config(new_data: dict|List[dict], session_key: str = "default"):
+    """
+    Merge one or more notebook entries into the YAML export, the file is written once per call.
+    """
     result_config = SESSION_RESULT_CONFIG_MAP[session_key]
     if not result_config.config_data:
         with open(result_config.config_path, 'r') as config_file:
-            result_config.config_data = yaml.safe_load(config_file)
+            result_config.config_data = yaml.safe_load(config_file) or {}
 
     # merge the two dictionaries
-    update_nested_dict(result_config.config_data, new_data)
-    with open(result_config.config_path, 'w') as config_file:
-        yaml.safe_dump(result_config.config_data, config_file)
+    for entry in (new_data if isinstance(new_data, list) else [new_data]):
+        update_nested_dict(result_config.config_data, entry)
+    atomic_write_yaml(result_config.config_data, result_config.config_path)
     print(f"SUCCESSFULL UPDATED NOTEBOOK CONFIG AT: {result_config.config_path}")
 
-def equation_result_callback(channel: Channel, method: DeliveryProperties,
-                            properties: BasicProperties, body: bytes):
-
-    print("Adding ML Pipeline result to database!")
-    result_message = OCR_Result.FromString(body)
-    config_data = {
+def notebook_config_entry(result_message: OCR_Result) -> dict:
+    return {
         result_message.input_image_data.parent_section: {
             result_message.input_image_data.equation_name: dict(
                 author = result_message.input_image_data.author,
@@ -88,27 +98,56 @@ def equation_result_callback(channel: Channel, method: DeliveryProperties,
                                last_bits = result_message.uid.last_bits))
             }
         }
+
+def notebook_upsert_operation(result_message: OCR_Result) -> UpdateOne:
+    return NotebookDatabase.upsert_operation(section = result_message.input_image_data.parent_section,
+                                             equation_name = result_message.input_image_data.equation_name,
+                                             author = result_message.input_image_data.author,
+                                             latex = result_message.latex,
+                                             result_id = result_message.uid)
+
+def equation_result_callback(transport: MessageTransport, delivery: Delivery):
+
+    print("Adding ML Pipeline result to the notebook!")
+    result_message: OCR_Result = delivery.decode(OCR_Result)
+    config_data = notebook_config_entry(result_message)
     print(f"Updating notebook with the following Configuration mapping:\n{config_data}")
-    update_result_config(config_data)
-    # TODO - figure out a better way to validate correctness
-    record_id: UintPacked = result_db.store_result(
-        result_message.latex, result_message.input_image_data.uid,
-        correct = True)
-    if record_id is not None:
-        print("Successfully added ML Pipeline Result to Database!")
-        print("Result Record: ", object_id_from_packed(record_id))
-        channel.basic_ack(delivery_tag = method.delivery_tag)
-
-def equation_result_listener():
-    rmq_connection: pika.connection.Connection = pika.BlockingConnection(
-            get_rmq_connection_parameters(LOCAL_MODE))
-    channel: Channel = rmq_connection.channel()
-    channel.queue_declare(queue = IngestQueueNames.RESULT_QUEUE, durable = True)
+    notebook_db.bulk_upsert([notebook_upsert_operation(result_message)])
+    if EXPORT_NOTEBOOK_YAML:
+        update_result_config(config_data)
+    # the ML pipeline has already persisted the result record, the message carries its id
+    print("Successfully added ML Pipeline Result to the Notebook!")
+    print("Result Record: ", object_id_from_packed(result_message.uid))
+    transport.ack(delivery)
+
+def equation_result_batch_callback(transport: MessageTransport, batch: List[Delivery]):
+    """
+    One bulk write and at most one YAML flush for the whole batch, then a single multiple-ack.
+    """
+    result_messages: List[OCR_Result] = [delivery.decode(OCR_Result) for delivery in batch]
+    notebook_db.bulk_upsert([notebook_upsert_operation(result_message) for result_message in result_messages])
+    if EXPORT_NOTEBOOK_YAML:
+        update_result_config([notebook_config_entry(result_message) for result_message in result_messages])
+    # the consumer acks every batch before pulling the next, so this covers exactly the current batch
+    transport.ack(batch[-1], multiple = True)
+    print(f"Successfully added {len(batch)} ML Pipeline Results to the Notebook!")
+
+def equation_result_listener(transport: MessageTransport|None = None, stop_event: threading.Event|None = None,
+                             batch_size: int = RESULT_BATCH_SIZE,
+                             flush_interval_ms: int = RESULT_FLUSH_INTERVAL_MS,
+                             consumer_stats: ConsumerStats|None = None):
+    if transport is None:
+        transport = create_transport()
     print(" [*] Waiting for result messages. CTRL+C to quit.")
-    channel.basic_qos(prefetch_count = 1)
-    channel.basic_consume(queue = IngestQueueNames.RESULT_QUEUE,
-                          on_message_callback = equation_result_callback)
-    channel.start_consuming()
+    if batch_size <= 1:
+        consume(transport, IngestQueueNames.RESULT_QUEUE,
+                lambda delivery: equation_result_callback(transport, delivery),
+                prefetch_count = 1, stop_event = stop_event, consumer_stats = consumer_stats)
+    else:
+        consume_batches(transport, IngestQueueNames.RESULT_QUEUE,
+                        lambda batch: equation_result_batch_callback(transport, batch),
+                        batch_size = batch_size, batch_wait_ms = flush_interval_ms, stop_event = stop_event,
+                        consumer_stats = consumer_stats)
 
 def equation_result_worker_factory() -> multiprocessing.Process:
     worker_process = multiprocessing.Process(target = equation_result_listener, name = "equation_result_worker")
@@ -123,7 +162,21 @@ class TrainingBatch:
     val_latex_labels: List[str] = field(default_factory = list)
 
 def train_worker(batch: TrainingBatch,
-                 image_db: MathSymbolImageDatabase, checkpoint_db: MLCheckpointDatabase):
+                 image_db: MathSymbolImageDatabase, checkpoint_db: MLCheckpointDatabase,
+                 cache_db: OCRResultCacheDatabase|None = None,
+                 on_progress: Callable[[str], None]|None = None,
+                 in_process: bool = TRAIN_IN_PROCESS) -> UintPacked:
+    """
+    Build a dataset from the batch, fine tune the current weights on it and promote the new weights.
+    `in_process` trains with in memory datasets in this process, instead of via the pix2tex CLIs,
+    see mathclips.services.training_data.
+
+    `on_progress` is called with a short description as each stage starts, an exception raised from it
+    aborts the run (before the new weights are promoted, if raised for the "promoting" stage).
+    Returns the id of the stored checkpoint record.
+    """
+    if on_progress is None:
+        on_progress = lambda stage: None
 
     # create a temp dir to load image data from database and create a temporary dataset, then cleanup from disk
     # the temp dir will automatically clean itself up, in case of any critical failures that will inevitably occur.
@@ -146,53 +199,33 @@ def train_worker(batch: TrainingBatch,
 
         shutil.copy2(seed_resizer_path, checkpoints_dir.joinpath("image_resizer.pth"))
 
+    # load in the default config, and replace settings where appropriate
+    # using the original hyperparameters the author designed
+    with open(model_dir / "settings" / "config.yaml", 'r') as config_template_file:
+        train_config_template = Munch(yaml.safe_load(config_template_file))
+    tokenizer_path: Path = resolve_tokenizer_path(train_config_template.tokenizer)
+    # train on the images as the ML pipeline preprocesses them, at the size the config below trains at
+    max_dimensions = TRAIN_MAX_DIMENSIONS
+
     with tempfile.TemporaryDirectory() as temp_dir:
         # copy all input datafiles here
         temp_dir_path = Path(temp_dir)
-        train_dir = temp_dir_path.joinpath("train")
-        train_dir.mkdir(parents = True, exist_ok = True)
-        val_dir = temp_dir_path.joinpath("val")
-        val_dir.mkdir(parents = True, exist_ok = True)
-
-        def save_temp_image(fid: UintPacked, out_dir: Path, index: int):
-            pil_image: Image = image_db.get_image(fid)
-            orig_ext: str = Path(pil_image.info["filename"]).suffix
-            basename: str = "{:07d}".format(index)
-            temp_path = out_dir.joinpath(basename).with_suffix(orig_ext)
-            pil_image.save(str(temp_path))
-
-        def save_labels(out_dir: Path, labels: List[str], filename: str):
-            label_file_contents = '\n'.join(labels)
-            label_file_path = out_dir.joinpath(filename)
-            with open(label_file_path, 'w') as label_file:
-                label_file.write(label_file_contents)
-            return label_file_path
-
-        for i, fid in enumerate(batch.train_image_file_ids):
-            save_temp_image(fid, train_dir, i)
-        train_labels_path: Path = \
-            save_labels(train_dir, batch.train_latex_labels, "mathclips_train_labels.txt")
-
-        for i, fid in enumerate(batch.val_image_file_ids):
-            save_temp_image(fid, val_dir, i)
-        val_labels_path: Path = \
-            save_labels(val_dir, batch.val_latex_labels, "mathclips_val_labels.txt")
-
-        torch_train_dataset_path: Path = temp_dir_path.joinpath("mathclips_train_dataset.pkl")
-        subprocess.run([sys.executable, "-m", "pix2tex.dataset.dataset", "--equations", train_labels_path,
-                        "--images", train_dir, "--out", torch_train_dataset_path],
-                       check = True, stderr = sys.stderr, stdout = sys.stdout)
-
-        torch_val_dataset_path: Path = temp_dir_path.joinpath("mathclips_val_dataset.pkl")
-        subprocess.run([sys.executable, "-m", "pix2tex.dataset.dataset", "--equations", val_labels_path,
-                        "--images", val_dir, "--out", torch_val_dataset_path],
-                       check = True, stderr = sys.stderr, stdout = sys.stdout)
-
-        # load in the default config, and replace settings where appropriate
-        # using the original hyperparameters the author designed
-        with open(model_dir / "settings" / "config.yaml", 'r') as config_template_file:
-    
-            train_config_template = Munch(yaml.safe_load(config_template_file))
+
+        on_progress("building dataset")
+        if in_process:
+            train_dataset = build_in_memory_dataset(image_db, batch.train_image_file_ids, batch.train_latex_labels,
+                                                    tokenizer_path, max_dimensions)
+            val_dataset = build_in_memory_dataset(image_db, batch.val_image_file_ids, batch.val_latex_labels,
+                                                  tokenizer_path, max_dimensions)
+        else:
+            # one bulk fetch per split instead of a round trip per sample
+            train_images: List[Image.Image] = image_db.get_preprocessed_images(batch.train_image_file_ids,
+                                                                                max_dimensions)
+            val_images: List[Image.Image] = image_db.get_preprocessed_images(batch.val_image_file_ids, max_dimensions)
+            torch_train_dataset_path: Path = build_pickled_dataset(
+                train_images, batch.train_latex_labels, temp_dir_path, "train")
+            torch_val_dataset_path: Path = build_pickled_dataset(
+                val_images, batch.val_latex_labels, temp_dir_path, "val")
 
         # override the default settings
         current_batch_size: int = min(64, len(batch.train_image_file_ids))
@@ -200,16 +233,16 @@ def train_worker(batch: TrainingBatch,
         assert val_batch_size > 0
         train_config_template.name = MLPipelineInterface.mathclips_weights_name
         train_config_template.batchsize = current_batch_size
-        train_config_template.data = str(torch_train_dataset_path)
-        train_config_template.valdata = str(torch_val_dataset_path)
+        if not in_process:
+            train_config_template.data = str(torch_train_dataset_path)
+            train_config_template.valdata = str(torch_val_dataset_path)
         train_config_template.valbatches = val_batch_size
         train_config_template.model_path = str(checkpoints_dir)
         train_config_template.num_epochs = 10
         if current_checkpoint_path:
             train_config_template.load_chkpt = str(current_checkpoint_path)
-        train_config_template.max_width = 512
         #train_config_template.max_width = 1024
-        train_config_template.max_height = 512
+        train_config_template.max_width, train_config_template.max_height = max_dimensions
         train_config_template.debug = True
         #train_config_template.encoder_structure = 'vit'
         train_config_template.encoder_structure = 'hybrid'
@@ -219,23 +252,52 @@ def train_worker(batch: TrainingBatch,
         with open(train_config_path, 'w') as train_config:
             yaml.safe_dump(dict(train_config_template), train_config)
 
-        subprocess.run([sys.executable, "-m", "pix2tex.train", "--config", train_config_path, "--debug"],
-                       check = True, stderr = sys.stderr, stdout = sys.stdout)
+        on_progress(f"training {train_config_template.num_epochs} epochs")
+        if in_process:
+            run_training_in_process(train_config_template, train_dataset, val_dataset)
+        else:
+            run_training_subprocess(train_config_path)
 
         # the train module outputs new weights and configs to: config.model_path / config.name
         batch_run_output_dir = checkpoints_dir.joinpath(MLPipelineInterface.mathclips_weights_name)
         newest_checkpoint_path = find_newest_file(batch_run_output_dir, filter_pattern = '*.pth')
+
         # the filename stored in the database will have extra info associated with it related to the training run.
         # the production file will just be called mathclips_weights.pth to simplify the system
         # the database will store more of the metadata that give better detail about how the weights file was constructed.
-        checkpoint_db.store_checkpoint_file(checkpoint_path = newest_checkpoint_path,
-                                            timestamp = datetime.now(),
-                                            train_file_ids = batch.train_image_file_ids)
-
+        # the record is written before the weights are promoted, its id is the checkpoint id the OCR cache is keyed on.
         new_config_path = batch_run_output_dir.joinpath("config.yaml")
+        checkpoint_record_id: UintPacked = checkpoint_db.store_checkpoint_file(
+            checkpoint_path = newest_checkpoint_path,
+            timestamp = datetime.now(),
+            train_file_ids = batch.train_image_file_ids,
+            model_config_path = new_config_path)
+        checkpoint_id: str = str(object_id_from_packed(checkpoint_record_id))
+
+        # resident ML workers poll these paths, promote them atomically so a worker never loads a half-written file.
+        # the config goes first, the weights next, and the record id file the workers watch last,
+        # so a worker that sees the new id finds the matching weights and config.
+        on_progress("promoting")
         if new_config_path.exists():
-            shutil.copy2(new_config_path, MLPipelineInterface.mathclips_config_path)
-        shutil.copy2(newest_checkpoint_path, mathclips_weight_path)
+            atomic_copy(new_config_path, MLPipelineInterface.mathclips_config_path)
+        atomic_copy(newest_checkpoint_path, mathclips_weight_path)
+        if ML_INFERENCE_BACKEND == InferenceBackend.INT8_DYNAMIC:
+            # workers sharing this filesystem load the quantized copy instead of each quantizing on their own
+            on_progress("quantizing")
+            try:
+                save_quantized_weights(MLPipelineInterface.load_ocr_model(mathclips_weight_path),
+                                       MLPipelineInterface.quantized_weights_path(mathclips_weight_path))
+            except Exception as ex:
+                print(f"Could not build the int8 copy of the new weights, workers will quantize on load: {ex}")
+        weights_stat = mathclips_weight_path.stat()
+        atomic_write_yaml(dict(checkpoint_record_id = checkpoint_id, weights_mtime_ns = weights_stat.st_mtime_ns,
+                               weights_size = weights_stat.st_size),
+                          MLPipelineInterface.promoted_checkpoint_path(mathclips_weight_path))
+
+        if cache_db is None:
+            cache_db = ocr_cache_db
+        num_invalidated: int = cache_db.invalidate(keep_checkpoint_id = checkpoint_id)
+        print(f"Invalidated {num_invalidated} cached OCR results from previous weights")
 
         # TODO - Fix pipeline to get resizer to work
         # subprocess.run([sys.executable, "-m", "pix2tex.train_resizer",
@@ -248,16 +310,46 @@ def train_worker(batch: TrainingBatch,
         shutil.rmtree(batch_run_output_dir, ignore_errors = True)
         train_config_path.unlink(missing_ok = True)
         print(f"Updated OCR Model weights at: {mathclips_weight_path}")
-
-def train_callback(channel: Channel, method: DeliveryProperties,
-                   properties: BasicProperties, body: bytes):
+        return checkpoint_record_id
+
+def training_job_record(batch_id: ObjectId, batch: TrainingBatch) -> TrainingJobRecord:
+    return TrainingJobRecord(
+        batch_id = batch_id,
+        train_file_ids = object_ids_from_packed(batch.train_image_file_ids),
+        train_latex_labels = list(batch.train_latex_labels),
+        val_file_ids = object_ids_from_packed(batch.val_image_file_ids),
+        val_latex_labels = list(batch.val_latex_labels))
+
+def training_batch_from_job(job: dict) -> TrainingBatch:
+    return TrainingBatch(
+        train_image_file_ids = [packed_from_object_id(file_id) for file_id in job["train_file_ids"]],
+        train_latex_labels = list(job["train_latex_labels"]),
+        val_image_file_ids = [packed_from_object_id(file_id) for file_id in job["val_file_ids"]],
+        val_latex_labels = list(job["val_latex_labels"]))
+
+def complete_training_batch(batch_id: ObjectId):
+    """
+    Upon a successful training run, unmark only the samples of its batch.
+    Images re-labelled while the run was going are still waiting for the next batch.
+    """
+    trained_ids: List[ObjectId] = [candidate['file_storage_id'] for candidate in
+                                   training_candidate_db.collection.find(dict(batch_id = batch_id),
+                                                                         projection = dict(file_storage_id = True))]
+    still_pending = set(training_candidate_db.pending_file_ids(trained_ids))
+    image_db.collection.update_many(
+        filter = dict(file_storage_id = {'$in': [file_id for file_id in trained_ids if file_id not in still_pending]}),
+        update = {'$set': {'needs_train': False}})
+    training_candidate_db.complete_batch(batch_id)
+    print("Successfully Unmarked Samples for Training!")
+
+def train_callback(transport: MessageTransport, delivery: Delivery):
         print("Processing Training Request ...")
-        train_request = TrainRequest.FromString(body)
+        train_request: TrainRequest = delivery.decode(TrainRequest)
         result_record: MathEquationResultRecord = result_db.find_one(
             dict(_id = object_id_from_packed(train_request.result_uid)))
         if result_record is None:
             print(f"Could not find result record with id message: {train_request.result_uid}")
-            channel.basic_ack(delivery_tag = method.delivery_tag)
+            transport.ack(delivery)
             return
         # designate a record for training
         result = image_db.collection.update_one(
@@ -265,60 +357,59 @@ def train_callback(channel: Channel, method: DeliveryProperties,
             {'$set': dict(train_label = train_request.latex_str, needs_train = True)},
             upsert = False)
         assert result is not None
+        num_pending: int = training_candidate_db.mark_candidate(result_record["input_entry_id"],
+                                                                train_request.latex_str)
 
         # we want enough data for train data + validation data
         # going to use 20% of train batch size, or half the size
         validation_size = max(1, max(int(0.2*float(MIN_TRAIN_BATCH_SIZE)), int(MIN_TRAIN_BATCH_SIZE / 2)))
         # in developer mode, this will require 3 images, with a MIN_TRAIN_BATCH_SIZE of 2
         train_threshold: int = MIN_TRAIN_BATCH_SIZE + validation_size
-        num_matches: int = image_db.collection.count_documents(dict(needs_train = True))
         print("Checking if Training batch is ready ...")
-        if num_matches >= train_threshold:
-            print("Kicking off a training batch run!")
-            records_marked_train_cursor: pymongo.CursorType = image_db.query(dict(needs_train = True))
-            # delegate to a function that will kick off a training run
-            # probably need a worker queue here
-            query_batch = [ImageFileIdAndLabel(file_id = packed_from_object_id(post['file_storage_id']), \
-                                        latex_label = post['train_label']) for post in records_marked_train_cursor]
-            validation_sample_indexes = random.sample(range(num_matches), validation_size)
+        if num_pending >= train_threshold:
+            # claim the pending samples, anything marked from here on goes in the next batch
+            batch_id = ObjectId()
+            candidates: List[dict] = training_candidate_db.snapshot_batch(batch_id)
+            if len(candidates) < train_threshold:
+                # another train worker claimed the batch before us
+                training_candidate_db.release_batch(batch_id)
+                print("Trainig Request Processed!")
+                transport.ack(delivery)
+                return
+            query_batch = [ImageFileIdAndLabel(file_id = packed_from_object_id(candidate['file_storage_id']),
+                                               latex_label = candidate['train_label']) for candidate in candidates]
+            validation_sample_indexes = set(random.sample(range(len(query_batch)), validation_size))
             train_batch = TrainingBatch()
             for i, id_and_label in enumerate(query_batch):
                 if i in validation_sample_indexes:
                     train_batch.val_image_file_ids.append(id_and_label.file_id)
                     train_batch.val_latex_labels.append(id_and_label.latex_label)
-                    # shorten the list to make search nlog(n)
-                    validation_sample_indexes.remove(i)
                 else:
                     train_batch.train_image_file_ids.append(id_and_label.file_id)
                     train_batch.train_latex_labels.append(id_and_label.latex_label)
 
             assert len(train_batch.val_latex_labels) > 0
-            # kick off a training worker
-            print(f"Training using: {len(train_batch.train_latex_labels)} ",
+            # the run itself happens in the training job pool, see mathclips.services.training_jobs
+            try:
+                job_id: ObjectId = training_job_db.enqueue(training_job_record(batch_id, train_batch))
+            except Exception:
+                training_candidate_db.release_batch(batch_id)
+                raise
+            print(f"Queued training job {job_id} with: {len(train_batch.train_latex_labels)} ",
                   f"TRAIN SAMPLES and {len(train_batch.val_latex_labels)} VALIDATION SAMPLES!")
-            train_worker(
-                batch = train_batch, image_db = image_db, checkpoint_db = ml_checkpoints_db)
-
-            # upon successful training batch run, set needs train back to false
-            many_result: pymongo.results.UpdateResult = \
-                image_db.collection.update_many(
-                    filter = dict(needs_train = True),
-                    update = {'$set': {'needs_train': False}})
-            assert many_result is not None and many_result.modified_count == len(query_batch)
-            print("Successfully Unmarked Samples for Training!")
         print("Trainig Request Processed!")
-        channel.basic_ack(delivery_tag = method.delivery_tag)
-
-def train_message_listener():
-    rmq_connection: pika.connection.Connection = pika.BlockingConnection(
-            get_rmq_connection_parameters(LOCAL_MODE))
-    channel: Channel = rmq_connection.channel()
-    channel.queue_declare(queue = IngestQueueNames.TRAIN_QUEUE, durable = True)
+        transport.ack(delivery)
+
+def train_message_listener(transport: MessageTransport|None = None, stop_event: threading.Event|None = None,
+                           consumer_stats: ConsumerStats|None = None):
+    if transport is None:
+        transport = create_transport()
+    # pick up images flagged for training before the candidate collection existed
+    training_candidate_db.seed_from_images(image_db)
     print(" [*] Waiting for train request messages. CTRL+C to exit.")
-    channel.basic_qos(prefetch_count = 1)
-    channel.basic_consume(queue = IngestQueueNames.TRAIN_QUEUE,
-                          on_message_callback = train_callback)
-    channel.start_consuming()
+    consume(transport, IngestQueueNames.TRAIN_QUEUE,
+            lambda delivery: train_callback(transport, delivery),
+            prefetch_count = 1, stop_event = stop_event, consumer_stats = consumer_stats)
 
 def train_message_worker_factory() -> multiprocessing.Process:
     worker_process = multiprocessing.Process(target = train_message_listener, name = "train_message_worker")
@@ -359,7 +450,23 @@ def run_result_queue_listeners():
     for worker in result_message_workers:
         worker.join()
 
+def result_worker_pool_spec() -> WorkerPoolSpec:
+    return WorkerPoolSpec(name = "result", queue_names = (IngestQueueNames.RESULT_QUEUE,),
+                          target = equation_result_listener,
+                          min_workers = RESULT_WORKER_BOUNDS[0], max_workers = RESULT_WORKER_BOUNDS[1])
+
+def train_request_worker_pool_spec() -> WorkerPoolSpec:
+    return WorkerPoolSpec(name = "train_request", queue_names = (IngestQueueNames.TRAIN_QUEUE,),
+                          target = train_message_listener,
+                          min_workers = TRAIN_WORKER_BOUNDS[0], max_workers = TRAIN_WORKER_BOUNDS[1])
+
 def main():
+    ensure_all_indexes(image_db.db)
+    # before any result is upserted, an existing YAML notebook would otherwise never be imported
+    import_notebook_if_empty(notebook_db, default_result_config_filename)
+    if AUTOSCALE_WORKERS:
+        AutoscalingSupervisor([train_request_worker_pool_spec(), result_worker_pool_spec()]).run()
+        return
     train_message_workers = [train_message_worker_factory() for _ in range(NUM_TRAIN_WORKERS)]
     result_message_workers = [equation_result_worker_factory() for _ in range(NUM_RESULT_WORKERS)]
 
@@ -0,0 +1,64 @@
+"""
+Re-encode images already stored in GridFS with a compressed codec.
+
+Images uploaded before codecs were introduced hold the raw pillow pixel buffer.
+The GridFS ids are kept, so image records, results and queued messages that point at them stay valid.
+Each new encoding is staged and verified before its original is deleted, a re-run finishes any swap an
+interrupted run left halfway.
+
+usage:
+    python -m mathclips.services.migrate_image_storage [--codec grayscale_png] [--dry-run]
+    python -m mathclips.services.migrate_image_storage --metadata-only
+"""
+import argparse
+
+from mathclips.services import ImageCodec, IMAGE_STORAGE_CODEC
+from mathclips.services.logger import logger
+from mathclips.services.mongodb import MathSymbolImageDatabase
+
+def migrate_image_storage(image_db: MathSymbolImageDatabase, codec: str = IMAGE_STORAGE_CODEC,
+                          dry_run: bool = False):
+    total_before: int = 0
+    total_after: int = 0
+    num_migrated: int = 0
+    if not dry_run:
+        num_restored: int = image_db.recover_staged_images()
+        if num_restored:
+            logger.info(f"Restored {num_restored} re-encoded images left in staging by an interrupted run")
+    # only the id is needed, the metadata is re-read per file inside reencode_image
+    for file_document in image_db.file_storage.find({"metadata.codec": {'$ne': codec}}, no_cursor_timeout = True):
+        file_id = file_document._id
+        if dry_run:
+            logger.info(f"Would re-encode: {file_document.filename} ({file_document.length} bytes)")
+            continue
+        try:
+            size_before, size_after = image_db.reencode_image(file_id, codec)
+        except Exception as ex:
+            logger.error(f"Could not re-encode image {file_id}: {ex}")
+            continue
+        total_before += size_before
+        total_after += size_after
+        num_migrated += 1
+
+    if num_migrated:
+        logger.info(f"Re-encoded {num_migrated} images with {codec}: {total_before} bytes -> {total_after} bytes "
+                    f"({total_before / max(total_after, 1):.1f}x smaller)")
+    else:
+        logger.info("No images needed re-encoding")
+
+def main():
+    codec_choices = [value for key, value in vars(ImageCodec).items() if not key.startswith('_')]
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--codec", choices = codec_choices, default = IMAGE_STORAGE_CODEC)
+    parser.add_argument("--dry-run", action = "store_true", help = "list the files that would be re-encoded")
+    parser.add_argument("--metadata-only", action = "store_true",
+                        help = "only copy mode and size of legacy files into GridFS metadata, keeping their raw buffers")
+    args = parser.parse_args()
+    image_db = MathSymbolImageDatabase()
+    if args.metadata_only:
+        logger.info(f"Added decode metadata to {image_db.backfill_file_metadata()} legacy image files")
+        return
+    migrate_image_storage(image_db, codec = args.codec, dry_run = args.dry_run)
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,30 @@
 from __future__ import annotations
 
 from dataclasses import dataclass, asdict
+import hashlib
+import io
 import os
-from datetime import datetime
-from typing import List, TypeAlias, Tuple, Optional, IO
+import tempfile
+from datetime import datetime, timedelta, timezone
+from typing import List, TypeAlias, Tuple, Optional, IO, Dict
 from pathlib import Path
 
 from bson.objectid import ObjectId
-from pymongo import MongoClient
+from pymongo import MongoClient, ASCENDING, DESCENDING, UpdateOne, ReturnDocument, IndexModel
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 from pymongo.database import Database
 from pymongo.results import InsertManyResult, InsertOneResult
 import gridfs
-from PIL import Image
+from PIL import Image, ImageChops
 
-from mathclips.services import MONGO_DOCKER_IP, MONGO_PORT
+from mathclips.services import (MONGO_DOCKER_IP, MONGO_PORT, ImageCodec, IMAGE_STORAGE_CODEC, TrainingJobStatus,
+                                TRAIN_JOB_MAX_ATTEMPTS)
 from mathclips.proto.pb_py_classes.image_pb2 import Image as ProtoImage
 from mathclips.proto.pb_py_classes.uint_packed_bytes_pb2 import UintPackedBytes
-from mathclips.services.util import object_id_from_packed, packed_from_object_id
+from mathclips.services.util import (object_id_from_packed, packed_from_object_id, object_ids_from_packed,
+                                     pixel_content_hash)
+from mathclips.services.preprocessing import preprocess_image, preprocessing_key
+from mathclips.services.logger import logger
 
 def dict_to_intersection_query(dictionary: dict, uid: UintPackedBytes|bytes|None = None) -> dict:
     query_list = [{key: value} for key, value in dictionary.items() if value is not None]
@@ -29,6 +37,63 @@ def dict_to_intersection_query(dictionary: dict, uid: UintPackedBytes|bytes|None
         query_list.insert(0, {"_id", object_id})
     return {"$and": query_list}
 
+def is_opaque_grayscale(pillow_image: Image.Image) -> bool:
+    if pillow_image.mode in ("1", "L"):
+        return True
+    if pillow_image.mode not in ("RGB", "RGBA", "LA"):
+        return False
+    bands = pillow_image.split()
+    if pillow_image.mode in ("RGBA", "LA") and bands[-1].getextrema() != (255, 255):
+        return False
+    if pillow_image.mode == "LA":
+        return True
+    red, green, blue = bands[:3]
+    return ImageChops.difference(red, green).getbbox() is None \
+        and ImageChops.difference(red, blue).getbbox() is None
+
+def encode_image(pillow_image: Image.Image, codec: str = IMAGE_STORAGE_CODEC) -> Tuple[bytes, str]:
+    """
+    Encode an image for GridFS storage.  Every codec is lossless with respect to the decoded pixels,
+    if the requested codec cannot represent the image, this falls back to PNG and then to the raw buffer.
+
+    Returns
+    -------
+    Tuple[bytes, str]
+        The encoded buffer, and the codec that was actually used.
+    """
+    if codec == ImageCodec.GRAYSCALE_PNG and not is_opaque_grayscale(pillow_image):
+        codec = ImageCodec.PNG
+    if codec == ImageCodec.RAW:
+        return pillow_image.tobytes(), codec
+
+    buffer = io.BytesIO()
+    try:
+        if codec == ImageCodec.GRAYSCALE_PNG:
+            pillow_image.convert("L").save(buffer, format = "PNG", optimize = True)
+        elif codec == ImageCodec.WEBP_LOSSLESS:
+            pillow_image.save(buffer, format = "WEBP", lossless = True, quality = 100, exact = True)
+        elif codec == ImageCodec.PNG:
+            pillow_image.save(buffer, format = "PNG", optimize = True)
+        else:
+            raise ValueError(f"Unknown image codec: {codec}")
+    except (OSError, KeyError) as ex:
+        # e.g. modes that PNG/WEBP cannot hold, such as CMYK
+        logger.warning(f"Could not encode {pillow_image.mode} image as {codec}, storing the raw buffer. ERROR MESSAGE: {ex}")
+        return pillow_image.tobytes(), ImageCodec.RAW
+    return buffer.getvalue(), codec
+
+def decode_image(image_bytes: bytes, codec: str, image_mode: str, image_size: Tuple) -> Image.Image:
+    """
+    Inverse of `encode_image`, the returned image has the mode it was stored with.
+    """
+    if codec == ImageCodec.RAW:
+        return Image.frombytes(image_mode, tuple(image_size), image_bytes)
+    image_data = Image.open(io.BytesIO(image_bytes))
+    image_data.load()
+    if image_mode and image_data.mode != image_mode:
+        image_data = image_data.convert(image_mode)
+    return image_data
+
 @dataclass
 class MathSymbolImageRecord:
     image_filename: str|None = None
@@ -51,6 +116,11 @@ class MLCheckpointRecord:
     checkpoint_filename: str|None = None
     date_created: datetime|None = None
     training_file_ids: List[ObjectId]|None = None
+    # hex digest of the checkpoint file, checked on download
+    sha256: str|None = None
+    file_size: int|None = None
+    # the pix2tex config the weights were trained with, so a worker on any node can load them
+    model_config_yaml: str|None = None
     
     def as_intersection_query_filter(self, uid: UintPackedBytes|bytes|None = None) -> dict:
         return dict_to_intersection_query(asdict(self), uid)
@@ -60,19 +130,85 @@ class MathEquationResultRecord:
     input_entry_id: ObjectId|None = None
     is_correct: bool|None = None
     latex_label: str|None = None
+    checkpoint_id: str|None = None
+
+    def as_intersection_query_filter(self, uid: UintPackedBytes|bytes|None = None) -> dict:
+        return dict_to_intersection_query(asdict(self), uid)
+
+@dataclass
+class OCRResultCacheRecord:
+    pixel_hash: str|None = None
+    checkpoint_id: str|None = None
+    latex_label: str|None = None
+    date_created: datetime|None = None
+
+    def as_intersection_query_filter(self, uid: UintPackedBytes|bytes|None = None) -> dict:
+        return dict_to_intersection_query(asdict(self), uid)
+
+@dataclass
+class NotebookEquationRecord:
+    session_key: str|None = None
+    section: str|None = None
+    equation_name: str|None = None
+    author: str|None = None
+    latex: str|None = None
+    result_id: ObjectId|None = None
+    date_modified: datetime|None = None
 
     def as_intersection_query_filter(self, uid: UintPackedBytes|bytes|None = None) -> dict:
         return dict_to_intersection_query(asdict(self), uid)
 
-RecordType: TypeAlias = MathSymbolImageRecord | MLCheckpointRecord | MathEquationResultRecord
+@dataclass
+class TrainingCandidateRecord:
+    file_storage_id: ObjectId|None = None
+    train_label: str|None = None
+    # pending candidates have no batch yet, snapshotting a batch claims them with its id
+    pending: bool|None = None
+    batch_id: ObjectId|None = None
+    date_marked: datetime|None = None
+
+    def as_intersection_query_filter(self, uid: UintPackedBytes|bytes|None = None) -> dict:
+        return dict_to_intersection_query(asdict(self), uid)
+
+@dataclass
+class TrainingJobRecord:
+    batch_id: ObjectId|None = None
+    status: str|None = None
+    train_file_ids: List[ObjectId]|None = None
+    train_latex_labels: List[str]|None = None
+    val_file_ids: List[ObjectId]|None = None
+    val_latex_labels: List[str]|None = None
+    attempts: int = 0
+    worker_id: str|None = None
+    progress: str|None = None
+    error: str|None = None
+    # the MLCheckpointRecord id of the weights the job produced
+    checkpoint_record_id: ObjectId|None = None
+    date_created: datetime|None = None
+    date_started: datetime|None = None
+    date_finished: datetime|None = None
+
+    def as_intersection_query_filter(self, uid: UintPackedBytes|bytes|None = None) -> dict:
+        return dict_to_intersection_query(asdict(self), uid)
+
+RecordType: TypeAlias = MathSymbolImageRecord | MLCheckpointRecord | MathEquationResultRecord | OCRResultCacheRecord \
+    | NotebookEquationRecord
 
 def object_id_query_from_packed(uid: UintPackedBytes) -> ObjectId:
     object_id: ObjectId = object_id_from_packed(uid)
     return dict(_id = object_id)
 
+# the write error code of a unique index violation, DuplicateKeyError outside of bulk writes
+DUPLICATE_KEY_ERROR_CODE: int = 11000
+# GridFS chunks read or written per block when streaming checkpoints
+CHECKPOINT_STREAM_CHUNKS: int = 16
+
 class MathclipsDatabase:
     # going to connect to the standard default mongo client
 
+    # indexes the hot queries of each subclass rely on, created by `ensure_all_indexes` when a service starts
+    indexes: List[IndexModel] = []
+
     def __init__(self, collection_name: str,
                  db: Optional[MongoClient] = None,
                  file_storage: Optional[gridfs.GridFS] = None):
@@ -90,6 +226,14 @@ class MathclipsDatabase:
         # initialize the two primary database collections
         self.collection = self.db[collection_name]
 
+    def ensure_indexes(self) -> List[str]:
+        """
+        Create the declared indexes.  A no-op for the ones that already exist with the same specification.
+        """
+        if not self.indexes:
+            return []
+        return self.collection.create_indexes(self.indexes)
+
     def record_from_id(self, uid: UintPackedBytes):
         return self.collection.find_one(object_id_query_from_packed(uid))
 
@@ -114,12 +258,18 @@ class MathclipsDatabase:
     def insert_many_records(self, records: List[RecordType]) -> List[int]:
         insert_results: InsertManyResult = self.collection.insert_many([asdict(record) for record in records])
         assert insert_results
-        return [packed_from_object_id(id) for id in insert_results.inserted_ids]
+        return [packed_from_object_id(object_id) for object_id in insert_results.inserted_ids]
 
 
 class MathSymbolImageDatabase(MathclipsDatabase):
     
     collection_name: str = "math_symbol_image_data"
+    indexes: List[IndexModel] = [
+        # legacy get_image fallback, and the needs_train update in the train callback
+        IndexModel([("file_storage_id", ASCENDING)], unique = True),
+        # only the handful of images waiting for training are indexed
+        IndexModel([("needs_train", ASCENDING)], partialFilterExpression = {"needs_train": True}),
+    ]
 
     def __init__(self, db: Database = None, file_storage: Optional[gridfs.GridFS] = None):
         super().__init__(db = db, file_storage = file_storage,
@@ -127,6 +277,10 @@ class MathSymbolImageDatabase(MathclipsDatabase):
 
         if file_storage is None and self.file_storage is None:
             self.file_storage = gridfs.GridFS(self.db, self.collection.name)
+        # preprocessed copies of the stored images, each under the GridFS id of its original
+        self.preprocessed_storage = gridfs.GridFS(self.db, self.preprocessed_bucket_name)
+        # re-encoded images waiting to replace their original, see reencode_image
+        self.staging_storage = gridfs.GridFS(self.db, self.staging_bucket_name)
     
     def intersection_query(self,
                     uid: UintPackedBytes|bytes|None = None,
@@ -159,7 +313,9 @@ class MathSymbolImageDatabase(MathclipsDatabase):
                         needs_train: bool = False,
                         equation_name: str = "",
                         equation_section: str = "",
-                        author_name: str = "") -> UintPackedBytes:
+                        author_name: str = "",
+                        codec: str = IMAGE_STORAGE_CODEC,
+                        train_label: str|None = None) -> UintPackedBytes:
         
         file_storage_id: ObjectId
         pillow_image: Image.Image
@@ -167,37 +323,295 @@ class MathSymbolImageDatabase(MathclipsDatabase):
             pillow_image = image
         else:
             pillow_image = Image.open(image)
-        file_storage_id = self.file_storage.put(pillow_image.tobytes(), filename = image_basename)
+        image_bytes, codec = encode_image(pillow_image, codec)
+        file_storage_id = self.file_storage.put(
+            image_bytes, filename = image_basename,
+            metadata = dict(codec = codec, image_mode = pillow_image.mode, image_size = list(pillow_image.size),
+                            pixel_hash = pixel_content_hash(pillow_image)))
         assert ObjectId.is_valid(file_storage_id)
         locals().get('kwargs')
         record = MathSymbolImageRecord(image_filename = image_basename, file_storage_id = file_storage_id,
                                        image_size = pillow_image.size, image_mode = pillow_image.mode,
                                        equation_type = equation_type, needs_train = needs_train,
-                                       equation_name = equation_name, equation_section = equation_section,
+                                       train_label = train_label, equation_name = equation_name,
+                                       equation_section = equation_section,
                                        author_name = author_name)
         record_id = self.insert_single_record(record)
         return packed_from_object_id(file_storage_id)
     
-    def get_image(self, file_id: UintPackedBytes) -> Image|None:
-        formatted_file_id = object_id_from_packed(file_id)
-        image_record = self.collection.find_one(dict(file_storage_id = formatted_file_id),
-                                                projection = dict(image_mode = True, image_size = True))
-        if image_record is None:
-            return None
-        image_file_buffer = self.file_storage.get(formatted_file_id)
-        image_data = Image.frombytes(image_record["image_mode"], image_record["image_size"],
-                                     image_file_buffer.read())
-        filename_path = Path(image_file_buffer.filename)
+    @property
+    def files_collection(self):
+        return self.db[f"{self.collection.name}.files"]
+
+    @property
+    def chunks_collection(self):
+        return self.db[f"{self.collection.name}.chunks"]
+
+    @property
+    def preprocessed_bucket_name(self) -> str:
+        return f"{self.collection.name}_preprocessed"
+
+    @property
+    def staging_bucket_name(self) -> str:
+        return f"{self.collection.name}_staging"
+
+    @staticmethod
+    def _decode_stored_image(image_bytes: bytes, filename: str, file_metadata: dict) -> Image.Image:
+        # files stored before codecs were introduced hold the raw pixel buffer
+        image_data = decode_image(image_bytes, file_metadata.get("codec", ImageCodec.RAW),
+                                  file_metadata["image_mode"], file_metadata["image_size"])
+        if "pixel_hash" in file_metadata:
+            image_data.info["pixel_hash"] = file_metadata["pixel_hash"]
+        filename_path = Path(filename)
         if not filename_path.suffix:
             image_data.info["filename"] = str(filename_path.with_suffix('.png'))
         else:
             image_data.info["filename"] = str(filename_path)
         return image_data
-        
-    
+
+    def _legacy_decode_metadata(self, file_ids: List[ObjectId]) -> dict:
+        """
+        Files written before the decode metadata moved into GridFS need their image record for mode and size.
+        """
+        if not file_ids:
+            return {}
+        image_records = self.collection.find(dict(file_storage_id = {'$in': file_ids}),
+                                             projection = dict(file_storage_id = True,
+                                                               image_mode = True, image_size = True))
+        return {record["file_storage_id"]: dict(image_mode = record["image_mode"],
+                                                image_size = record["image_size"]) for record in image_records}
+
+    def get_image(self, file_id: UintPackedBytes) -> Image|None:
+        formatted_file_id = object_id_from_packed(file_id)
+        try:
+            image_file_buffer = self.file_storage.get(formatted_file_id)
+        except gridfs.NoFile:
+            return None
+        file_metadata: dict = dict(image_file_buffer.metadata or {})
+        if "image_size" not in file_metadata:
+            legacy_metadata = self._legacy_decode_metadata([formatted_file_id])
+            if formatted_file_id not in legacy_metadata:
+                return None
+            file_metadata.update(legacy_metadata[formatted_file_id])
+        return MathSymbolImageDatabase._decode_stored_image(
+            image_file_buffer.read(), image_file_buffer.filename, file_metadata)
+
+    def get_images(self, file_ids: List[UintPackedBytes]) -> List[Image.Image|None]:
+        """
+        Bulk counterpart of `get_image`, resolves every id with one query on the GridFS files collection
+        and one sorted query on its chunks, decoding each image as soon as its last chunk streams past.
+        The result lines up with `file_ids`, with None for ids that are not stored.
+        """
+        object_ids: List[ObjectId] = object_ids_from_packed(file_ids)
+        images = self._fetch_images(self.collection.name, {"_id": {'$in': list(dict.fromkeys(object_ids))}})
+        return [images.get(object_id) for object_id in object_ids]
+
+    def _fetch_images(self, bucket_name: str, files_filter: dict) -> Dict[ObjectId, Image.Image]:
+        """
+        Decode every file of the GridFS bucket matching `files_filter`, keyed on file id.
+        """
+        file_documents = {document["_id"]: document for document in
+                          self.db[f"{bucket_name}.files"].find(files_filter,
+                                                               projection = dict(filename = True, length = True,
+                                                                                 metadata = True))}
+        legacy_ids = [file_id for file_id, document in file_documents.items()
+                      if "image_size" not in (document.get("metadata") or {})]
+        legacy_metadata = self._legacy_decode_metadata(legacy_ids)
+
+        images: dict = {}
+
+        def finish_file(file_id: ObjectId, chunks: List[bytes]):
+            document = file_documents[file_id]
+            file_metadata = dict(document.get("metadata") or {})
+            if file_id in legacy_ids:
+                if file_id not in legacy_metadata:
+                    return
+                file_metadata.update(legacy_metadata[file_id])
+            image_bytes = b"".join(chunks)
+            if len(image_bytes) != document["length"]:
+                logger.error(f"GridFS file {file_id} is missing chunks, skipping it")
+                return
+            images[file_id] = MathSymbolImageDatabase._decode_stored_image(
+                image_bytes, document["filename"], file_metadata)
+
+        current_file_id: ObjectId|None = None
+        current_chunks: List[bytes] = []
+        chunk_cursor = self.db[f"{bucket_name}.chunks"].find({"files_id": {'$in': list(file_documents)}},
+                                                             projection = dict(files_id = True, data = True),
+                                                             sort = [("files_id", ASCENDING), ("n", ASCENDING)])
+        for chunk in chunk_cursor:
+            if chunk["files_id"] != current_file_id:
+                if current_file_id is not None:
+                    finish_file(current_file_id, current_chunks)
+                current_file_id, current_chunks = chunk["files_id"], []
+            current_chunks.append(chunk["data"])
+        if current_file_id is not None:
+            finish_file(current_file_id, current_chunks)
+        # zero-length files have no chunks at all
+        for file_id, document in file_documents.items():
+            if file_id not in images and document["length"] == 0:
+                finish_file(file_id, [])
+        return images
+
+    def get_preprocessed_images(self, file_ids: List[UintPackedBytes],
+                                max_dimensions: Tuple[int, int]) -> List[Image.Image|None]:
+        """
+        The images of `file_ids` as preprocessed for a model with `max_dimensions` (width, height),
+        see mathclips.services.preprocessing.  Preprocessed copies are stored on first use,
+        later calls (retries, other workers, training) fetch those instead of the originals.
+        The result lines up with `file_ids`, with None for ids that are not stored.
+        """
+        key: str = preprocessing_key(max_dimensions)
+        object_ids: List[ObjectId] = object_ids_from_packed(file_ids)
+        unique_ids = list(dict.fromkeys(object_ids))
+        preprocessed_images = self._fetch_images(self.preprocessed_bucket_name,
+                                                 {"_id": {'$in': unique_ids}, "metadata.preprocessing_key": key})
+        missing_ids = [object_id for object_id in unique_ids if object_id not in preprocessed_images]
+        if missing_ids:
+            for object_id, image in zip(missing_ids, self.get_images(
+                    [packed_from_object_id(object_id) for object_id in missing_ids])):
+                if image is None:
+                    continue
+                preprocessed_images[object_id] = preprocess_image(image, max_dimensions)
+                self.store_preprocessed_image(object_id, preprocessed_images[object_id], key)
+            logger.info(f"Preprocessed {len(missing_ids)} of {len(unique_ids)} images")
+        return [preprocessed_images.get(object_id) for object_id in object_ids]
+
+    def store_preprocessed_image(self, file_id: ObjectId, preprocessed_image: Image.Image, key: str):
+        """
+        Store the preprocessed copy of the image `file_id` under `key`, replacing a copy made under another key.
+        The stored pixel hash is the original's, which OCR results are cached under.
+        """
+        image_bytes, codec = encode_image(preprocessed_image)
+        file_metadata = dict(codec = codec, image_mode = preprocessed_image.mode,
+                             image_size = list(preprocessed_image.size), preprocessing_key = key)
+        if "pixel_hash" in preprocessed_image.info:
+            file_metadata["pixel_hash"] = preprocessed_image.info["pixel_hash"]
+        # a copy from an older preprocessing version or for other model dimensions
+        if self.db[f"{self.preprocessed_bucket_name}.files"].find_one(
+                {"_id": file_id, "metadata.preprocessing_key": {'$ne': key}}, projection = dict(_id = True)):
+            self.preprocessed_storage.delete(file_id)
+        try:
+            self.preprocessed_storage.put(image_bytes, _id = file_id,
+                                          filename = preprocessed_image.info.get("filename", str(file_id)),
+                                          metadata = file_metadata)
+        except gridfs.errors.FileExists:
+            # another worker preprocessed the same image at the same time
+            pass
+
+    def get_pixel_hashes(self, file_ids: List[UintPackedBytes]) -> List[str|None]:
+        """
+        The content hashes stored in the GridFS metadata, without fetching any chunks.
+        None for ids that are not stored, and for legacy files stored before hashes were recorded.
+        """
+        object_ids: List[ObjectId] = object_ids_from_packed(file_ids)
+        pixel_hashes = {document["_id"]: (document.get("metadata") or {}).get("pixel_hash") for document in
+                        self.files_collection.find({"_id": {'$in': list(dict.fromkeys(object_ids))}},
+                                                   projection = {"metadata.pixel_hash": True})}
+        return [pixel_hashes.get(object_id) for object_id in object_ids]
+
+    def backfill_file_metadata(self) -> int:
+        """
+        Copy the decode metadata (mode and size) of legacy files from their image records into GridFS,
+        so they can be fetched in a single round trip without re-encoding them.
+        """
+        num_updated: int = 0
+        legacy_files = self.files_collection.find({"metadata.image_size": {'$exists': False}},
+                                                  projection = dict(_id = True))
+        for document in legacy_files:
+            legacy_metadata = self._legacy_decode_metadata([document["_id"]]).get(document["_id"])
+            if legacy_metadata is None:
+                continue
+            self.files_collection.update_one(
+                dict(_id = document["_id"]),
+                {'$set': {"metadata.codec": ImageCodec.RAW,
+                          "metadata.image_mode": legacy_metadata["image_mode"],
+                          "metadata.image_size": list(legacy_metadata["image_size"])}})
+            num_updated += 1
+        return num_updated
+
+    def reencode_image(self, file_id: ObjectId, codec: str = IMAGE_STORAGE_CODEC) -> Tuple[int, int]:
+        """
+        Rewrite one stored image with `codec`, keeping its GridFS id so every reference to it stays valid.
+
+        The new encoding is written to the staging bucket and decoded back first, the original is only
+        deleted once it matches.  Should the process die in between, `recover_staged_images` finishes the swap.
+
+        Returns
+        -------
+        Tuple[int, int]
+            stored size in bytes before and after.
+        """
+        image_file_buffer = self.file_storage.get(file_id)
+        original_size: int = image_file_buffer.length
+        file_metadata: dict = dict(image_file_buffer.metadata or {})
+        current_codec: str = file_metadata.get("codec", ImageCodec.RAW)
+        if current_codec == codec:
+            return original_size, original_size
+
+        decode_metadata: dict = dict(file_metadata)
+        if "image_size" not in decode_metadata:
+            decode_metadata.update(self._legacy_decode_metadata([file_id])[file_id])
+        pillow_image = decode_image(image_file_buffer.read(), current_codec,
+                                    decode_metadata["image_mode"], decode_metadata["image_size"])
+        image_bytes, codec = encode_image(pillow_image, codec)
+        if codec == current_codec:
+            # the requested codec could not hold this image, and it already uses the fallback
+            return original_size, original_size
+        pixel_hash: str = pixel_content_hash(pillow_image)
+        file_metadata.update(codec = codec, image_mode = pillow_image.mode, image_size = list(pillow_image.size),
+                             pixel_hash = pixel_hash)
+        filename: str = image_file_buffer.filename
+
+        # a leftover from an interrupted run is replaced
+        self.staging_storage.delete(file_id)
+        self.staging_storage.put(image_bytes, _id = file_id, filename = filename, metadata = file_metadata)
+        staged_image = decode_image(self.staging_storage.get(file_id).read(), codec,
+                                    file_metadata["image_mode"], file_metadata["image_size"])
+        if pixel_content_hash(staged_image) != pixel_hash:
+            self.staging_storage.delete(file_id)
+            raise ValueError(f"re-encoding image {file_id} with {codec} changed its pixels, kept the original")
+
+        # GridFS files are immutable, so the only way to keep the id is delete then put.
+        self.file_storage.delete(file_id)
+        try:
+            self.file_storage.put(image_bytes, _id = file_id, filename = filename, metadata = file_metadata)
+        except Exception:
+            logger.error(f"Could not replace image {file_id}, its re-encoded copy is kept in "
+                         f"{self.staging_bucket_name} for recover_staged_images")
+            raise
+        self.staging_storage.delete(file_id)
+        return original_size, len(image_bytes)
+
+    def recover_staged_images(self) -> int:
+        """
+        Finish the re-encodes an interrupted `reencode_image` left in the staging bucket: a staged copy whose
+        original was already deleted takes its place, every other staged copy is dropped.
+
+        Returns
+        -------
+        int
+            number of images restored from the staging bucket.
+        """
+        num_restored: int = 0
+        for staged_file in self.staging_storage.find({}, no_cursor_timeout = True):
+            file_id = staged_file._id
+            if not self.file_storage.exists(file_id):
+                self.file_storage.put(staged_file.read(), _id = file_id, filename = staged_file.filename,
+                                      metadata = staged_file.metadata)
+                num_restored += 1
+            self.staging_storage.delete(file_id)
+        return num_restored
+
+
 class MLCheckpointDatabase(MathclipsDatabase):
     
     collection_name: str = "ml_checkpoint_data"
+    indexes: List[IndexModel] = [
+        IndexModel([("file_storage_id", ASCENDING)], unique = True),
+        # newest checkpoint lookup, polled by every resident ML worker
+        IndexModel([("date_created", DESCENDING)]),
+    ]
 
     def __init__(self, db: Optional[Database] = None, file_storage: Optional[gridfs.GridFS] = None):
         super().__init__(db = db, file_storage = file_storage,
@@ -206,26 +620,97 @@ class MLCheckpointDatabase(MathclipsDatabase):
             self.file_storage = gridfs.GridFS(self.db, self.collection.name)
 
     def store_checkpoint_file(self, checkpoint_path: Path, timestamp: datetime,
-                              train_file_ids: List[UintPackedBytes]) -> UintPackedBytes:
-        checkpoint_binary_data: bytes
-        with open(checkpoint_path, 'rb') as file:
-            checkpoint_binary_data = file.read()
-        file_id: ObjectId = self.file_storage.put(checkpoint_binary_data, filename = checkpoint_path.name)
+                              train_file_ids: List[UintPackedBytes],
+                              model_config_path: Path|None = None) -> UintPackedBytes:
+        """
+        Stream the checkpoint into GridFS a few chunks at a time, hashing it on the way,
+        so memory use does not grow with the checkpoint size.
+        """
+        model_config_yaml: str|None = None
+        if model_config_path is not None and Path(model_config_path).exists():
+            model_config_yaml = Path(model_config_path).read_text()
+        checkpoint_hash = hashlib.sha256()
+        file_size: int = 0
+        with self.file_storage.new_file(filename = checkpoint_path.name) as grid_in:
+            with open(checkpoint_path, 'rb') as file:
+                for block in iter(lambda: file.read(grid_in.chunk_size * CHECKPOINT_STREAM_CHUNKS), b""):
+                    checkpoint_hash.update(block)
+                    file_size += len(block)
+                    grid_in.write(block)
+            # extra attributes set before the file is closed are saved on its GridFS document
+            grid_in.sha256 = checkpoint_hash.hexdigest()
+        file_id: ObjectId = grid_in._id
         assert ObjectId.is_valid(file_id)
 
         record = MLCheckpointRecord(
             file_storage_id = file_id,
             checkpoint_filename = checkpoint_path.name,
             date_created = timestamp,
-            training_file_ids = [object_id_from_packed(packed) for packed in train_file_ids])
+            training_file_ids = object_ids_from_packed(train_file_ids),
+            sha256 = checkpoint_hash.hexdigest(),
+            file_size = file_size,
+            model_config_yaml = model_config_yaml)
         return self.insert_single_record(record)
 
+    def download_checkpoint(self, file_id: UintPackedBytes|ObjectId, destination: Path) -> Path:
+        """
+        Stream a checkpoint out of GridFS into a temp file next to `destination`, verify its SHA-256,
+        then rename it into place, so `destination` is either the complete checkpoint or untouched.
+
+        Raises
+        ------
+        IOError
+            when the downloaded bytes do not match the stored digest
+        """
+        if isinstance(file_id, UintPackedBytes):
+            file_id = object_id_from_packed(file_id)
+        checkpoint_record: dict|None = self.collection.find_one(dict(file_storage_id = file_id),
+                                                                projection = dict(sha256 = True))
+        assert checkpoint_record is not None
+        grid_out = self.file_storage.get(file_id)
+        # checkpoints stored before digests were recorded can only be checked for completeness
+        expected_sha256: str|None = checkpoint_record.get("sha256") or getattr(grid_out, "sha256", None)
+
+        destination = Path(destination)
+        destination.parent.mkdir(parents = True, exist_ok = True)
+        file_descriptor, temp_path = tempfile.mkstemp(dir = destination.parent, prefix = f".{destination.name}.")
+        try:
+            checkpoint_hash = hashlib.sha256()
+            num_bytes: int = 0
+            with os.fdopen(file_descriptor, 'wb') as file:
+                # a few GridFS chunks per read, iterating a GridOut would split it on newlines instead
+                block_size: int = grid_out.chunk_size * CHECKPOINT_STREAM_CHUNKS
+                while block := grid_out.read(block_size):
+                    checkpoint_hash.update(block)
+                    num_bytes += len(block)
+                    file.write(block)
+                file.flush()
+                os.fsync(file.fileno())
+            if num_bytes != grid_out.length:
+                raise IOError(f"checkpoint {file_id} is truncated: {num_bytes} of {grid_out.length} bytes")
+            if expected_sha256 is not None and checkpoint_hash.hexdigest() != expected_sha256:
+                raise IOError(f"checkpoint {file_id} failed its SHA-256 check")
+            os.replace(temp_path, destination)
+        except BaseException:
+            Path(temp_path).unlink(missing_ok = True)
+            raise
+        return destination
+
+    def newest_checkpoint_record(self, projection: dict|None = None) -> dict|None:
+        """
+        The most recently promoted checkpoint, records are only written once their weights are promoted.
+        """
+        return self.collection.find_one({}, projection = projection, sort = [("date_created", DESCENDING)])
+
     def get_checkpoint_binary_data(self, file_id: UintPackedBytes) -> Tuple[bytes, str]:
+        """
+        The whole checkpoint in memory, prefer `download_checkpoint` for anything but small files.
+        """
         formatted_file_id = object_id_from_packed(file_id)
-        checkpoint_record: MLCheckpointRecord = self.collection.find_one(dict(file_storage_id = formatted_file_id))
+        checkpoint_record: dict|None = self.collection.find_one(dict(file_storage_id = formatted_file_id))
         assert checkpoint_record is not None
         checkpoint_file_buffer = self.file_storage.get(formatted_file_id)
-        return checkpoint_file_buffer.read(), checkpoint_record.checkpoint_filename
+        return checkpoint_file_buffer.read(), checkpoint_record["checkpoint_filename"]
 
     def intersection_query(self, uid: UintPackedBytes|None = None,
                            file_storage_id: UintPackedBytes|None = None,
@@ -236,13 +721,20 @@ class MLCheckpointDatabase(MathclipsDatabase):
         record = MLCheckpointRecord(
             file_storage_id = object_id_from_packed(file_storage_id),
             checkpoint_filename = checkpoint_filename, date_created = date_created,
-            training_file_ids = [object_id_from_packed(id) for id in training_file_ids])
+            training_file_ids = object_ids_from_packed(training_file_ids))
         return self.collection.find(record.as_intersection_query_filter(uid))
 
 
 class MathSymbolResultDatabase(MathclipsDatabase):
     
     collection_name: str = "math_equation_result_data"
+    indexes: List[IndexModel] = [
+        IndexModel([("input_entry_id", ASCENDING)]),
+        # results written before upserts were introduced have no checkpoint id (missing or null), and may be
+        # duplicated, the partial filter keeps them from blocking the index build.
+        IndexModel([("input_entry_id", ASCENDING), ("checkpoint_id", ASCENDING)], unique = True,
+                   partialFilterExpression = {"checkpoint_id": {'$type': "string"}}),
+    ]
 
     def __init__(self, db: Optional[Database] = None):
         super().__init__(db = db, collection_name = MathSymbolResultDatabase.collection_name)
@@ -250,13 +742,432 @@ class MathSymbolResultDatabase(MathclipsDatabase):
     def intersection_query(self, uid: UintPackedBytes|None = None,
                            input_entry_id: UintPackedBytes|None = None,
                            is_correct: bool|None = None,
-                           latex_label: str|None = None) -> dict:
+                           latex_label: str|None = None,
+                           checkpoint_id: str|None = None) -> dict:
         record = MathEquationResultRecord(input_entry_id = object_id_from_packed(input_entry_id),
-                                          is_correct = is_correct, latex_label = latex_label)
+                                          is_correct = is_correct, latex_label = latex_label,
+                                          checkpoint_id = checkpoint_id)
         return self.collection.find(record.as_intersection_query_filer(uid))
     
-    def store_result(self, latex_result: str, input_id: UintPackedBytes, correct: bool) -> UintPackedBytes:
+    def upsert_result(self, latex_result: str, input_id: UintPackedBytes, checkpoint_id: str,
+                      correct: bool) -> UintPackedBytes:
+        """
+        Store the OCR result for an input image.  There is at most one result per input image and checkpoint,
+        so a redelivered message updates the existing record and gets the same id back.
+        """
         record = MathEquationResultRecord(input_entry_id = object_id_from_packed(input_id),
                                           is_correct = correct,
-                                          latex_label = latex_result)
-        return self.insert_single_record(record)
+                                          latex_label = latex_result,
+                                          checkpoint_id = checkpoint_id)
+        result_key = dict(input_entry_id = record.input_entry_id, checkpoint_id = checkpoint_id)
+        for attempt in range(2):
+            try:
+                result_record = self.collection.find_one_and_update(
+                    result_key, {'$set': asdict(record)}, upsert = True,
+                    projection = dict(_id = True), return_document = ReturnDocument.AFTER)
+                return packed_from_object_id(result_record["_id"])
+            except DuplicateKeyError:
+                # two workers upserted the same key at once, the retry finds the winner's document
+                if attempt:
+                    raise
+
+
+class OCRResultCacheDatabase(MathclipsDatabase):
+    """
+    Content addressed OCR results, keyed on the hash of the decoded pixels and the checkpoint that produced them.
+    Lets the ML pipeline skip inference when the same image gets uploaded again.
+    """
+
+    collection_name: str = "math_equation_ocr_cache"
+    indexes: List[IndexModel] = [
+        IndexModel([("pixel_hash", ASCENDING), ("checkpoint_id", ASCENDING)], unique = True),
+        # invalidation deletes by checkpoint
+        IndexModel([("checkpoint_id", ASCENDING)]),
+    ]
+
+    def __init__(self, db: Optional[Database] = None):
+        super().__init__(db = db, collection_name = OCRResultCacheDatabase.collection_name)
+
+    def lookup(self, pixel_hash: str, checkpoint_id: str) -> str|None:
+        cache_record = self.collection.find_one(dict(pixel_hash = pixel_hash, checkpoint_id = checkpoint_id),
+                                                projection = dict(latex_label = True))
+        return cache_record["latex_label"] if cache_record is not None else None
+
+    def store(self, pixel_hash: str, checkpoint_id: str, latex_label: str):
+        record = OCRResultCacheRecord(pixel_hash = pixel_hash, checkpoint_id = checkpoint_id,
+                                      latex_label = latex_label, date_created = datetime.now())
+        self.collection.update_one(dict(pixel_hash = pixel_hash, checkpoint_id = checkpoint_id),
+                                   {'$set': asdict(record)}, upsert = True)
+
+    def invalidate(self, keep_checkpoint_id: str|None = None) -> int:
+        """
+        Drop every cached result that was not produced by `keep_checkpoint_id` (all of them if None).
+        """
+        cache_filter = {} if keep_checkpoint_id is None else dict(checkpoint_id = {'$ne': keep_checkpoint_id})
+        return self.collection.delete_many(cache_filter).deleted_count
+
+
+class NotebookDatabase(MathclipsDatabase):
+    """
+    The equation notebook rendered by the front end, one document per equation.
+    Replaces rewriting the whole YAML notebook for every result, each result is a single document upsert
+    and the front end only loads the section it displays.
+    """
+
+    collection_name: str = "notebook_equation_data"
+    default_session_key: str = "default"
+    # the unique key doubles as the per-section index the front end reads with
+    indexes: List[IndexModel] = [
+        IndexModel([("session_key", ASCENDING), ("section", ASCENDING), ("equation_name", ASCENDING)],
+                   unique = True),
+    ]
+
+    def __init__(self, db: Optional[Database] = None):
+        super().__init__(db = db, collection_name = NotebookDatabase.collection_name)
+
+    @staticmethod
+    def equation_key(section: str, equation_name: str, session_key: str = default_session_key) -> dict:
+        return dict(session_key = session_key, section = section, equation_name = equation_name)
+
+    @staticmethod
+    def upsert_operation(section: str, equation_name: str, author: str, latex: str,
+                         result_id: UintPackedBytes|ObjectId|None,
+                         session_key: str = default_session_key) -> UpdateOne:
+        if isinstance(result_id, UintPackedBytes):
+            result_id = object_id_from_packed(result_id)
+        record = NotebookEquationRecord(session_key = session_key, section = section, equation_name = equation_name,
+                                        author = author, latex = latex, result_id = result_id,
+                                        date_modified = datetime.now())
+        return UpdateOne(NotebookDatabase.equation_key(section, equation_name, session_key),
+                         {'$set': asdict(record)}, upsert = True)
+
+    def upsert_equation(self, section: str, equation_name: str, author: str, latex: str,
+                        result_id: UintPackedBytes|ObjectId|None, session_key: str = default_session_key):
+        self.bulk_upsert([NotebookDatabase.upsert_operation(section, equation_name, author, latex,
+                                                            result_id, session_key)])
+
+    def bulk_upsert(self, operations: List[UpdateOne]):
+        """
+        Apply many `upsert_operation`s in one round trip.
+        Ordered, so the later of two results for the same equation wins, like applying them one by one.
+        """
+        if operations:
+            self.collection.bulk_write(operations, ordered = True)
+
+    def sections(self, session_key: str = default_session_key) -> List[str]:
+        return sorted(self.collection.distinct("section", dict(session_key = session_key)))
+
+    def equations_in_section(self, section: str, session_key: str = default_session_key) -> List[dict]:
+        return list(self.collection.find(dict(session_key = session_key, section = section),
+                                         sort = [("equation_name", ASCENDING)]))
+
+    def delete_equation(self, section: str, equation_name: str, session_key: str = default_session_key):
+        self.collection.delete_one(NotebookDatabase.equation_key(section, equation_name, session_key))
+
+    def as_nested_dict(self, session_key: str = default_session_key) -> Dict:
+        """
+        The notebook in the layout of the legacy YAML file: section -> equation name -> equation data.
+        """
+        notebook: Dict = {}
+        equations: List[dict] = list(self.collection.find(
+            dict(session_key = session_key), sort = [("section", ASCENDING), ("equation_name", ASCENDING)]))
+        for equation in equations:
+            packed_id = packed_from_object_id(equation["result_id"]) if equation.get("result_id") is not None \
+                else UintPackedBytes()
+            notebook.setdefault(equation["section"], {})[equation["equation_name"]] = dict(
+                author = equation["author"], latex = equation["latex"],
+                db_id = dict(first_bits = packed_id.first_bits, last_bits = packed_id.last_bits))
+        return notebook
+
+    def import_nested_dict(self, notebook: Dict, session_key: str = default_session_key) -> int:
+        """
+        Inverse of `as_nested_dict`, used to seed the collection from an existing YAML notebook.
+        """
+        operations: List[UpdateOne] = []
+        for section, equations in (notebook or {}).items():
+            for equation_name, equation_data in (equations or {}).items():
+                db_id = equation_data.get("db_id") or {}
+                result_id = object_id_from_packed(UintPackedBytes(first_bits = int(db_id.get("first_bits", 0)),
+                                                                  last_bits = int(db_id.get("last_bits", 0))))
+                operations.append(NotebookDatabase.upsert_operation(
+                    str(section), str(equation_name), equation_data.get("author"), equation_data.get("latex"),
+                    result_id, session_key))
+        self.bulk_upsert(operations)
+        return len(operations)
+
+
+class TrainingCandidateDatabase(MathclipsDatabase):
+    """
+    Images labelled for training that have not been trained on yet, plus a counter of the pending ones.
+    The counter is maintained with atomic `$inc`s so the train consumer can check batch readiness
+    without counting the image collection on every request.
+    A batch is snapshotted by claiming the pending candidates with a batch id, anything marked afterwards
+    stays pending and carries over to the next batch.
+    """
+
+    collection_name: str = "training_candidate_data"
+    counter_collection_name: str = "training_candidate_counters"
+    pending_counter_id: str = "pending"
+    indexes: List[IndexModel] = [
+        # at most one pending candidate per image, re-labelling an image updates it in place
+        IndexModel([("file_storage_id", ASCENDING)], unique = True,
+                   partialFilterExpression = dict(pending = True)),
+        # snapshotting claims every pending candidate, the partial index only holds those
+        IndexModel([("pending", ASCENDING)], partialFilterExpression = dict(pending = True)),
+        IndexModel([("batch_id", ASCENDING)]),
+    ]
+
+    def __init__(self, db: Optional[Database] = None):
+        super().__init__(db = db, collection_name = TrainingCandidateDatabase.collection_name)
+        self.counters = self.db[TrainingCandidateDatabase.counter_collection_name]
+
+    def _add_to_pending_count(self, amount: int) -> int:
+        counter = self.counters.find_one_and_update(
+            dict(_id = TrainingCandidateDatabase.pending_counter_id),
+            {'$inc': dict(count = amount)},
+            upsert = True, return_document = ReturnDocument.AFTER)
+        return int(counter["count"])
+
+    def pending_count(self) -> int:
+        counter = self.counters.find_one(dict(_id = TrainingCandidateDatabase.pending_counter_id))
+        return int(counter["count"]) if counter is not None else 0
+
+    def mark_candidate(self, file_storage_id: ObjectId, train_label: str) -> int:
+        """
+        Mark an image for training with `train_label`.  Only a newly pending image bumps the counter.
+
+        Returns
+        -------
+        int
+            the number of pending candidates after marking
+        """
+        candidate_filter = dict(file_storage_id = file_storage_id, pending = True)
+        update = {'$set': dict(train_label = train_label, date_marked = datetime.now()),
+                  '$setOnInsert': dict(batch_id = None)}
+        try:
+            result = self.collection.update_one(candidate_filter, update, upsert = True)
+        except DuplicateKeyError:
+            # a concurrent mark inserted the same image first, ours becomes a label update
+            result = self.collection.update_one(candidate_filter, update, upsert = False)
+        if result.upserted_id is not None:
+            return self._add_to_pending_count(1)
+        return self.pending_count()
+
+    def bulk_mark_candidates(self, labels_by_file_id: Dict[ObjectId, str]) -> int:
+        """
+        `mark_candidate` for many images in one round trip.
+        """
+        if not labels_by_file_id:
+            return self.pending_count()
+        marked_at = datetime.now()
+        updates = [(dict(file_storage_id = file_id, pending = True),
+                    {'$set': dict(train_label = label, date_marked = marked_at),
+                     '$setOnInsert': dict(batch_id = None)})
+                   for file_id, label in labels_by_file_id.items()]
+        try:
+            num_upserted: int = self.collection.bulk_write(
+                [UpdateOne(*update, upsert = True) for update in updates], ordered = False).upserted_count
+        except BulkWriteError as ex:
+            duplicates = [error for error in ex.details["writeErrors"] if error["code"] == DUPLICATE_KEY_ERROR_CODE]
+            if len(duplicates) < len(ex.details["writeErrors"]):
+                raise
+            # concurrent marks inserted these images first, ours become label updates
+            num_upserted = len(ex.details["upserted"])
+            self.collection.bulk_write([UpdateOne(*updates[error["index"]]) for error in duplicates], ordered = False)
+        if num_upserted:
+            return self._add_to_pending_count(num_upserted)
+        return self.pending_count()
+
+    def snapshot_batch(self, batch_id: ObjectId) -> List[dict]:
+        """
+        Claim every currently pending candidate for `batch_id` and return the claimed candidates.
+        """
+        claimed = self.collection.update_many(dict(pending = True),
+                                              {'$set': dict(pending = False, batch_id = batch_id)})
+        if claimed.modified_count:
+            self._add_to_pending_count(-claimed.modified_count)
+        return list(self.collection.find(dict(batch_id = batch_id)))
+
+    def pending_file_ids(self, file_storage_ids: List[ObjectId]) -> List[ObjectId]:
+        """
+        The subset of `file_storage_ids` that are (again) pending, i.e. were re-marked after a snapshot.
+        """
+        return [candidate["file_storage_id"] for candidate in self.collection.find(
+            dict(file_storage_id = {'$in': file_storage_ids}, pending = True),
+            projection = dict(file_storage_id = True))]
+
+    def marked_file_ids(self, file_storage_ids: List[ObjectId]) -> List[ObjectId]:
+        """
+        The subset of `file_storage_ids` with a candidate, pending or claimed by a batch that has not completed.
+        Their image records keep `needs_train` until the batch completes.
+        """
+        return [candidate["file_storage_id"] for candidate in self.collection.find(
+            {"file_storage_id": {'$in': file_storage_ids},
+             '$or': [dict(pending = True), {"batch_id": {'$ne': None}}]},
+            projection = dict(file_storage_id = True))]
+
+    def complete_batch(self, batch_id: ObjectId) -> int:
+        return self.collection.delete_many(dict(batch_id = batch_id)).deleted_count
+
+    def release_batch(self, batch_id: ObjectId) -> int:
+        """
+        Put the candidates of a batch that did not train back in the pending set.
+        An image that was re-marked since the snapshot keeps its newer label.
+        """
+        released = 0
+        for candidate in self.collection.find(dict(batch_id = batch_id)):
+            try:
+                self.collection.update_one(dict(_id = candidate["_id"]),
+                                           {'$set': dict(pending = True, batch_id = None)})
+                released += 1
+            except DuplicateKeyError:
+                self.collection.delete_one(dict(_id = candidate["_id"]))
+        if released:
+            self._add_to_pending_count(released)
+        return released
+
+    def recount(self) -> int:
+        """
+        Rebuild the counter from the collection, e.g. after a crash between a claim and its `$inc`.
+        """
+        count = self.collection.count_documents(dict(pending = True))
+        self.counters.update_one(dict(_id = TrainingCandidateDatabase.pending_counter_id),
+                                 {'$set': dict(count = count)}, upsert = True)
+        return count
+
+    def seed_from_images(self, image_db: MathSymbolImageDatabase) -> int:
+        """
+        Add a pending candidate for every image still flagged `needs_train` (records marked before this
+        collection existed) and resync the counter.
+        """
+        labels_by_file_id = {record["file_storage_id"]: record["train_label"] for record in
+                             image_db.collection.find(dict(needs_train = True),
+                                                      projection = dict(file_storage_id = True, train_label = True))}
+        already_marked = set(self.marked_file_ids(list(labels_by_file_id.keys())))
+        self.bulk_mark_candidates({file_id: label for file_id, label in labels_by_file_id.items()
+                                   if file_id not in already_marked})
+        return self.recount()
+
+
+class TrainingJobDatabase(MathclipsDatabase):
+    """
+    Queued, running and finished training runs, plus the lease that keeps two runs from overlapping.
+
+    A job is claimed by one worker at a time, but a worker only claims jobs while it holds the training lease,
+    a single document in a separate collection with an expiry the holder keeps pushing forward.
+    If the holder dies the lease expires and the next worker picks up its orphaned job.
+    """
+
+    collection_name: str = "training_job_data"
+    lease_collection_name: str = "training_job_leases"
+    training_lease_id: str = "training"
+    indexes: List[IndexModel] = [
+        # claiming takes the oldest queued job, status pages list the newest jobs
+        IndexModel([("status", ASCENDING), ("date_created", ASCENDING)]),
+        IndexModel([("date_created", DESCENDING)]),
+        IndexModel([("batch_id", ASCENDING)], unique = True),
+    ]
+
+    def __init__(self, db: Optional[Database] = None):
+        super().__init__(db = db, collection_name = TrainingJobDatabase.collection_name)
+        self.leases = self.db[TrainingJobDatabase.lease_collection_name]
+
+    def enqueue(self, record: TrainingJobRecord) -> ObjectId:
+        record.status = TrainingJobStatus.QUEUED
+        record.progress = "queued"
+        record.date_created = datetime.now()
+        return self.collection.insert_one(asdict(record)).inserted_id
+
+    def claim_next(self, worker_id: str) -> dict|None:
+        """
+        Atomically move the oldest queued job to running.  Only call while holding the training lease.
+        """
+        return self.collection.find_one_and_update(
+            dict(status = TrainingJobStatus.QUEUED),
+            {'$set': dict(status = TrainingJobStatus.RUNNING, worker_id = worker_id, progress = "starting",
+                          date_started = datetime.now()),
+             '$inc': dict(attempts = 1)},
+            sort = [("date_created", ASCENDING)], return_document = ReturnDocument.AFTER)
+
+    def set_progress(self, job_id: ObjectId, progress: str):
+        self.collection.update_one(dict(_id = job_id), {'$set': dict(progress = progress)})
+
+    def finish(self, job_id: ObjectId, status: str, error: str|None = None,
+               checkpoint_record_id: ObjectId|None = None):
+        self.collection.update_one(dict(_id = job_id), {'$set': dict(
+            status = status, progress = status, error = error, checkpoint_record_id = checkpoint_record_id,
+            date_finished = datetime.now())})
+
+    def recover_orphaned(self, max_attempts: int = TRAIN_JOB_MAX_ATTEMPTS) -> List[dict]:
+        """
+        Jobs left running by a worker that lost the lease go back in the queue, unless they used up
+        their attempts.  Only call while holding the training lease, no other job can legitimately be running.
+
+        Returns
+        -------
+        List[dict]
+            the jobs that were marked failed, their training candidates still need releasing
+        """
+        failed_jobs: List[dict] = []
+        for job in self.collection.find(dict(status = TrainingJobStatus.RUNNING)):
+            if job["attempts"] >= max_attempts:
+                self.finish(job["_id"], TrainingJobStatus.FAILED,
+                            error = f"worker {job['worker_id']} lost the training lease {job['attempts']} times")
+                failed_jobs.append(job)
+            else:
+                self.collection.update_one(dict(_id = job["_id"], status = TrainingJobStatus.RUNNING),
+                                           {'$set': dict(status = TrainingJobStatus.QUEUED, progress = "requeued",
+                                                         worker_id = None)})
+        return failed_jobs
+
+    def get_job(self, job_id: ObjectId) -> dict|None:
+        return self.collection.find_one(dict(_id = job_id))
+
+    def recent_jobs(self, limit: int = 20) -> List[dict]:
+        return list(self.collection.find({}, sort = [("date_created", DESCENDING)], limit = limit))
+
+    def acquire_lease(self, holder: str, duration_s: float) -> bool:
+        """
+        Take the training lease if it is free or expired, or extend it if `holder` already has it.
+        """
+        now = datetime.now(timezone.utc)
+        try:
+            self.leases.find_one_and_update(
+                {'_id': TrainingJobDatabase.training_lease_id,
+                 '$or': [dict(holder = holder), dict(expires_at = {'$lt': now})]},
+                {'$set': dict(holder = holder, expires_at = now + timedelta(seconds = duration_s))},
+                upsert = True)
+        except DuplicateKeyError:
+            # the lease document exists and is held by someone else, so the upsert tried a second insert
+            return False
+        return True
+
+    def renew_lease(self, holder: str, duration_s: float) -> bool:
+        result = self.leases.update_one(
+            dict(_id = TrainingJobDatabase.training_lease_id, holder = holder),
+            {'$set': dict(expires_at = datetime.now(timezone.utc) + timedelta(seconds = duration_s))})
+        return result.matched_count == 1
+
+    def release_lease(self, holder: str):
+        self.leases.delete_one(dict(_id = TrainingJobDatabase.training_lease_id, holder = holder))
+
+    def lease_holder(self) -> dict|None:
+        return self.leases.find_one(dict(_id = TrainingJobDatabase.training_lease_id))
+
+
+def ensure_all_indexes(db: Optional[Database] = None) -> Dict[str, List[str]]:
+    """
+    Create the declared indexes of every collection, once when a service starts.  The database classes are also
+    built at import time, so their constructors never talk to the server.
+
+    Returns
+    -------
+    Dict[str, List[str]]
+        the index names per collection.
+    """
+    image_db = MathSymbolImageDatabase(db = db)
+    databases: List[MathclipsDatabase] = [image_db] + [
+        database_class(db = image_db.db) for database_class in (
+            MathSymbolResultDatabase, MLCheckpointDatabase, OCRResultCacheDatabase, NotebookDatabase,
+            TrainingCandidateDatabase, TrainingJobDatabase)]
+    return {database.collection.name: database.ensure_indexes() for database in databases}
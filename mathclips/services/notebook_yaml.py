@@ -0,0 +1,59 @@
+"""
+Move the equation notebook between mongo and the legacy YAML notebook file.
+
+usage:
+    python -m mathclips.services.notebook_yaml export [--path notebook.yml]
+    python -m mathclips.services.notebook_yaml import [--path notebook.yml]
+"""
+import argparse
+from pathlib import Path
+
+import yaml
+
+import mathclips.front_end
+from mathclips.services.logger import logger
+from mathclips.services.mongodb import NotebookDatabase
+from mathclips.services.util import atomic_write_yaml
+
+def export_notebook(notebook_db: NotebookDatabase, config_path: Path,
+                    session_key: str = NotebookDatabase.default_session_key):
+    atomic_write_yaml(notebook_db.as_nested_dict(session_key), config_path)
+    logger.info(f"Exported notebook to: {config_path}")
+
+def import_notebook(notebook_db: NotebookDatabase, config_path: Path,
+                    session_key: str = NotebookDatabase.default_session_key) -> int:
+    with open(config_path, 'r') as config_file:
+        notebook = yaml.safe_load(config_file)
+    num_equations: int = notebook_db.import_nested_dict(notebook, session_key)
+    logger.info(f"Imported {num_equations} equations from: {config_path}")
+    return num_equations
+
+def import_notebook_if_empty(notebook_db: NotebookDatabase,
+                             config_path: Path = mathclips.front_end.notebook_config_path,
+                             session_key: str = NotebookDatabase.default_session_key) -> int:
+    """
+    Seed the notebook collection from the YAML notebook the first time the services start after the upgrade,
+    so the equations of an existing notebook are not lost.  Upserts, so two services starting at once is harmless.
+
+    Returns
+    -------
+    The number of equations imported, 0 once the session has any equation in mongo.
+    """
+    if not config_path.exists() or notebook_db.collection.find_one(dict(session_key = session_key)) is not None:
+        return 0
+    return import_notebook(notebook_db, config_path, session_key)
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("direction", choices = ("export", "import"))
+    parser.add_argument("--path", type = Path, default = mathclips.front_end.notebook_config_path)
+    parser.add_argument("--session", default = NotebookDatabase.default_session_key)
+    args = parser.parse_args()
+    notebook_db = NotebookDatabase()
+    if args.direction == "export":
+        export_notebook(notebook_db, args.path, args.session)
+    else:
+        import_notebook(notebook_db, args.path, args.session)
+
+if __name__ == "__main__":
+    main()
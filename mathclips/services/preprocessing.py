@@ -0,0 +1,128 @@
+"""
+Vectorized preprocessing of stored images before they reach the OCR model.
+
+Uploads are much larger than the equation they hold: the draw widget sends its whole 800x200 RGBA canvas,
+mostly transparent background, and digital uploads can be full screenshots.  LatexOCR's own preprocessing
+(`pix2tex.utils.pad` and the resizer loop) works on the whole image, so each image is first reduced to its ink
+with a few NumPy passes: grayscale with alpha dropped, cropped to the bounding box of the ink, and downscaled to
+fit the model's maximum input size.  What counts as ink follows `pad`, so an image already within the maximum
+size reaches the model as the same crop `pad` would have made of it.
+
+The preprocessed images are stored next to the originals under `preprocessing_key`
+(see `MathSymbolImageDatabase.get_preprocessed_images`), so retries and retraining reuse them.
+"""
+from __future__ import annotations
+
+from typing import Sequence, Tuple
+
+import numpy as np
+from PIL import Image
+
+# bump whenever the output of preprocess_image changes, stored preprocessed images are keyed on it
+PREPROCESSING_VERSION: int = 1
+# threshold of pix2tex.utils.pad, on pixels normalized to the full 0-255 range
+INK_THRESHOLD: int = 128
+# image info carried over to the preprocessed image
+KEPT_IMAGE_INFO = ("filename", "pixel_hash")
+
+def preprocessing_key(max_dimensions: Sequence[int]) -> str:
+    """
+    Identifies the preprocessed form of an image for a model with `max_dimensions` (width, height).
+    """
+    return f"v{PREPROCESSING_VERSION}-{int(max_dimensions[0])}x{int(max_dimensions[1])}"
+
+def grayscale_array(image: Image.Image) -> np.ndarray:
+    """
+    height x width uint8 pixels.  Like `pad`, an image whose alpha varies is read from its alpha channel alone
+    (strokes drawn on a transparent canvas), any other image from its luminance.
+    """
+    if image.mode not in ("L", "LA", "RGB", "RGBA"):
+        has_alpha = "A" in image.getbands() or "transparency" in image.info
+        image = image.convert("RGBA" if has_alpha else "L")
+    pixels = np.asarray(image)
+    if pixels.ndim == 2:
+        return pixels
+    if image.mode in ("LA", "RGBA"):
+        alpha = pixels[..., -1]
+        if alpha.min() != alpha.max():
+            return 255 - alpha
+        pixels = pixels[..., :-1]
+    if pixels.shape[-1] == 1:
+        return pixels[..., 0]
+    # ITU-R 601-2 luma with the same rounding as Image.convert("L")
+    luma = pixels[..., 0].astype(np.uint32) * 299 + pixels[..., 1].astype(np.uint32) * 587 \
+        + pixels[..., 2].astype(np.uint32) * 114
+    return ((luma + 500) // 1000).astype(np.uint8)
+
+def ink_bounding_box(ink: np.ndarray) -> Tuple[slice, slice]|None:
+    """
+    Row and column slices of the smallest box holding every True pixel of `ink`, None if there are none.
+    """
+    rows = np.flatnonzero(ink.any(axis = 1))
+    if rows.size == 0:
+        return None
+    columns = np.flatnonzero(ink.any(axis = 0))
+    return slice(rows[0], rows[-1] + 1), slice(columns[0], columns[-1] + 1)
+
+def crop_to_ink(gray: np.ndarray) -> np.ndarray:
+    """
+    Crop to the ink and stretch the contrast to 0-255, as dark ink on a light background.
+    Blank images are returned as they are.
+    """
+    low, high = int(gray.min()), int(gray.max())
+    if low == high:
+        return gray
+    # pad normalizes the whole image and then thresholds it, thresholding the raw pixels at the equivalent level
+    # only leaves the crop to be normalized
+    threshold = low + INK_THRESHOLD * (high - low) / 255.0
+    dark_background: bool = gray.mean() <= threshold
+    ink = gray > threshold if dark_background else gray < threshold
+    bounding_box = ink_bounding_box(ink)
+    if bounding_box is None:
+        return gray
+    crop = (gray[bounding_box].astype(np.float32) - low) * (255.0 / (high - low))
+    if dark_background:
+        crop = 255.0 - crop
+    return np.rint(crop).astype(np.uint8)
+
+def downscale(gray: np.ndarray, max_dimensions: Sequence[int]) -> np.ndarray:
+    """
+    Shrink to fit within `max_dimensions` (width, height), to the size `pix2tex.cli.minmax_size` would.
+    Whole factors are taken with a box filter over the blocks of pixels, the remainder with a bilinear resize.
+    """
+    height, width = gray.shape
+    ratio = max(width / max_dimensions[0], height / max_dimensions[1])
+    if ratio <= 1:
+        return gray
+    target_width, target_height = max(1, int(width // ratio)), max(1, int(height // ratio))
+    # never more than the short side, a sliver of a few pixels is left to the resize
+    factor = min(int(ratio), height, width)
+    if factor >= 2:
+        # the ragged last rows and columns are dropped, less than one output pixel
+        height, width = height // factor * factor, width // factor * factor
+        gray = np.rint(gray[:height, :width].reshape(height // factor, factor, width // factor, factor)
+                       .mean(axis = (1, 3))).astype(np.uint8)
+    if gray.shape != (target_height, target_width):
+        gray = np.asarray(Image.fromarray(gray).resize((target_width, target_height), Image.Resampling.BILINEAR))
+    return gray
+
+def pad_to_min_dimensions(pixels: np.ndarray, min_dimensions: Sequence[int]) -> np.ndarray:
+    """
+    Pad with white on the right and bottom to at least `min_dimensions` (width, height), as `pix2tex.cli.minmax_size`
+    does before inference.  Crops of short or thin equations are often smaller.
+    """
+    height, width = pixels.shape[:2]
+    pad_height, pad_width = max(0, min_dimensions[1] - height), max(0, min_dimensions[0] - width)
+    if not pad_height and not pad_width:
+        return pixels
+    padding = [(0, pad_height), (0, pad_width)] + [(0, 0)] * (pixels.ndim - 2)
+    return np.pad(pixels, padding, constant_values = 255)
+
+def preprocess_image(image: Image.Image, max_dimensions: Sequence[int]) -> Image.Image:
+    """
+    Grayscale ("L") copy of `image` cropped to its ink and fit within `max_dimensions` (width, height).
+    The filename and pixel hash of the original are kept in its info, results stay cached under the original's hash.
+    """
+    preprocessed = Image.fromarray(downscale(crop_to_ink(grayscale_array(image)), max_dimensions))
+    preprocessed.info.update({key: image.info[key] for key in KEPT_IMAGE_INFO if key in image.info})
+    return preprocessed
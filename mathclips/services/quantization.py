@@ -0,0 +1,141 @@
+"""
+int8 inference backend for the OCR model, plus a harness comparing it with fp32 on the stored labelled images.
+
+The quantized copy is a dynamically quantized (`torch.quantization.quantize_dynamic`) version of the
+LatexOCR encoder/decoder: the weights of every Linear layer stored as int8, activations quantized on the fly.
+Only the transformer layers are affected, the convolutional backbone of the hybrid encoder stays fp32.
+It is built once when weights are promoted (by the training process, and by each node as it fetches a checkpoint)
+and saved as a state dict that workers load on top of the quantized module structure.
+
+usage:
+    python -m mathclips.services.quantization --compare [--limit 200]
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import statistics
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+
+import torch
+from pix2tex.cli import LatexOCR
+
+from mathclips.services.logger import logger
+
+QUANTIZED_LAYER_TYPES = {torch.nn.Linear}
+
+def quantize_ocr_model(ocr_model: LatexOCR, quantized_state_path: Path|None = None) -> LatexOCR:
+    """
+    Swap the model of `ocr_model` for its dynamically quantized copy, in place.
+    With `quantized_state_path`, the prebuilt quantized weights are loaded instead of quantizing the fp32 ones.
+    """
+    quantized_model = torch.quantization.quantize_dynamic(ocr_model.model, QUANTIZED_LAYER_TYPES, dtype = torch.qint8)
+    if quantized_state_path is not None:
+        quantized_model.load_state_dict(torch.load(quantized_state_path, map_location = "cpu"))
+    quantized_model.eval()
+    ocr_model.model = quantized_model
+    return ocr_model
+
+def save_quantized_weights(ocr_model: LatexOCR, out_path: Path):
+    """
+    Quantize a loaded fp32 model and save the quantized state dict, atomically so a worker never loads half of it.
+    """
+    out_path = Path(out_path)
+    quantized_model = torch.quantization.quantize_dynamic(ocr_model.model, QUANTIZED_LAYER_TYPES, dtype = torch.qint8)
+    file_descriptor, temp_name = tempfile.mkstemp(dir = out_path.parent, prefix = f".{out_path.name}.", suffix = ".tmp")
+    os.close(file_descriptor)
+    try:
+        torch.save(quantized_model.state_dict(), temp_name)
+        os.replace(temp_name, out_path)
+    except BaseException:
+        Path(temp_name).unlink(missing_ok = True)
+        raise
+    logger.info(f"Saved int8 OCR weights to: {out_path}")
+
+def token_accuracy(predicted_tokens: List[str], label_tokens: List[str]) -> float:
+    """
+    Fraction of positions where the predicted token matches the label, over the longer of the two sequences.
+    """
+    length = max(len(predicted_tokens), len(label_tokens))
+    if length == 0:
+        return 1.0
+    return sum(p == l for p, l in zip(predicted_tokens, label_tokens)) / length
+
+def labelled_samples(limit: int) -> List[Tuple[object, str]]:
+    """
+    (GridFS id, latex label) pairs: images re-labelled by users, and results users confirmed as correct.
+    """
+    from mathclips.services.image_to_equation_interface import MLPipelineInterface
+
+    samples: Dict[object, str] = {}
+    for record in MLPipelineInterface.image_db.collection.find(
+            {"train_label": {'$nin': [None, ""]}}, projection = dict(file_storage_id = True, train_label = True),
+            limit = limit):
+        samples[record["file_storage_id"]] = record["train_label"]
+    if len(samples) < limit:
+        for result in MLPipelineInterface.result_db.collection.find(
+                dict(is_correct = True), projection = dict(input_entry_id = True, latex_label = True),
+                limit = limit - len(samples)):
+            samples.setdefault(result["input_entry_id"], result["latex_label"])
+    return list(samples.items())
+
+def compare_backends(limit: int = 200) -> Dict[str, Dict[str, float]]:
+    """
+    Run the fp32 and int8 models over the labelled images, reporting latency and token accuracy of each.
+    """
+    from mathclips.services.image_to_equation_interface import MLPipelineInterface
+    from mathclips.services.util import packed_from_object_id
+
+    model_version = MLPipelineInterface.get_current_model_version()
+    fp32_model: LatexOCR = MLPipelineInterface.load_model_version(model_version)
+    int8_model: LatexOCR = quantize_ocr_model(MLPipelineInterface.load_model_version(model_version))
+    tokenizer = fp32_model.tokenizer
+
+    samples = labelled_samples(limit)
+    images = MLPipelineInterface.image_db.get_images([packed_from_object_id(file_id) for file_id, _ in samples])
+    backends: Dict[str, Callable] = dict(fp32 = fp32_model, int8 = int8_model)
+    latencies: Dict[str, List[float]] = {name: [] for name in backends}
+    accuracies: Dict[str, List[float]] = {name: [] for name in backends}
+    agreement: List[float] = []
+    for (file_id, label), image in zip(samples, images):
+        if image is None:
+            continue
+        label_tokens = tokenizer.tokenize(label)
+        predictions: Dict[str, List[str]] = {}
+        for name, model in backends.items():
+            start_time = time.perf_counter()
+            latex = model(image)
+            latencies[name].append((time.perf_counter() - start_time) * 1000.0)
+            predictions[name] = tokenizer.tokenize(latex)
+            accuracies[name].append(token_accuracy(predictions[name], label_tokens))
+        agreement.append(token_accuracy(predictions["int8"], predictions["fp32"]))
+
+    if not agreement:
+        print("No labelled images to compare on")
+        return {}
+    summary: Dict[str, Dict[str, float]] = {}
+    print(f"checkpoint: {model_version.checkpoint_id}, {len(agreement)} labelled images")
+    for name in backends:
+        sorted_latencies = sorted(latencies[name])
+        summary[name] = dict(
+            token_accuracy = statistics.mean(accuracies[name]),
+            latency_p50_ms = sorted_latencies[len(sorted_latencies) // 2],
+            latency_p95_ms = sorted_latencies[min(len(sorted_latencies) - 1, int(0.95 * len(sorted_latencies)))])
+        print(f"{name:>5}: token accuracy {summary[name]['token_accuracy']:.4f}  "
+              f"p50 {summary[name]['latency_p50_ms']:8.1f} ms  p95 {summary[name]['latency_p95_ms']:8.1f} ms")
+    print(f"int8 vs fp32 token agreement: {statistics.mean(agreement):.4f}, "
+          f"speedup (p50): {summary['fp32']['latency_p50_ms'] / max(summary['int8']['latency_p50_ms'], 1e-9):.2f}x")
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(description = "Compare the int8 OCR backend with fp32 on the labelled images")
+    parser.add_argument("--compare", action = "store_true", required = True)
+    parser.add_argument("--limit", type = int, default = 200, help = "maximum number of labelled images to run")
+    args = parser.parse_args()
+    compare_backends(args.limit)
+
+if __name__ == "__main__":
+    main()
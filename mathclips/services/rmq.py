@@ -1,18 +1,23 @@
 from __future__ import annotations
 
+import os
+import threading
+from typing import Iterable, Set
+
 import pika
-from pika.channel import Channel
-from pika.connection import Connection
+import pika.exceptions
+from pika.adapters.blocking_connection import BlockingChannel, BlockingConnection
 from pika.credentials import PlainCredentials
 from google.protobuf.message import Message
 
 from mathclips.services.logger import logger
-from mathclips.services import RMQ_DOCKER_IP, LOCAL_MODE
+from mathclips.services import RMQ_DOCKER_IP, LOCAL_MODE, RMQ_HEARTBEAT_S, MESSAGE_TRANSPORT, TransportBackend
 
 def get_rmq_connection_parameters(localmode: bool = False) -> pika.ConnectionParameters:
     if localmode:
         return pika.ConnectionParameters(host = 'localhost',
                                          port = 5672,
+                                         heartbeat = RMQ_HEARTBEAT_S,
                                          credentials = PlainCredentials(username = "admin", password = "admin"))
 
     # TODO - change host to static IP generated in docker-compose
@@ -21,17 +26,130 @@ def get_rmq_connection_parameters(localmode: bool = False) -> pika.ConnectionPar
         host = RMQ_DOCKER_IP,
         port = 5672,
         connection_attempts = 10,
+        heartbeat = RMQ_HEARTBEAT_S,
         credentials = PlainCredentials(username = "admin", password = "admin"))
 
+persistent_message_properties = pika.BasicProperties(delivery_mode = pika.DeliveryMode.Persistent)
+
+class RMQPublisher:
+    """
+    Process-wide publisher that keeps one connection open, instead of a TCP and AMQP handshake per message.
+
+    Holds two channels: one for single publishes, and one in transaction mode for batches,
+    where a single commit round trip confirms that the broker has taken the whole batch.
+    The connection is re-opened transparently if the broker drops it, and after a fork,
+    since a child process must never share its parent's socket.
+    Calls are serialized with a lock, pika connections are not thread-safe (the streamlit front end is threaded).
+    """
+    max_publish_attempts: int = 2
+    recoverable_errors = (pika.exceptions.AMQPConnectionError, pika.exceptions.AMQPChannelError)
+
+    def __init__(self, connection_parameters: pika.ConnectionParameters|None = None):
+        self._connection_parameters = connection_parameters
+        self._connection: BlockingConnection|None = None
+        self._channel: BlockingChannel|None = None
+        self._batch_channel: BlockingChannel|None = None
+        self._declared_queues: Set[str] = set()
+        self._owner_pid: int = os.getpid()
+        self._lock = threading.RLock()
+
+    def _reset(self):
+        if self._connection is not None and self._owner_pid == os.getpid():
+            try:
+                if self._connection.is_open:
+                    self._connection.close()
+            except Exception:
+                pass
+        self._connection, self._channel, self._batch_channel = None, None, None
+        self._declared_queues.clear()
+        self._owner_pid = os.getpid()
+
+    def _ensure_connection(self) -> BlockingConnection:
+        if self._owner_pid != os.getpid() or (self._connection is not None and self._connection.is_closed):
+            self._reset()
+        if self._connection is None:
+            if self._connection_parameters is None:
+                self._connection_parameters = get_rmq_connection_parameters(LOCAL_MODE)
+            self._connection = pika.BlockingConnection(self._connection_parameters)
+        else:
+            # an idle blocking connection only answers heartbeats when it gets to process events
+            self._connection.process_data_events(time_limit = 0)
+        return self._connection
+
+    def _get_channel(self, batch: bool = False) -> BlockingChannel:
+        connection = self._ensure_connection()
+        if self._channel is None or self._channel.is_closed:
+            self._channel = connection.channel()
+        if batch and (self._batch_channel is None or self._batch_channel.is_closed):
+            self._batch_channel = connection.channel()
+            self._batch_channel.tx_select()
+        return self._batch_channel if batch else self._channel
+
+    def _declare_queue(self, queue_name: str):
+        if queue_name not in self._declared_queues:
+            self._get_channel().queue_declare(queue = queue_name, durable = True)
+            self._declared_queues.add(queue_name)
+
+    def publish(self, message: Message, queue_name: str,
+                properties: pika.BasicProperties = persistent_message_properties):
+        body: bytes = message.SerializeToString()
+        with self._lock:
+            for attempt in range(1, RMQPublisher.max_publish_attempts + 1):
+                try:
+                    self._declare_queue(queue_name)
+                    self._get_channel().basic_publish(exchange = '', routing_key = queue_name,
+                                                      properties = properties, body = body)
+                    return
+                except RMQPublisher.recoverable_errors as ex:
+                    logger.warning(f"Lost RabbitMQ publisher connection ({ex!r}), reconnecting. Attempt: {attempt}")
+                    self._reset()
+                    if attempt == RMQPublisher.max_publish_attempts:
+                        raise
+
+    def publish_many(self, messages: Iterable[Message], queue_name: str,
+                     properties: pika.BasicProperties = persistent_message_properties) -> int:
+        """
+        Publish a batch and wait for one commit, returning once the broker has accepted all of it.
+        The batch is retried as a whole after a reconnect, an uncommitted transaction is discarded by the broker.
+        """
+        bodies = [message.SerializeToString() for message in messages]
+        if not bodies:
+            return 0
+        with self._lock:
+            for attempt in range(1, RMQPublisher.max_publish_attempts + 1):
+                try:
+                    self._declare_queue(queue_name)
+                    batch_channel = self._get_channel(batch = True)
+                    for body in bodies:
+                        batch_channel.basic_publish(exchange = '', routing_key = queue_name,
+                                                    properties = properties, body = body)
+                    batch_channel.tx_commit()
+                    return len(bodies)
+                except RMQPublisher.recoverable_errors as ex:
+                    logger.warning(f"Lost RabbitMQ publisher connection ({ex!r}), reconnecting. Attempt: {attempt}")
+                    self._reset()
+                    if attempt == RMQPublisher.max_publish_attempts:
+                        raise
+
+    def close(self):
+        with self._lock:
+            self._reset()
+
+_process_publisher: RMQPublisher|None = None
+_process_publisher_lock = threading.Lock()
+
+def get_publisher() -> RMQPublisher:
+    global _process_publisher
+    with _process_publisher_lock:
+        if _process_publisher is None:
+            _process_publisher = RMQPublisher()
+        return _process_publisher
+
 def publish_proto_message(message: Message, queue_name: str):
-    connection: Connection = pika.BlockingConnection(
-        get_rmq_connection_parameters(LOCAL_MODE))
-    channel: Channel = connection.channel()
-    channel.queue_declare(queue = queue_name, durable = True, passive = True)
-    channel.basic_publish(
-        exchange = '',
-        routing_key = queue_name,
-        properties = pika.BasicProperties(delivery_mode = pika.DeliveryMode.Persistent),
-        body = message.SerializeToString())
+    if MESSAGE_TRANSPORT == TransportBackend.IN_PROCESS:
+        # imported here, the transport module builds on top of this one
+        from mathclips.services.transport import get_in_process_transport
+        get_in_process_transport().publish(message, queue_name)
+    else:
+        get_publisher().publish(message, queue_name)
     logger.info(f" [x] Sent Protobuf Message to queue: {queue_name}. Message Contents:\n{message}")
-    connection.close()
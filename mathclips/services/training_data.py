@@ -0,0 +1,226 @@
+"""
+Training dataset construction for the pix2tex fine tuning runs.
+
+Two ways to get from labelled images in GridFS to a `pix2tex.train` run:
+
+- subprocess: write every image and a label file into a temp dir, pickle the datasets with
+  `python -m pix2tex.dataset.dataset` and train with `python -m pix2tex.train`, the way pix2tex documents it.
+- in process: decode the images straight into an `Im2LatexDataset` subclass that keeps them in memory,
+  and call `pix2tex.train.train` as a library.  Skips three interpreter/torch start ups and the disk round trip,
+  which dominate the small fine tune batches mathclips trains on.  The samples go through the node local
+  shard cache (see mathclips.services.training_shards), so only ones no earlier run has seen are fetched.
+
+`TRAIN_IN_PROCESS` picks the path `ingest.train_worker` uses.
+"""
+from __future__ import annotations
+
+import subprocess
+import sys
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, List, Sequence, Tuple
+
+import numpy as np
+import torch
+from munch import Munch
+from PIL import Image
+from torch.nn.utils.rnn import pad_sequence
+import torch.nn.functional as F
+from transformers import PreTrainedTokenizerFast
+import pix2tex
+import pix2tex.train
+from pix2tex.dataset.dataset import Im2LatexDataset
+from pix2tex.utils import parse_args, seed_everything
+
+from mathclips.services import TRAIN_SHARD_CACHE_DIR
+from mathclips.services.mongodb import MathSymbolImageDatabase
+from mathclips.services.preprocessing import pad_to_min_dimensions
+from mathclips.services.training_shards import TrainingShardCache
+from mathclips.proto.pb_py_classes.uint_packed_bytes_pb2 import UintPackedBytes
+
+pix2tex_root = Path(pix2tex.__path__[0]).resolve()
+
+# the Im2LatexDataset constructor defaults, the dataset CLI filters images with them
+DEFAULT_MIN_DIMENSIONS: Tuple[int, int] = (32, 32)
+DEFAULT_MAX_DIMENSIONS: Tuple[int, int] = (1024, 512)
+
+def resolve_tokenizer_path(tokenizer: str|Path) -> Path:
+    """
+    pix2tex configs give the tokenizer relative to the pix2tex checkout, try it relative to the installed package too.
+    """
+    tokenizer_path = Path(tokenizer)
+    for candidate in (tokenizer_path, pix2tex_root.parent.joinpath(tokenizer_path),
+                      pix2tex_root.joinpath(tokenizer_path)):
+        if candidate.exists():
+            return candidate
+    return pix2tex_root.joinpath("model", "dataset", "tokenizer.json")
+
+class InMemoryIm2LatexDataset(Im2LatexDataset):
+    """
+    An `Im2LatexDataset` whose samples are decoded arrays (RGB, or grayscale from the shard cache)
+    instead of png paths, optionally with their token ids already computed.
+    `data` maps (width, height) to (equation, index into `image_arrays`) pairs, so the batching,
+    shuffling and dimension filtering of the base class work unchanged, only `prepare_data` reads differently.
+    """
+
+    def __init__(self, image_arrays: List[np.ndarray], equations: Sequence[str], tokenizer: str|Path,
+                 min_dimensions: Tuple[int, int] = DEFAULT_MIN_DIMENSIONS,
+                 max_dimensions: Tuple[int, int] = DEFAULT_MAX_DIMENSIONS,
+                 token_ids: List[np.ndarray]|None = None, shuffle: bool = True, batchsize: int = 16,
+                 max_seq_len: int = 1024, pad: bool = False, keep_smaller_batches: bool = False,
+                 test: bool = False):
+        # the base constructor only does work when given paths, the settings it would store are set here
+        super().__init__()
+        self.shuffle = shuffle
+        self.batchsize = batchsize
+        self.max_seq_len = max_seq_len
+        self.pad = pad
+        self.keep_smaller_batches = keep_smaller_batches
+        self.test = test
+        # padded rather than filtered, like inference pads them, the crops of short equations are under the minimum
+        image_arrays = [pad_to_min_dimensions(image_array, min_dimensions) for image_array in image_arrays]
+        self.image_arrays = image_arrays
+        self.token_ids = token_ids
+        self.tokenizer = PreTrainedTokenizerFast(tokenizer_file = str(resolve_tokenizer_path(tokenizer)))
+        self.min_dimensions = min_dimensions
+        self.max_dimensions = max_dimensions
+        grouped_samples: Dict[Tuple[int, int], List[Tuple[str, int]]] = defaultdict(list)
+        for index, (image_array, equation) in enumerate(zip(image_arrays, equations)):
+            height, width = image_array.shape[:2]
+            if min_dimensions[0] <= width <= max_dimensions[0] and min_dimensions[1] <= height <= max_dimensions[1]:
+                grouped_samples[(width, height)].append((equation, index))
+        # an instance attribute, the base class keeps a (shared) class level default
+        self.data = dict(grouped_samples)
+        self._get_size()
+        iter(self)
+
+    @classmethod
+    def from_images(cls, images: Sequence[Image.Image], equations: Sequence[str], tokenizer: str|Path,
+                    **kwargs) -> InMemoryIm2LatexDataset:
+        # same pixels cv2.imread gives the subprocess path for the saved png, alpha is dropped
+        return cls([np.asarray(image.convert("RGB")) for image in images], equations, tokenizer, **kwargs)
+
+    @classmethod
+    def from_shard_cache(cls, shard_cache: TrainingShardCache, image_db: MathSymbolImageDatabase,
+                         file_ids: List[UintPackedBytes], equations: List[str], tokenizer: str|Path,
+                         max_dimensions: Tuple[int, int]|None = None, **kwargs) -> InMemoryIm2LatexDataset:
+        tokenizer_path = resolve_tokenizer_path(tokenizer)
+        pixel_arrays, token_ids = shard_cache.load_samples(
+            image_db, file_ids, equations, PreTrainedTokenizerFast(tokenizer_file = str(tokenizer_path)),
+            tokenizer_path, max_dimensions)
+        # equations are only used by prepare_data to tokenize, which the cached token ids replace
+        return cls(pixel_arrays, [""] * len(pixel_arrays), tokenizer_path, token_ids = token_ids, **kwargs)
+
+    def _tokenize(self, equations, image_indexes) -> dict:
+        if self.token_ids is None:
+            tok = self.tokenizer(list(equations), return_token_type_ids = False)
+        else:
+            token_ids = [self.token_ids[int(image_index)].tolist() for image_index in image_indexes]
+            tok = dict(input_ids = token_ids, attention_mask = [[1] * len(ids) for ids in token_ids])
+        # pad with bos and eos token
+        for k, p in zip(list(tok), [[self.bos_token_id, self.eos_token_id], [1, 1]]):
+            tok[k] = pad_sequence([torch.LongTensor([p[0]] + x + [p[1]]) for x in tok[k]],
+                                  batch_first = True, padding_value = self.pad_token_id)
+        return tok
+
+    def prepare_data(self, batch):
+        equations, image_indexes = batch.T
+        tok = self._tokenize(equations, image_indexes)
+        # check if sequence length is too long
+        if self.max_seq_len < tok['attention_mask'].shape[1]:
+            return next(self)
+        images = []
+        for image_index in image_indexes:
+            image_array = self.image_arrays[int(image_index)]
+            if not self.test and np.random.random() < .04:
+                # sometimes convert to bitmask, like the base class
+                image_array = image_array.copy()
+                image_array[image_array != 255] = 0
+            if image_array.ndim == 2:
+                # the transforms expect the 3 channel image cv2.imread gives the base class
+                image_array = np.repeat(image_array[:, :, None], 3, axis = 2)
+            images.append(self.transform(image = image_array)['image'][:1])
+        images = torch.cat(images).float().unsqueeze(1)
+        if self.pad:
+            h, w = images.shape[2:]
+            images = F.pad(images, (0, self.max_dimensions[0] - w, 0, self.max_dimensions[1] - h), value = 1)
+        return tok, images
+
+# pix2tex.train.train loads its datasets by path through the module level Im2LatexDataset name,
+# patching it is process wide, so only one in process run may have it patched at a time
+_dataset_patch_lock = threading.Lock()
+
+@contextmanager
+def registered_datasets(datasets: Dict[str, Im2LatexDataset]) -> Iterator[None]:
+    """
+    Make `Im2LatexDataset().load(key)` inside `pix2tex.train` return `datasets[key]` instead of unpickling a file.
+    """
+    class RegistryIm2LatexDataset(Im2LatexDataset):
+        def load(self, filename, args = []):
+            return datasets[str(filename)]
+
+    with _dataset_patch_lock:
+        original_dataset_class = pix2tex.train.Im2LatexDataset
+        pix2tex.train.Im2LatexDataset = RegistryIm2LatexDataset
+        try:
+            yield
+        finally:
+            pix2tex.train.Im2LatexDataset = original_dataset_class
+
+def build_in_memory_dataset(image_db: MathSymbolImageDatabase, file_ids: List[UintPackedBytes],
+                            equations: List[str], tokenizer: str|Path,
+                            max_dimensions: Tuple[int, int]) -> InMemoryIm2LatexDataset:
+    """
+    Through the node local shard cache when TRAIN_SHARD_CACHE_DIR is set, straight from GridFS otherwise.
+    Images are preprocessed like they are for inference, for a model with `max_dimensions` (width, height).
+    """
+    if TRAIN_SHARD_CACHE_DIR is not None:
+        return InMemoryIm2LatexDataset.from_shard_cache(TrainingShardCache(TRAIN_SHARD_CACHE_DIR), image_db,
+                                                        file_ids, equations, tokenizer, max_dimensions)
+    images = image_db.get_preprocessed_images(file_ids, max_dimensions)
+    samples = [(image, equation) for image, equation in zip(images, equations) if image is not None]
+    return InMemoryIm2LatexDataset.from_images([image for image, _ in samples],
+                                               [equation for _, equation in samples], tokenizer)
+
+def run_training_in_process(train_config: Munch, train_dataset: Im2LatexDataset, val_dataset: Im2LatexDataset):
+    """
+    `python -m pix2tex.train --config <train_config> --debug`, with the datasets handed over in memory.
+    """
+    train_key, val_key = "mathclips_in_memory_train", "mathclips_in_memory_val"
+    args = parse_args(Munch(dict(train_config, data = train_key, valdata = val_key)), debug = True)
+    seed_everything(args.seed)
+    with registered_datasets({train_key: train_dataset, val_key: val_dataset}):
+        pix2tex.train.train(args)
+
+def write_image_folder(images: Sequence[Image.Image], labels: Sequence[str], out_dir: Path, labels_filename: str) -> Path:
+    """
+    The layout the pix2tex dataset CLI reads, images named by their line in the label file.
+    """
+    out_dir.mkdir(parents = True, exist_ok = True)
+    for i, pil_image in enumerate(images):
+        orig_ext: str = Path(pil_image.info["filename"]).suffix
+        basename: str = "{:07d}".format(i)
+        if pil_image.width < DEFAULT_MIN_DIMENSIONS[0] or pil_image.height < DEFAULT_MIN_DIMENSIONS[1]:
+            # the dataset CLI drops images under its minimum size
+            pil_image = Image.fromarray(pad_to_min_dimensions(np.asarray(pil_image.convert("L")),
+                                                              DEFAULT_MIN_DIMENSIONS))
+        pil_image.save(str(out_dir.joinpath(basename).with_suffix(orig_ext)))
+    label_file_path = out_dir.joinpath(labels_filename)
+    with open(label_file_path, 'w') as label_file:
+        label_file.write('\n'.join(labels))
+    return label_file_path
+
+def build_pickled_dataset(images: Sequence[Image.Image], labels: Sequence[str], work_dir: Path, name: str) -> Path:
+    image_dir = work_dir.joinpath(name)
+    labels_path = write_image_folder(images, labels, image_dir, f"mathclips_{name}_labels.txt")
+    dataset_path = work_dir.joinpath(f"mathclips_{name}_dataset.pkl")
+    subprocess.run([sys.executable, "-m", "pix2tex.dataset.dataset", "--equations", labels_path,
+                    "--images", image_dir, "--out", dataset_path],
+                   check = True, stderr = sys.stderr, stdout = sys.stdout)
+    return dataset_path
+
+def run_training_subprocess(train_config_path: Path):
+    subprocess.run([sys.executable, "-m", "pix2tex.train", "--config", train_config_path, "--debug"],
+                   check = True, stderr = sys.stderr, stdout = sys.stdout)
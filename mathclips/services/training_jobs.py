@@ -0,0 +1,183 @@
+"""
+Training job runner.
+
+The train request consumer only snapshots a batch and queues a job document (see `ingest.train_callback`),
+so it acks within milliseconds.  The jobs are run here, by a dedicated pool of worker processes.
+A worker only runs a job while it holds the training lease in mongo, so two runs never overwrite
+the promoted weights at the same time, and a background thread keeps renewing the lease while the run goes.
+Job status and progress are kept on the job documents.
+
+usage:
+    python -m mathclips.services.training_jobs            # run the training job worker pool
+    python -m mathclips.services.training_jobs --status   # show the recent jobs and the lease holder
+"""
+from __future__ import annotations
+
+import argparse
+import multiprocessing
+import os
+import socket
+import threading
+import uuid
+
+from bson.objectid import ObjectId
+
+from mathclips.services import (NUM_TRAIN_JOB_WORKERS, TRAIN_LEASE_DURATION_S, TRAIN_JOB_POLL_INTERVAL_S,
+                                TRAIN_JOB_MAX_ATTEMPTS, TrainingJobStatus)
+from mathclips.services.logger import logger
+from mathclips.services.transport import MessageTransport
+from mathclips.services.mongodb import TrainingJobDatabase, ensure_all_indexes
+from mathclips.services.util import object_id_from_packed
+from mathclips.services.ingest import (image_db, ml_checkpoints_db, training_candidate_db, training_job_db,
+                                       train_worker, training_batch_from_job, complete_training_batch)
+
+class TrainingLeaseLost(RuntimeError):
+    pass
+
+class LeaseKeeper:
+    """
+    Renews the training lease every third of its duration from a background thread while a job runs.
+    """
+
+    def __init__(self, job_db: TrainingJobDatabase, holder: str, duration_s: float = TRAIN_LEASE_DURATION_S):
+        self.job_db = job_db
+        self.holder = holder
+        self.duration_s = duration_s
+        self.lost = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target = self._renew_loop, name = "training_lease_keeper", daemon = True)
+
+    def _renew_loop(self):
+        while not self._stop_event.wait(self.duration_s / 3.0):
+            try:
+                renewed = self.job_db.renew_lease(self.holder, self.duration_s)
+            except Exception:
+                logger.exception("Failed to renew the training lease")
+                continue
+            if not renewed:
+                logger.error(f"Training lease held by {self.holder} was taken over")
+                self.lost.set()
+                return
+
+    def check(self):
+        if self.lost.is_set():
+            raise TrainingLeaseLost(f"{self.holder} no longer holds the training lease")
+
+    def __enter__(self) -> LeaseKeeper:
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop_event.set()
+        self._thread.join()
+
+class TrainingJobRunner:
+
+    def __init__(self, job_db: TrainingJobDatabase = training_job_db,
+                 lease_duration_s: float = TRAIN_LEASE_DURATION_S,
+                 max_attempts: int = TRAIN_JOB_MAX_ATTEMPTS,
+                 worker_id: str|None = None):
+        self.job_db = job_db
+        self.lease_duration_s = lease_duration_s
+        self.max_attempts = max_attempts
+        # unique per worker, also across hosts
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+    def run_next_job(self) -> bool:
+        """
+        Run the oldest queued job if the training lease is free.
+
+        Returns
+        -------
+        bool
+            whether a job was run
+        """
+        if not self.job_db.acquire_lease(self.worker_id, self.lease_duration_s):
+            return False
+        try:
+            with LeaseKeeper(self.job_db, self.worker_id, self.lease_duration_s) as lease:
+                # holding the lease, so anything still running was left behind by a dead worker
+                for failed_job in self.job_db.recover_orphaned(self.max_attempts):
+                    training_candidate_db.release_batch(failed_job["batch_id"])
+                job = self.job_db.claim_next(self.worker_id)
+                if job is None:
+                    return False
+                self._run_job(job, lease)
+                return True
+        finally:
+            self.job_db.release_lease(self.worker_id)
+
+    def _run_job(self, job: dict, lease: LeaseKeeper):
+        job_id: ObjectId = job["_id"]
+        logger.info(f"Running training job {job_id} (attempt {job['attempts']}) on {self.worker_id}")
+
+        def on_progress(stage: str):
+            # never promote weights without the lease, another run may be promoting its own by now
+            lease.check()
+            self.job_db.set_progress(job_id, stage)
+
+        try:
+            checkpoint_record_id = train_worker(training_batch_from_job(job), image_db, ml_checkpoints_db,
+                                                on_progress = on_progress)
+        except TrainingLeaseLost:
+            # leave the job running, whoever holds the lease now requeues it as orphaned
+            logger.exception(f"Abandoned training job {job_id}")
+            return
+        except Exception as ex:
+            logger.exception(f"Training job {job_id} failed")
+            self.job_db.finish(job_id, TrainingJobStatus.FAILED, error = repr(ex))
+            training_candidate_db.release_batch(job["batch_id"])
+            return
+
+        complete_training_batch(job["batch_id"])
+        self.job_db.finish(job_id, TrainingJobStatus.SUCCEEDED,
+                           checkpoint_record_id = object_id_from_packed(checkpoint_record_id))
+        logger.info(f"Training job {job_id} succeeded")
+
+    def run(self, stop_event: threading.Event|None = None, poll_interval_s: float = TRAIN_JOB_POLL_INTERVAL_S):
+        if stop_event is None:
+            stop_event = threading.Event()
+        logger.info(f"Training job worker {self.worker_id} waiting for jobs")
+        while not stop_event.is_set():
+            try:
+                ran_job = self.run_next_job()
+            except Exception:
+                logger.exception("Training job worker hit an error, retrying")
+                ran_job = False
+            if not ran_job:
+                stop_event.wait(poll_interval_s)
+
+def training_job_worker(transport: MessageTransport|None = None, stop_event: threading.Event|None = None):
+    # jobs are handed over through mongo, the transport is only accepted so this starts like the other services
+    TrainingJobRunner().run(stop_event = stop_event)
+
+def training_job_worker_factory() -> multiprocessing.Process:
+    worker_process = multiprocessing.Process(target = training_job_worker, name = "training_job_worker")
+    worker_process.start()
+    return worker_process
+
+def print_status(job_db: TrainingJobDatabase = training_job_db, limit: int = 20):
+    lease = job_db.lease_holder()
+    print(f"training lease: {lease['holder']} until {lease['expires_at']}" if lease else "training lease: free")
+    for job in job_db.recent_jobs(limit):
+        line = f"{job['_id']}  {job['status']:<10} {job['progress'] or '':<24} " \
+               f"train={len(job['train_file_ids'])} val={len(job['val_file_ids'])} attempts={job['attempts']}"
+        if job.get("error"):
+            line += f"  error: {job['error']}"
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description = "Run the training job workers, or show the job status")
+    parser.add_argument("--status", action = "store_true", help = "print the recent training jobs and exit")
+    parser.add_argument("--workers", type = int, default = NUM_TRAIN_JOB_WORKERS)
+    args = parser.parse_args()
+    if args.status:
+        print_status()
+        return
+    ensure_all_indexes(image_db.db)
+    workers = [training_job_worker_factory() for _ in range(args.workers)]
+    for worker in workers:
+        worker.join()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+"""
+Node local cache of decoded training samples, shared by every training run on the host.
+
+Each run used to download, decode and tokenize every labelled sample again, including the ones earlier runs
+had already trained on.  The cache keeps the grayscale pixels and the token ids of every sample it has seen
+in append-only shards of flat NumPy arrays, opened memory mapped, plus a JSON index into them:
+
+- pixels are content addressed on the pixel hash stored in the GridFS metadata, so an image that is cached
+  is never fetched from mongo again, whichever record it was uploaded under.  Preprocessed pixels
+  (see mathclips.services.preprocessing) are additionally keyed on the preprocessing key.
+- token ids are keyed on the hash of the label and of the tokenizer file that produced them.
+
+A run only fetches, decodes and tokenizes what is missing and writes it as one new shard,
+so its I/O is proportional to the new data.  Writers serialize on an fcntl lock,
+readers never lock since a shard is complete before the index that points at it is replaced.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, List, Sequence, Tuple
+
+import numpy as np
+from PIL import Image
+from transformers import PreTrainedTokenizerFast
+
+from mathclips.services import TRAIN_SHARD_CACHE_DIR
+from mathclips.services.logger import logger
+from mathclips.services.mongodb import MathSymbolImageDatabase
+from mathclips.services.util import pixel_content_hash, file_lock
+from mathclips.services.preprocessing import preprocessing_key
+from mathclips.proto.pb_py_classes.uint_packed_bytes_pb2 import UintPackedBytes
+
+PIXEL_DTYPE = np.uint8
+TOKEN_DTYPE = np.int32
+
+def sha256_of_file(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+class TrainingShardCache:
+
+    index_filename: str = "index.json"
+    lock_filename: str = ".lock"
+
+    def __init__(self, cache_dir: Path = TRAIN_SHARD_CACHE_DIR):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents = True, exist_ok = True)
+        # image key -> [shard, offset, height, width]
+        self.images: Dict[str, List[int]] = {}
+        # token key -> [shard, offset, length]
+        self.tokens: Dict[str, List[int]] = {}
+        self.next_shard: int = 0
+        self._shards: Dict[Tuple[str, int], np.ndarray] = {}
+        self._load_index()
+
+    @property
+    def index_path(self) -> Path:
+        return self.cache_dir.joinpath(TrainingShardCache.index_filename)
+
+    def _shard_path(self, kind: str, shard: int) -> Path:
+        return self.cache_dir.joinpath(f"{kind}_{shard:06d}.npy")
+
+    def _load_index(self):
+        if not self.index_path.exists():
+            return
+        with open(self.index_path, 'r') as index_file:
+            index = json.load(index_file)
+        self.images, self.tokens, self.next_shard = index["images"], index["tokens"], index["next_shard"]
+
+    def _write_index(self):
+        file_descriptor, temp_path = tempfile.mkstemp(dir = self.cache_dir, prefix = ".index.")
+        try:
+            with os.fdopen(file_descriptor, 'w') as index_file:
+                json.dump(dict(images = self.images, tokens = self.tokens, next_shard = self.next_shard), index_file)
+            os.replace(temp_path, self.index_path)
+        except BaseException:
+            Path(temp_path).unlink(missing_ok = True)
+            raise
+
+    def _save_shard(self, kind: str, shard: int, values: np.ndarray):
+        file_descriptor, temp_path = tempfile.mkstemp(dir = self.cache_dir, prefix = f".{kind}.", suffix = ".npy")
+        try:
+            with os.fdopen(file_descriptor, 'wb') as shard_file:
+                np.save(shard_file, values)
+            os.replace(temp_path, self._shard_path(kind, shard))
+        except BaseException:
+            Path(temp_path).unlink(missing_ok = True)
+            raise
+
+    def _shard(self, kind: str, shard: int) -> np.ndarray:
+        key = (kind, shard)
+        if key not in self._shards:
+            self._shards[key] = np.load(self._shard_path(kind, shard), mmap_mode = 'r')
+        return self._shards[key]
+
+    @contextmanager
+    def _write_lock(self) -> Iterator[None]:
+        with file_lock(self.cache_dir.joinpath(TrainingShardCache.lock_filename)):
+            # another process may have added shards since this one read the index
+            self._load_index()
+            yield
+
+    @staticmethod
+    def token_key(label: str, tokenizer_digest: str) -> str:
+        return hashlib.sha256(f"{tokenizer_digest}\0{label}".encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def image_key(pixel_hash: str, max_dimensions: Tuple[int, int]|None = None) -> str:
+        if max_dimensions is None:
+            return pixel_hash
+        return f"{pixel_hash}:{preprocessing_key(max_dimensions)}"
+
+    def pixels(self, image_key: str) -> np.ndarray:
+        shard, offset, height, width = self.images[image_key]
+        return self._shard("pixels", shard)[offset:offset + height * width].reshape(height, width)
+
+    def token_ids(self, token_key: str) -> np.ndarray:
+        shard, offset, length = self.tokens[token_key]
+        return self._shard("tokens", shard)[offset:offset + length]
+
+    def add(self, pixels: Dict[str, np.ndarray], token_ids: Dict[str, Sequence[int]]):
+        """
+        Append the entries the index does not have yet as one new shard of each kind.
+        """
+        with self._write_lock():
+            new_pixels = {image_key: array for image_key, array in pixels.items() if image_key not in self.images}
+            new_tokens = {key: ids for key, ids in token_ids.items() if key not in self.tokens}
+            if not new_pixels and not new_tokens:
+                return
+            shard = self.next_shard
+            if new_pixels:
+                offset = 0
+                for image_key, array in new_pixels.items():
+                    self.images[image_key] = [shard, offset, int(array.shape[0]), int(array.shape[1])]
+                    offset += array.size
+                self._save_shard("pixels", shard, np.concatenate(
+                    [np.ascontiguousarray(array, dtype = PIXEL_DTYPE).ravel() for array in new_pixels.values()]))
+            if new_tokens:
+                offset = 0
+                for key, ids in new_tokens.items():
+                    self.tokens[key] = [shard, offset, len(ids)]
+                    offset += len(ids)
+                self._save_shard("tokens", shard, np.concatenate(
+                    [np.asarray(ids, dtype = TOKEN_DTYPE) for ids in new_tokens.values()] or
+                    [np.empty(0, dtype = TOKEN_DTYPE)]))
+            self.next_shard = shard + 1
+            self._write_index()
+
+    def load_samples(self, image_db: MathSymbolImageDatabase, file_ids: List[UintPackedBytes], labels: List[str],
+                     tokenizer: PreTrainedTokenizerFast, tokenizer_path: Path,
+                     max_dimensions: Tuple[int, int]|None = None) -> Tuple[List[np.ndarray], List[np.ndarray]]:
+        """
+        Grayscale pixels and token ids for each sample, fetching, decoding and tokenizing only what is not cached.
+        With `max_dimensions` (width, height), the images are preprocessed for a model of that size.
+        Samples whose image is no longer stored are skipped.
+
+        Returns
+        -------
+        Tuple[List[np.ndarray], List[np.ndarray]]
+            memory mapped pixel arrays (height x width) and token ids, without bos/eos, in sample order
+        """
+        image_keys: List[str|None] = [
+            None if pixel_hash is None else TrainingShardCache.image_key(pixel_hash, max_dimensions)
+            for pixel_hash in image_db.get_pixel_hashes(file_ids)]
+        missing_indexes = [i for i, image_key in enumerate(image_keys) if image_key not in self.images]
+        new_pixels: Dict[str, np.ndarray] = {}
+        if missing_indexes:
+            missing_file_ids = [file_ids[i] for i in missing_indexes]
+            fetched_images: List[Image.Image|None] = image_db.get_images(missing_file_ids) if max_dimensions is None \
+                else image_db.get_preprocessed_images(missing_file_ids, max_dimensions)
+            for i, image in zip(missing_indexes, fetched_images):
+                if image is None:
+                    logger.error(f"Training image {file_ids[i]} is missing, leaving it out of the run")
+                    continue
+                # legacy files have no hash in their metadata
+                image_keys[i] = TrainingShardCache.image_key(image.info.get("pixel_hash") or pixel_content_hash(image),
+                                                             max_dimensions)
+                new_pixels[image_keys[i]] = np.asarray(image.convert("L"))
+
+        tokenizer_digest = sha256_of_file(tokenizer_path)
+        token_keys = [TrainingShardCache.token_key(label, tokenizer_digest) for label in labels]
+        missing_labels = {key: label for key, label in zip(token_keys, labels) if key not in self.tokens}
+        new_tokens: Dict[str, List[int]] = {}
+        if missing_labels:
+            encoded = tokenizer(list(missing_labels.values()), return_token_type_ids = False)["input_ids"]
+            new_tokens = dict(zip(missing_labels.keys(), encoded))
+
+        self.add(new_pixels, new_tokens)
+        logger.info(f"Training shard cache: {len(file_ids) - len(missing_indexes)} of {len(file_ids)} images "
+                    f"and {len(labels) - len(missing_labels)} of {len(labels)} labels were cached")
+
+        pixel_arrays: List[np.ndarray] = []
+        token_arrays: List[np.ndarray] = []
+        for image_key, token_key in zip(image_keys, token_keys):
+            if image_key is None or image_key not in self.images:
+                continue
+            pixel_arrays.append(self.pixels(image_key))
+            token_arrays.append(self.token_ids(token_key))
+        return pixel_arrays, token_arrays
@@ -0,0 +1,354 @@
+"""
+Message transports used to move protobuf messages between the mathclips services.
+
+Every consumer (ML pipeline, result ingest, training requests) is written against `MessageTransport`,
+so the same code runs against RabbitMQ or against in-process queues,
+the latter lets the whole upload -> ML pipeline -> result -> notebook flow run without a broker.
+"""
+from __future__ import annotations
+
+from abc import ABC, abstractmethod
+from collections import defaultdict, deque
+from dataclasses import dataclass
+import itertools
+import multiprocessing
+import threading
+import time
+from typing import Callable, Deque, Dict, Iterable, List, Sequence, Tuple, Type, TypeVar
+
+import pika
+from pika.adapters.blocking_connection import BlockingChannel, BlockingConnection
+from google.protobuf.message import Message
+
+from mathclips.services import LOCAL_MODE, MESSAGE_TRANSPORT, TransportBackend
+from mathclips.services.rmq import get_rmq_connection_parameters, get_publisher
+
+MessageType = TypeVar("MessageType", bound = Message)
+
+# how long consumer loops block before re-checking their stop event
+CONSUMER_POLL_INTERVAL_S: float = 1.0
+
+@dataclass
+class Delivery:
+    """
+    One received message.  Over AMQP only `body` is set, in process the published object itself is handed over.
+    """
+    queue_name: str
+    delivery_tag: int
+    body: bytes|None = None
+    message: Message|None = None
+
+    def decode(self, message_type: Type[MessageType]) -> MessageType:
+        if self.message is not None:
+            return self.message
+        return message_type.FromString(self.body)
+
+@dataclass
+class QueueStats:
+    message_count: int
+    consumer_count: int
+
+class ConsumerStats:
+    """
+    Messages handled, and seconds spent handling them, summed over every consumer loop it is handed to.
+    The counters live in shared memory, so a supervisor can read those of its worker processes,
+    see mathclips.services.autoscale.
+    """
+
+    def __init__(self):
+        self._lock = multiprocessing.Lock()
+        self._num_handled = multiprocessing.RawValue("q", 0)
+        self._busy_s = multiprocessing.RawValue("d", 0.0)
+
+    def record(self, num_handled: int, busy_s: float):
+        with self._lock:
+            self._num_handled.value += num_handled
+            self._busy_s.value += busy_s
+
+    def snapshot(self) -> Tuple[int, float]:
+        with self._lock:
+            return self._num_handled.value, self._busy_s.value
+
+class MessageTransport(ABC):
+
+    @abstractmethod
+    def publish(self, message: Message, queue_name: str):
+        ...
+
+    def publish_many(self, messages: Iterable[Message], queue_name: str) -> int:
+        num_published: int = 0
+        for message in messages:
+            self.publish(message, queue_name)
+            num_published += 1
+        return num_published
+
+    @abstractmethod
+    def subscribe(self, queue_name: str, prefetch_count: int = 1):
+        """
+        Start receiving from `queue_name`, at most `prefetch_count` messages are held unacknowledged.
+        """
+
+    def get(self, queue_name: str, timeout: float|None = None) -> Delivery|None:
+        """
+        Next delivery from a subscribed queue, waiting up to `timeout` seconds (forever if None).
+        """
+        return self.get_first((queue_name,), timeout = timeout)
+
+    @abstractmethod
+    def get_first(self, queue_names: Sequence[str], timeout: float|None = None) -> Delivery|None:
+        """
+        Next delivery from the first of the subscribed `queue_names` that has one,
+        waiting up to `timeout` seconds (forever if None) for any of them to receive one.
+        """
+
+    @abstractmethod
+    def ack(self, delivery: Delivery, multiple: bool = False):
+        """
+        Acknowledge `delivery`, and with `multiple` every earlier delivery of the same queue too.
+        """
+
+    @abstractmethod
+    def nack(self, delivery: Delivery, requeue: bool = True):
+        ...
+
+    @abstractmethod
+    def queue_stats(self, queue_name: str) -> QueueStats:
+        ...
+
+    def close(self):
+        pass
+
+class AMQPTransport(MessageTransport):
+    """
+    RabbitMQ transport.  One instance per consumer thread, pika blocking connections are not thread-safe.
+    Deliveries are pushed by the broker into a local buffer, `get` pops from it.
+    Publishing goes through the process-wide pooled publisher.
+    """
+
+    def __init__(self, connection_parameters: pika.ConnectionParameters|None = None):
+        if connection_parameters is None:
+            connection_parameters = get_rmq_connection_parameters(LOCAL_MODE)
+        self.connection: BlockingConnection = pika.BlockingConnection(connection_parameters)
+        self.channel: BlockingChannel = self.connection.channel()
+        self._buffers: Dict[str, Deque[Delivery]] = defaultdict(deque)
+        self._declared_queues: set = set()
+
+    def _declare_queue(self, queue_name: str):
+        if queue_name not in self._declared_queues:
+            self.channel.queue_declare(queue = queue_name, durable = True)
+            self._declared_queues.add(queue_name)
+
+    def publish(self, message: Message, queue_name: str):
+        get_publisher().publish(message, queue_name)
+
+    def publish_many(self, messages: Iterable[Message], queue_name: str) -> int:
+        return get_publisher().publish_many(messages, queue_name)
+
+    def subscribe(self, queue_name: str, prefetch_count: int = 1):
+        self._declare_queue(queue_name)
+        self.channel.basic_qos(prefetch_count = prefetch_count)
+
+        def buffer_delivery(channel, method, properties, body: bytes):
+            self._buffers[queue_name].append(
+                Delivery(queue_name = queue_name, delivery_tag = method.delivery_tag, body = body))
+
+        self.channel.basic_consume(queue = queue_name, on_message_callback = buffer_delivery)
+
+    def get_first(self, queue_names: Sequence[str], timeout: float|None = None) -> Delivery|None:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            for queue_name in queue_names:
+                if self._buffers[queue_name]:
+                    return self._buffers[queue_name].popleft()
+            remaining_s = None if deadline is None else deadline - time.monotonic()
+            if remaining_s is not None and remaining_s <= 0:
+                return None
+            self.connection.process_data_events(time_limit = remaining_s)
+
+    def ack(self, delivery: Delivery, multiple: bool = False):
+        self.channel.basic_ack(delivery_tag = delivery.delivery_tag, multiple = multiple)
+
+    def nack(self, delivery: Delivery, requeue: bool = True):
+        self.channel.basic_nack(delivery_tag = delivery.delivery_tag, requeue = requeue)
+
+    def queue_stats(self, queue_name: str) -> QueueStats:
+        # not passive, a passive declare of a queue no consumer has declared yet closes the channel
+        declare_result = self.channel.queue_declare(queue = queue_name, durable = True)
+        return QueueStats(message_count = declare_result.method.message_count,
+                          consumer_count = declare_result.method.consumer_count)
+
+    def close(self):
+        if self.connection.is_open:
+            self.connection.close()
+
+class InProcessTransport(MessageTransport):
+    """
+    Queues living in the memory of one process, shared by every thread in it.
+    Published objects are handed to the consumer by reference, nothing is serialized.
+    Unacknowledged deliveries are tracked so that a nack can put them back at the head of their queue.
+    """
+
+    def __init__(self):
+        self._queues: Dict[str, Deque[Delivery]] = defaultdict(deque)
+        self._unacked: Dict[str, Dict[int, Delivery]] = defaultdict(dict)
+        self._consumer_counts: Dict[str, int] = defaultdict(int)
+        self._delivery_tags = itertools.count(1)
+        self._condition = threading.Condition()
+
+    def publish(self, message: Message, queue_name: str):
+        self.publish_many((message,), queue_name)
+
+    def publish_many(self, messages: Iterable[Message], queue_name: str) -> int:
+        with self._condition:
+            deliveries = [Delivery(queue_name = queue_name, delivery_tag = next(self._delivery_tags),
+                                   message = message) for message in messages]
+            self._queues[queue_name].extend(deliveries)
+            self._condition.notify_all()
+        return len(deliveries)
+
+    def subscribe(self, queue_name: str, prefetch_count: int = 1):
+        with self._condition:
+            self._consumer_counts[queue_name] += 1
+
+    def get_first(self, queue_names: Sequence[str], timeout: float|None = None) -> Delivery|None:
+        with self._condition:
+            if not self._condition.wait_for(lambda: any(self._queues[queue_name] for queue_name in queue_names),
+                                            timeout = timeout):
+                return None
+            queue_name = next(queue_name for queue_name in queue_names if self._queues[queue_name])
+            delivery = self._queues[queue_name].popleft()
+            self._unacked[queue_name][delivery.delivery_tag] = delivery
+            return delivery
+
+    def ack(self, delivery: Delivery, multiple: bool = False):
+        with self._condition:
+            unacked = self._unacked[delivery.queue_name]
+            if multiple:
+                for delivery_tag in [tag for tag in unacked if tag <= delivery.delivery_tag]:
+                    del unacked[delivery_tag]
+            else:
+                unacked.pop(delivery.delivery_tag, None)
+
+    def nack(self, delivery: Delivery, requeue: bool = True):
+        with self._condition:
+            self._unacked[delivery.queue_name].pop(delivery.delivery_tag, None)
+            if requeue:
+                self._queues[delivery.queue_name].appendleft(delivery)
+                self._condition.notify_all()
+
+    def queue_stats(self, queue_name: str) -> QueueStats:
+        with self._condition:
+            return QueueStats(message_count = len(self._queues[queue_name]),
+                              consumer_count = self._consumer_counts[queue_name])
+
+_in_process_transport: InProcessTransport|None = None
+_in_process_transport_lock = threading.Lock()
+
+def get_in_process_transport() -> InProcessTransport:
+    global _in_process_transport
+    with _in_process_transport_lock:
+        if _in_process_transport is None:
+            _in_process_transport = InProcessTransport()
+        return _in_process_transport
+
+def create_transport(backend: str = MESSAGE_TRANSPORT) -> MessageTransport:
+    """
+    A transport for one consumer.  AMQP consumers each get their own connection,
+    in-process consumers all share the process-wide queues.
+    """
+    if backend == TransportBackend.AMQP:
+        return AMQPTransport()
+    if backend == TransportBackend.IN_PROCESS:
+        return get_in_process_transport()
+    raise ValueError(f"Unknown message transport backend: {backend}")
+
+@dataclass
+class QueueLanes:
+    """
+    Queues consumed together as priority lanes, e.g. interactive uploads ahead of bulk imports.
+    Lanes are listed highest priority first, each with a weight.  While several lanes have messages waiting,
+    each lane gets up to its weight in deliveries per round before the lanes after it get theirs,
+    so with weights (8, 1) a bulk backlog costs interactive messages at most one delivery in nine,
+    and a lane that is alone in having messages gets all of the throughput.
+    """
+    queue_names: Sequence[str]
+    weights: Sequence[int]
+
+    @staticmethod
+    def of(queue: str|QueueLanes) -> QueueLanes:
+        return queue if isinstance(queue, QueueLanes) else QueueLanes(queue_names = (queue,), weights = (1,))
+
+class LaneReader:
+    """
+    Reads deliveries from the lanes of a `QueueLanes` in their weighted priority order.
+    """
+
+    def __init__(self, transport: MessageTransport, lanes: QueueLanes, prefetch_count: int = 1):
+        self.transport = transport
+        self.lanes = lanes
+        # deliveries taken from each lane in the current round
+        self.served: Dict[str, int] = {queue_name: 0 for queue_name in lanes.queue_names}
+        for queue_name in lanes.queue_names:
+            transport.subscribe(queue_name, prefetch_count = prefetch_count)
+
+    def lane_order(self) -> List[str]:
+        """
+        Lanes with weight left in this round by priority, then the rest by priority.
+        """
+        lanes = list(zip(self.lanes.queue_names, self.lanes.weights))
+        return [queue_name for queue_name, weight in lanes if self.served[queue_name] < weight] + \
+            [queue_name for queue_name, weight in lanes if self.served[queue_name] >= weight]
+
+    def get(self, timeout: float|None = None) -> Delivery|None:
+        delivery = self.transport.get_first(self.lane_order(), timeout = timeout)
+        if delivery is None:
+            return None
+        self.served[delivery.queue_name] += 1
+        if all(self.served[queue_name] >= weight for queue_name, weight in zip(self.lanes.queue_names,
+                                                                                self.lanes.weights)):
+            self.served = {queue_name: 0 for queue_name in self.served}
+        return delivery
+
+def consume(transport: MessageTransport, queue: str|QueueLanes, on_delivery: Callable[[Delivery], None],
+            prefetch_count: int = 1, stop_event: threading.Event|None = None,
+            consumer_stats: ConsumerStats|None = None):
+    """
+    Hand every delivery to `on_delivery` until `stop_event` is set, which is responsible for acking it.
+    """
+    reader = LaneReader(transport, QueueLanes.of(queue), prefetch_count = prefetch_count)
+    while stop_event is None or not stop_event.is_set():
+        delivery = reader.get(timeout = CONSUMER_POLL_INTERVAL_S)
+        if delivery is not None:
+            start_time = time.monotonic()
+            on_delivery(delivery)
+            if consumer_stats is not None:
+                consumer_stats.record(1, time.monotonic() - start_time)
+
+def consume_batches(transport: MessageTransport, queue: str|QueueLanes, on_batch: Callable[[List[Delivery]], None],
+                    batch_size: int, batch_wait_ms: float, stop_event: threading.Event|None = None,
+                    consumer_stats: ConsumerStats|None = None):
+    """
+    Hand deliveries to `on_batch` in groups of up to `batch_size`.  A batch is released once it is full,
+    or `batch_wait_ms` after its first delivery arrived, whichever comes first.
+    With several lanes a batch can hold deliveries of different queues, which have to be acked one by one.
+    """
+    reader = LaneReader(transport, QueueLanes.of(queue), prefetch_count = batch_size)
+    batch_wait_s: float = batch_wait_ms / 1000.0
+    while stop_event is None or not stop_event.is_set():
+        first_delivery = reader.get(timeout = CONSUMER_POLL_INTERVAL_S)
+        if first_delivery is None:
+            continue
+        batch: List[Delivery] = [first_delivery]
+        batch_deadline = time.monotonic() + batch_wait_s
+        while len(batch) < batch_size:
+            remaining_s = batch_deadline - time.monotonic()
+            if remaining_s <= 0:
+                break
+            delivery = reader.get(timeout = remaining_s)
+            if delivery is None:
+                break
+            batch.append(delivery)
+        start_time = time.monotonic()
+        on_batch(batch)
+        if consumer_stats is not None:
+            consumer_stats.record(len(batch), time.monotonic() - start_time)
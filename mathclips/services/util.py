@@ -1,30 +1,50 @@
 from pathlib import Path
+from collections import OrderedDict
+from typing import Dict, Hashable, Any, Iterator, List, Sequence
+from contextlib import contextmanager
+import fcntl
+import hashlib
+import os
+import shutil
 import struct
-from typing import Dict
+import tempfile
 
 from mathclips.proto.pb_py_classes.uint_packed_bytes_pb2 import UintPackedBytes
 import bson
+import numpy as np
+import yaml
+from PIL import Image
 
 PROJECT_ENDIANNESS = '!' # network big-endian
 uint32_format = 'I'
 uint64_format = 'Q'
 ObjectID_len = int(12)
 
+# the 12 ObjectId bytes read as (first_bits, last_bits), compiled once instead of per conversion
+object_id_struct = struct.Struct(f"{PROJECT_ENDIANNESS}{uint64_format}{uint32_format}")
+# the same layout as a NumPy record, for converting whole lists of ids in one pass
+packed_object_id_dtype = np.dtype([("first_bits", ">u8"), ("last_bits", ">u4")])
+assert object_id_struct.size == packed_object_id_dtype.itemsize == ObjectID_len
+
 def object_id_from_packed(uid: UintPackedBytes) -> bson.ObjectId:
-    pack_format = f"{PROJECT_ENDIANNESS}{uint64_format}{uint32_format}"
-    packed_data_buffer: bytes = struct.pack(pack_format, uid.first_bits, uid.last_bits)
-    return bson.ObjectId(packed_data_buffer)
+    return bson.ObjectId(object_id_struct.pack(uid.first_bits, uid.last_bits))
     
 def packed_from_object_id(oid: bson.ObjectId) -> UintPackedBytes:
-    byte_array = oid.binary
-    assert len(byte_array) == ObjectID_len
-    unpack_32_format = f"{PROJECT_ENDIANNESS}{uint32_format}"
-    unpack_64_format = f"{PROJECT_ENDIANNESS}{uint64_format}"
-    uint64_tuple, uint32_tuple = struct.unpack(unpack_64_format, byte_array[:8]),\
-        struct.unpack(unpack_32_format, byte_array[8:])
-    uint64, = uint64_tuple
-    uint32, = uint32_tuple
-    return UintPackedBytes(first_bits = uint64, last_bits = uint32)
+    first_bits, last_bits = object_id_struct.unpack(oid.binary)
+    return UintPackedBytes(first_bits = first_bits, last_bits = last_bits)
+
+def object_ids_from_packed(uids: Sequence[UintPackedBytes]) -> List[bson.ObjectId]:
+    """
+    `object_id_from_packed` for a whole list: the fields are written into one big-endian record array,
+    whose records read as raw 12 byte values are the ObjectIds.
+    """
+    if not uids:
+        return []
+    records = np.empty(len(uids), dtype = packed_object_id_dtype)
+    records["first_bits"] = [uid.first_bits for uid in uids]
+    records["last_bits"] = [uid.last_bits for uid in uids]
+    # void, not bytes ("S12"), which would drop trailing zero bytes
+    return list(map(bson.ObjectId, records.view(f"V{ObjectID_len}").tolist()))
 
 def find_newest_file(root_dir: Path, filter_pattern: str = '*'):
     newest_path: Path = None
@@ -38,6 +58,96 @@ def find_newest_file(root_dir: Path, filter_pattern: str = '*'):
                 latest_timestamp = timestamp
     return newest_path
 
+def pixel_content_hash(image: Image.Image) -> str:
+    """
+    Hash of the decoded pixels, so the same picture hashes the same no matter how the file was encoded.
+    """
+    hasher = hashlib.sha256()
+    hasher.update(f"{image.mode}:{image.size[0]}x{image.size[1]}:".encode())
+    hasher.update(image.tobytes())
+    return hasher.hexdigest()
+
+class LRUCache:
+    """
+    Minimal least-recently-used mapping, not thread-safe.
+    """
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._data: OrderedDict = OrderedDict()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        if key not in self._data:
+            return default
+        self._data.move_to_end(key)
+        return self._data[key]
+
+    def put(self, key: Hashable, value: Any):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last = False)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+def atomic_copy(source_path: Path, destination_path: Path):
+    """
+    Copy to a temporary file next to the destination, then rename over it.
+    Readers polling the destination never observe a partially written file.
+    """
+    destination_path = Path(destination_path)
+    file_descriptor, temp_name = tempfile.mkstemp(dir = destination_path.parent,
+                                                  prefix = f".{destination_path.name}.", suffix = ".tmp")
+    os.close(file_descriptor)
+    try:
+        shutil.copy2(source_path, temp_name)
+        os.replace(temp_name, destination_path)
+    except BaseException:
+        Path(temp_name).unlink(missing_ok = True)
+        raise
+
+def atomic_write_text(text: str, destination_path: Path):
+    destination_path = Path(destination_path)
+    file_descriptor, temp_name = tempfile.mkstemp(dir = destination_path.parent,
+                                                  prefix = f".{destination_path.name}.", suffix = ".tmp")
+    try:
+        with os.fdopen(file_descriptor, 'w') as temp_file:
+            temp_file.write(text)
+        os.replace(temp_name, destination_path)
+    except BaseException:
+        Path(temp_name).unlink(missing_ok = True)
+        raise
+
+@contextmanager
+def file_lock(lock_path: Path) -> Iterator[None]:
+    """
+    Exclusive advisory lock shared by every process on the host that locks the same path.
+    """
+    with open(lock_path, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def atomic_write_yaml(data: Dict, destination_path: Path):
+    """
+    Dump to a temporary file next to the destination and rename over it, readers never see a half-written file.
+    """
+    destination_path = Path(destination_path)
+    file_descriptor, temp_name = tempfile.mkstemp(dir = destination_path.parent,
+                                                  prefix = f".{destination_path.name}.", suffix = ".tmp")
+    try:
+        with os.fdopen(file_descriptor, 'w') as temp_file:
+            yaml.safe_dump(data, temp_file)
+        os.replace(temp_name, destination_path)
+    except BaseException:
+        Path(temp_name).unlink(missing_ok = True)
+        raise
+
 def update_nested_dict(old_dict: Dict, new_dict: Dict):
     """
     This function assumes that we only have one section per layer.
@@ -0,0 +1,56 @@
+import time
+
+from mathclips.services import AUTOSCALE_SCALE_DOWN_IDLE_S, WORKER_RESTART_BACKOFF_S
+from mathclips.services.autoscale import PoolLoad, WorkerPool, WorkerPoolSpec
+
+def idle_worker(stop_event, consumer_stats):
+    stop_event.wait()
+
+def crashing_worker(stop_event, consumer_stats):
+    raise SystemExit(1)
+
+def make_pool(target, min_workers: int = 1, max_workers: int = 8) -> WorkerPool:
+    return WorkerPool(WorkerPoolSpec(name = "test", queue_names = ("test",), target = target,
+                                     min_workers = min_workers, max_workers = max_workers))
+
+def test_scales_up_to_drain_the_backlog_in_time():
+    pool = make_pool(idle_worker)
+    # 2 messages per second per worker, 300 queued drain within 30s with 5 workers
+    assert pool.desired_size(PoolLoad(backlog = 300, utilization = 1.0, service_rate = 2.0), now = 0.0) == 5
+    assert pool.desired_size(PoolLoad(backlog = 30000, utilization = 1.0, service_rate = 2.0), now = 0.0) == 8
+    # before any message was handled, one worker at a time
+    assert pool.desired_size(PoolLoad(backlog = 300, utilization = 0.0, service_rate = None), now = 0.0) == 1
+
+def test_drains_one_worker_after_an_idle_period():
+    pool = make_pool(idle_worker, min_workers = 1)
+    pool.scale_to(3, PoolLoad(backlog = 10, utilization = 1.0, service_rate = None), now = 0.0)
+    try:
+        idle_load = PoolLoad(backlog = 0, utilization = 0.0, service_rate = 2.0)
+        assert pool.desired_size(idle_load, now = 100.0) == 3
+        desired = pool.desired_size(idle_load, now = 100.0 + AUTOSCALE_SCALE_DOWN_IDLE_S)
+        assert desired == 2
+        pool.scale_to(desired, idle_load, now = 100.0 + AUTOSCALE_SCALE_DOWN_IDLE_S)
+        assert sorted(pool.workers) == [0, 1] and len(pool.draining) == 1
+        pool.draining[0].process.join(timeout = 10.0)
+        pool.reap(time.monotonic())
+        assert pool.draining == []
+    finally:
+        pool.stop(timeout_s = 10.0)
+
+def test_crashed_workers_restart_with_backoff():
+    pool = make_pool(crashing_worker)
+    pool.start()
+    try:
+        pool.workers[0].process.join(timeout = 10.0)
+        started_at = pool.workers[0].started_at
+        pool.reap(started_at + 0.1)
+        # the slot still counts towards the pool while it waits for its restart
+        assert pool.size == 1 and pool.restart_at[0] == started_at + 0.1 + WORKER_RESTART_BACKOFF_S
+
+        pool.reap(pool.restart_at[0])
+        pool.workers[0].process.join(timeout = 10.0)
+        restarted_at = pool.workers[0].started_at
+        pool.reap(restarted_at + 0.1)
+        assert pool.restart_at[0] == restarted_at + 0.1 + 2 * WORKER_RESTART_BACKOFF_S
+    finally:
+        pool.stop(timeout_s = 10.0)
@@ -0,0 +1,75 @@
+import io
+import tarfile
+import zipfile
+from pathlib import Path
+
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+import mongomock.gridfs
+from PIL import Image
+
+from mathclips.proto.pb_py_classes.image_pb2 import Image as ProtoImage
+from mathclips.services import IngestQueueNames
+from mathclips.services.bulk_import import bulk_import, iterate_source, load_labels
+from mathclips.services.mongodb import MathSymbolImageDatabase, TrainingCandidateDatabase
+from mathclips.services.transport import InProcessTransport
+
+mongomock.gridfs.enable_gridfs_integration()
+
+def png_bytes(shade: int) -> bytes:
+    buffer = io.BytesIO()
+    Image.new("L", (40, 20), shade).save(buffer, format = "PNG")
+    return buffer.getvalue()
+
+IMAGES = {"algebra/quadratic.png": png_bytes(10), "euler.png": png_bytes(200)}
+
+def make_sources(tmp_path: Path):
+    directory = tmp_path.joinpath("images")
+    for name, data in IMAGES.items():
+        directory.joinpath(name).parent.mkdir(parents = True, exist_ok = True)
+        directory.joinpath(name).write_bytes(data)
+    directory.joinpath("notes.txt").write_text("not an image")
+
+    zip_path = tmp_path.joinpath("images.zip")
+    with zipfile.ZipFile(zip_path, "w") as archive:
+        for name, data in IMAGES.items():
+            archive.writestr(name, data)
+
+    tar_path = tmp_path.joinpath("images.tar.gz")
+    with tarfile.open(tar_path, "w:gz") as archive:
+        for name, data in IMAGES.items():
+            member = tarfile.TarInfo(name)
+            member.size = len(data)
+            archive.addfile(member, io.BytesIO(data))
+    return directory, zip_path, tar_path
+
+def test_sources_yield_the_same_images(tmp_path: Path):
+    for source in make_sources(tmp_path):
+        assert {item.name: item.data for item in iterate_source(source)} == IMAGES
+
+def test_labels_formats(tmp_path: Path):
+    tmp_path.joinpath("labels.json").write_text('{"euler.png": "e^{i\\\\pi} + 1 = 0"}')
+    tmp_path.joinpath("labels.csv").write_text('euler.png,"e^{i\\pi} + 1 = 0"\n')
+    tmp_path.joinpath("labels.tsv").write_text("euler.png\te^{i\\pi} + 1 = 0\n")
+    for name in ("labels.json", "labels.csv", "labels.tsv"):
+        assert load_labels(tmp_path.joinpath(name)) == {"euler.png": "e^{i\\pi} + 1 = 0"}
+
+def test_bulk_import_stores_publishes_and_marks_labelled(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    _, zip_path, _ = make_sources(tmp_path)
+    marked = {}
+    # mongomock's bulk_write lags behind pymongo, the candidate update itself is not under test
+    monkeypatch.setattr(TrainingCandidateDatabase, "bulk_mark_candidates",
+                        lambda self, labels_by_file_id: marked.update(labels_by_file_id))
+    image_db = MathSymbolImageDatabase(db = mongomock.MongoClient()["mathclips_test"])
+    transport = InProcessTransport()
+    transport.subscribe(IngestQueueNames.ML_PIPELINE_BULK_QUEUE)
+
+    progress = bulk_import(zip_path, image_db, transport, author_name = "tester", section = "imports",
+                           equation_type = ProtoImage.EquationType.DIGITAL,
+                           labels = {"quadratic.png": "x^2"}, num_workers = 2, publish_batch_size = 1)
+    assert (progress.num_stored, progress.num_published, progress.num_labelled) == (2, 2, 1)
+    assert transport.queue_stats(IngestQueueNames.ML_PIPELINE_BULK_QUEUE).message_count == 2
+    labelled, = image_db.collection.find(dict(needs_train = True))
+    assert labelled["train_label"] == "x^2" and labelled["equation_name"] == "quadratic"
+    assert marked == {labelled["file_storage_id"]: "x^2"}
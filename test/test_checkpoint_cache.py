@@ -0,0 +1,61 @@
+from pathlib import Path
+import time
+
+import pytest
+
+pytest.importorskip("pix2tex")
+from bson.objectid import ObjectId
+
+from mathclips.services.checkpoint_cache import CheckpointCache
+
+class FakeCheckpointDatabase:
+    def __init__(self):
+        self.num_downloads = 0
+
+    def download_checkpoint(self, file_id, destination: Path) -> Path:
+        self.num_downloads += 1
+        destination.write_bytes(str(file_id).encode())
+        return destination
+
+def make_record(digest: str) -> dict:
+    return dict(_id = ObjectId(), file_storage_id = ObjectId(), sha256 = digest, model_config_yaml = "name: test\n")
+
+def test_checkpoint_is_fetched_once_per_node(tmp_path: Path):
+    checkpoint_db = FakeCheckpointDatabase()
+    record = make_record("a" * 64)
+    # two worker processes on the same node, each with its own cache instance
+    first_paths = CheckpointCache(tmp_path).fetch(checkpoint_db, record)
+    second_paths = CheckpointCache(tmp_path).fetch(checkpoint_db, record)
+    assert first_paths == second_paths
+    assert checkpoint_db.num_downloads == 1
+    weights_path, config_path = first_paths
+    assert weights_path.name == f"{'a' * 64}.pth"
+    assert config_path.read_text() == "name: test\n"
+
+def test_old_checkpoints_are_pruned(tmp_path: Path):
+    checkpoint_db = FakeCheckpointDatabase()
+    cache = CheckpointCache(tmp_path, keep = 2)
+    paths = []
+    for digest in "abc":
+        paths.append(cache.fetch(checkpoint_db, make_record(digest * 64))[0])
+        # pruning goes by modification time, keep the fetches apart on coarse filesystem clocks
+        time.sleep(0.02)
+    assert not paths[0].exists()
+    assert paths[1].exists() and paths[2].exists()
+
+def test_fetch_places_the_resizer_next_to_the_weights(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    import mathclips.services.checkpoint_cache as checkpoint_cache
+    seed_root = tmp_path.joinpath("pix2tex")
+    seed_root.joinpath("model", "checkpoints").mkdir(parents = True)
+    seed_root.joinpath("model", "checkpoints", CheckpointCache.resizer_filename).write_bytes(b"resizer")
+    cache = CheckpointCache(tmp_path.joinpath("cache"))
+    record = make_record("d" * 64)
+    # a node without the pix2tex resizer, whatever a fetch places is what load_ocr_model finds
+    monkeypatch.setattr(checkpoint_cache, "pix2tex_root", tmp_path.joinpath("missing"))
+    cache.fetch(FakeCheckpointDatabase(), record)
+    assert not cache.resizer_path.exists()
+    # the next fetch retries once the resizer can be seeded
+    monkeypatch.setattr(checkpoint_cache, "pix2tex_root", seed_root)
+    weights_path, _ = cache.fetch(FakeCheckpointDatabase(), record)
+    assert cache.resizer_path.read_bytes() == b"resizer"
+    assert cache.resizer_path.parent == weights_path.parent
@@ -0,0 +1,70 @@
+import os
+from datetime import datetime
+from pathlib import Path
+
+import gridfs.grid_file
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+import mongomock.gridfs
+
+from mathclips.services.mongodb import CHECKPOINT_STREAM_CHUNKS, MLCheckpointDatabase
+from mathclips.services.util import packed_from_object_id
+
+mongomock.gridfs.enable_gridfs_integration()
+
+@pytest.fixture
+def checkpoint_db() -> MLCheckpointDatabase:
+    return MLCheckpointDatabase(db = mongomock.MongoClient()["mathclips_test"])
+
+def test_checkpoint_round_trip(checkpoint_db: MLCheckpointDatabase, tmp_path: Path):
+    checkpoint_path = tmp_path.joinpath("weights.pth")
+    # a few GridFS chunks plus a partial one
+    checkpoint_path.write_bytes(os.urandom(3 * 255 * 1024 + 123))
+    record_id = checkpoint_db.store_checkpoint_file(checkpoint_path, datetime.now(), [])
+    record = checkpoint_db.record_from_id(record_id)
+    assert record["file_size"] == checkpoint_path.stat().st_size
+
+    destination = tmp_path.joinpath("downloaded", "weights.pth")
+    checkpoint_db.download_checkpoint(record["file_storage_id"], destination)
+    assert destination.read_bytes() == checkpoint_path.read_bytes()
+    # no temp files are left behind
+    assert [path.name for path in destination.parent.iterdir()] == ["weights.pth"]
+
+    data, filename = checkpoint_db.get_checkpoint_binary_data(packed_from_object_id(record["file_storage_id"]))
+    assert filename == "weights.pth" and data == checkpoint_path.read_bytes()
+
+def test_corrupt_checkpoint_leaves_destination_untouched(checkpoint_db: MLCheckpointDatabase, tmp_path: Path):
+    checkpoint_path = tmp_path.joinpath("weights.pth")
+    checkpoint_path.write_bytes(os.urandom(4096))
+    record_id = checkpoint_db.store_checkpoint_file(checkpoint_path, datetime.now(), [])
+    record = checkpoint_db.record_from_id(record_id)
+    checkpoint_db.collection.update_one(dict(_id = record["_id"]), {'$set': dict(sha256 = "0" * 64)})
+
+    destination = tmp_path.joinpath("weights_copy.pth")
+    destination.write_bytes(b"previous weights")
+    with pytest.raises(IOError):
+        checkpoint_db.download_checkpoint(record["file_storage_id"], destination)
+    assert destination.read_bytes() == b"previous weights"
+
+def test_download_reads_whole_blocks(checkpoint_db: MLCheckpointDatabase, tmp_path: Path,
+                                     monkeypatch: pytest.MonkeyPatch):
+    checkpoint_path = tmp_path.joinpath("weights.pth")
+    # no newline bytes, iterating the GridOut would hand back the whole file at once
+    checkpoint_path.write_bytes(b"\x01" * (2 * CHECKPOINT_STREAM_CHUNKS * 255 * 1024 + 123))
+    record = checkpoint_db.record_from_id(checkpoint_db.store_checkpoint_file(checkpoint_path, datetime.now(), []))
+
+    block_sizes = []
+    read = gridfs.grid_file.GridOut.read
+
+    def recording_read(self, size = -1):
+        block = read(self, size)
+        block_sizes.append(len(block))
+        return block
+
+    monkeypatch.setattr(gridfs.grid_file.GridOut, "read", recording_read)
+    destination = tmp_path.joinpath("downloaded.pth")
+    checkpoint_db.download_checkpoint(record["file_storage_id"], destination)
+    assert destination.read_bytes() == checkpoint_path.read_bytes()
+    block_size = CHECKPOINT_STREAM_CHUNKS * 255 * 1024
+    assert block_sizes == [block_size, block_size, 123, 0]
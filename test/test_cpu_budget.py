@@ -0,0 +1,15 @@
+from mathclips.services.cpu_budget import plan_cpu_budgets
+
+def test_cores_are_split_evenly_between_workers():
+    budgets = plan_cpu_budgets(3, cores = list(range(8)))
+    assert [budget.num_threads for budget in budgets] == [2, 2, 2]
+    assert all(budget.cores == [] for budget in budgets)
+
+def test_pinned_workers_get_disjoint_cores_until_they_run_out():
+    budgets = plan_cpu_budgets(4, pin = True, cores = [0, 1, 2, 3, 4, 5, 6, 7])
+    assert [budget.cores for budget in budgets] == [[0, 1], [2, 3], [4, 5], [6, 7]]
+    oversubscribed = plan_cpu_budgets(3, threads_per_worker = 2, pin = True, cores = [0, 1, 2, 3])
+    assert [budget.cores for budget in oversubscribed] == [[0, 1], [2, 3], [0, 1]]
+
+def test_more_workers_than_cores_still_get_a_thread():
+    assert [budget.num_threads for budget in plan_cpu_budgets(4, cores = [0, 1])] == [1, 1, 1, 1]
@@ -1,28 +1,32 @@
 from pathlib import Path
 
-import numpy as np
+import pytest
+
+pytest.importorskip("pix2tex")
 
 from mathclips.proto.pb_py_classes.image_pb2 import Image as ProtoImage
 from mathclips.proto.pb_py_classes.uint_packed_bytes_pb2 import UintPackedBytes
-from mathclips.services.mongodb import MathSymbolImageDatabase
-from mathclips.services.image_to_equation_interface import Interface_IPC
+from mathclips.services.image_to_equation_interface import MLPipelineInterface
+from mathclips.services.transport import InProcessTransport
 
 root_path = Path(__file__).parent.parent.resolve()
 
 def test_database():
     # this data would be available through an upload service
-    sample_image_path: Path = root_path / "data" / "test" / "moment_of_intertia_snippet.png"
-    input_db = MathSymbolImageDatabase()
-    file_storage_id: UintPackedBytes = input_db.store_image(
+    sample_image_path: Path = root_path / "mathclips" / "data" / "test_images" / "moment_of_intertia_snippet.png"
+    ml_pipeline_interface = MLPipelineInterface(transport = InProcessTransport())
+    file_storage_id: UintPackedBytes = MLPipelineInterface.image_db.store_image(
         sample_image_path,
-        ProtoImage.EquationType.DIGITAL,
-        processed = False,
-        trained = False)
+        sample_image_path.name,
+        ProtoImage.EquationType.DIGITAL)
 
     sample_message = ProtoImage(uid = file_storage_id,
                                 equationType = ProtoImage.EquationType.DIGITAL)
-    latex_equation: str = Interface_IPC.latex_from_image(image_msg = sample_message)
-    Interface_IPC.store_latex_result_to_db(file_storage_id, latex_equation, correct=True)
+    latex_equation: str = ml_pipeline_interface.latex_from_image(image_msg = sample_message)
+    assert latex_equation
+    result_id: UintPackedBytes = MLPipelineInterface.result_db.upsert_result(
+        latex_equation, file_storage_id, ml_pipeline_interface.model_version.checkpoint_id, correct = True)
+    assert MLPipelineInterface.result_db.record_from_id(result_id)["latex_label"] == latex_equation
     
 if __name__ == "__main__":
     test_database()
@@ -0,0 +1,32 @@
+import numpy as np
+from PIL import Image
+
+from mathclips.services import ImageCodec
+from mathclips.services.mongodb import encode_image, decode_image
+from mathclips.services.util import pixel_content_hash
+
+def make_canvas_image() -> Image.Image:
+    # mimics the draw widget output, an RGBA canvas that is mostly empty background
+    pixels = np.full((200, 800, 4), 238, dtype = np.uint8)
+    pixels[..., 3] = 255
+    pixels[80:120, 100:400, :3] = 0
+    return Image.fromarray(pixels)
+
+def test_codecs_are_lossless():
+    canvas_image = make_canvas_image()
+    for codec in (ImageCodec.RAW, ImageCodec.PNG, ImageCodec.WEBP_LOSSLESS, ImageCodec.GRAYSCALE_PNG):
+        image_bytes, used_codec = encode_image(canvas_image, codec)
+        decoded = decode_image(image_bytes, used_codec, canvas_image.mode, canvas_image.size)
+        assert decoded.mode == canvas_image.mode
+        assert pixel_content_hash(decoded) == pixel_content_hash(canvas_image)
+
+def test_grayscale_codec_shrinks_canvas():
+    canvas_image = make_canvas_image()
+    image_bytes, used_codec = encode_image(canvas_image, ImageCodec.GRAYSCALE_PNG)
+    assert used_codec == ImageCodec.GRAYSCALE_PNG
+    assert len(image_bytes) * 10 < len(canvas_image.tobytes())
+
+def test_grayscale_codec_falls_back_for_color():
+    color_image = Image.new("RGB", (64, 32), (255, 0, 0))
+    _, used_codec = encode_image(color_image, ImageCodec.GRAYSCALE_PNG)
+    assert used_codec == ImageCodec.PNG
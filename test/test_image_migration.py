@@ -0,0 +1,65 @@
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+import mongomock.gridfs
+from PIL import Image, ImageDraw
+
+import mathclips.services.mongodb as mongodb
+from mathclips.services import ImageCodec
+from mathclips.services.mongodb import MathSymbolImageDatabase
+from mathclips.services.util import object_id_from_packed, pixel_content_hash
+from mathclips.proto.pb_py_classes.image_pb2 import Image as ProtoImage
+
+mongomock.gridfs.enable_gridfs_integration()
+
+def store_raw_canvas(image_db: MathSymbolImageDatabase):
+    canvas = Image.new("RGBA", (400, 100), (238, 238, 238, 255))
+    ImageDraw.Draw(canvas).line((50, 20, 300, 80), fill = (0, 0, 0, 255), width = 5)
+    file_id = image_db.store_image(canvas, "canvas", ProtoImage.EquationType.HANDWRITTEN, codec = ImageCodec.RAW)
+    return file_id, canvas
+
+def staged_count(image_db: MathSymbolImageDatabase) -> int:
+    return image_db.db[f"{image_db.staging_bucket_name}.files"].count_documents({})
+
+def test_reencode_keeps_the_id_and_the_pixels():
+    image_db = MathSymbolImageDatabase(db = mongomock.MongoClient()["mathclips_test"])
+    packed_id, canvas = store_raw_canvas(image_db)
+    file_id = object_id_from_packed(packed_id)
+    size_before, size_after = image_db.reencode_image(file_id, ImageCodec.GRAYSCALE_PNG)
+    assert size_after < size_before
+    assert image_db.file_storage.get(file_id).metadata["codec"] == ImageCodec.GRAYSCALE_PNG
+    assert pixel_content_hash(image_db.get_image(packed_id)) == pixel_content_hash(canvas)
+    assert staged_count(image_db) == 0
+
+def test_reencode_keeps_the_original_when_the_new_encoding_differs(monkeypatch: pytest.MonkeyPatch):
+    image_db = MathSymbolImageDatabase(db = mongomock.MongoClient()["mathclips_test"])
+    packed_id, canvas = store_raw_canvas(image_db)
+    file_id = object_id_from_packed(packed_id)
+    encode_image = mongodb.encode_image
+    monkeypatch.setattr(mongodb, "encode_image",
+                        lambda image, codec: encode_image(Image.new(image.mode, image.size), codec))
+    with pytest.raises(ValueError):
+        image_db.reencode_image(file_id, ImageCodec.PNG)
+    assert image_db.file_storage.get(file_id).metadata["codec"] == ImageCodec.RAW
+    assert pixel_content_hash(image_db.get_image(packed_id)) == pixel_content_hash(canvas)
+    assert staged_count(image_db) == 0
+
+def test_interrupted_reencode_is_recovered_from_staging(monkeypatch: pytest.MonkeyPatch):
+    image_db = MathSymbolImageDatabase(db = mongomock.MongoClient()["mathclips_test"])
+    packed_id, canvas = store_raw_canvas(image_db)
+    file_id = object_id_from_packed(packed_id)
+
+    def lost_connection(*args, **kwargs):
+        raise ConnectionError("lost the connection to mongo")
+
+    # the original is deleted, writing its replacement fails
+    with monkeypatch.context() as patch:
+        patch.setattr(image_db.file_storage, "put", lost_connection)
+        with pytest.raises(ConnectionError):
+            image_db.reencode_image(file_id, ImageCodec.PNG)
+    assert not image_db.file_storage.exists(file_id)
+
+    assert image_db.recover_staged_images() == 1
+    assert image_db.file_storage.get(file_id).metadata["codec"] == ImageCodec.PNG
+    assert pixel_content_hash(image_db.get_image(packed_id)) == pixel_content_hash(canvas)
+    assert staged_count(image_db) == 0
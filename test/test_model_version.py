@@ -0,0 +1,41 @@
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("pix2tex")
+from bson.objectid import ObjectId
+
+from mathclips.services.image_to_equation_interface import MLPipelineInterface
+from mathclips.services.util import atomic_write_yaml
+
+def promote(weights_path: Path, weights: bytes, checkpoint_record_id: ObjectId|None):
+    # the order train_worker promotes in, the record id file last
+    weights_path.write_bytes(weights)
+    if checkpoint_record_id is not None:
+        weights_stat = weights_path.stat()
+        atomic_write_yaml(dict(checkpoint_record_id = str(checkpoint_record_id),
+                               weights_mtime_ns = weights_stat.st_mtime_ns, weights_size = weights_stat.st_size),
+                          MLPipelineInterface.promoted_checkpoint_path(weights_path))
+
+def test_new_weights_are_only_picked_up_with_their_record_id(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    weights_path = tmp_path.joinpath("mathclips_weights.pth")
+    first_id, second_id = ObjectId(), ObjectId()
+    newest_record = dict(_id = first_id)
+    monkeypatch.setattr(MLPipelineInterface, "checkpoint_cache", None)
+    monkeypatch.setattr(MLPipelineInterface, "get_current_weights_path", staticmethod(lambda: weights_path))
+    monkeypatch.setattr(MLPipelineInterface.checkpoint_db, "newest_checkpoint_record",
+                        lambda projection = None: newest_record)
+
+    promote(weights_path, b"first", first_id)
+    first_version = MLPipelineInterface.get_current_model_version()
+    assert first_version.checkpoint_record_id == first_id
+
+    # the next run wrote its record and is midway through promoting its weights
+    newest_record = dict(_id = second_id)
+    promote(weights_path, b"second weights", None)
+    assert MLPipelineInterface.get_current_model_version() == first_version
+
+    promote(weights_path, b"second weights", second_id)
+    second_version = MLPipelineInterface.get_current_model_version()
+    assert second_version.checkpoint_record_id == second_id
+    assert second_version.weights_size == len(b"second weights")
@@ -0,0 +1,36 @@
+from pathlib import Path
+
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+from bson.objectid import ObjectId
+
+from mathclips.services.mongodb import NotebookDatabase
+from mathclips.services.notebook_yaml import import_notebook_if_empty
+from mathclips.services.util import atomic_write_yaml, packed_from_object_id
+
+def make_notebook_db(monkeypatch: pytest.MonkeyPatch) -> NotebookDatabase:
+    notebook_db = NotebookDatabase(db = mongomock.MongoClient()["mathclips_test"])
+    # mongomock's bulk_write lags behind pymongo, apply the upserts one by one
+    monkeypatch.setattr(notebook_db.collection, "bulk_write", lambda operations, ordered = True: [
+        notebook_db.collection.update_one(op._filter, op._doc, upsert = op._upsert) for op in operations])
+    return notebook_db
+
+def test_existing_yaml_notebook_is_imported_once(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    notebook_db = make_notebook_db(monkeypatch)
+    packed_id = packed_from_object_id(ObjectId())
+    config_path = tmp_path.joinpath("notebook.yml")
+    atomic_write_yaml({"Calculus": {"Chain Rule": dict(author = "me", latex = "f'(g(x))g'(x)", db_id = dict(
+        first_bits = packed_id.first_bits, last_bits = packed_id.last_bits))}}, config_path)
+
+    assert import_notebook_if_empty(notebook_db, config_path) == 1
+    assert notebook_db.sections() == ["Calculus"]
+    notebook_db.upsert_equation("Algebra", "Square", "me", "x^2", None)
+    # the collection is the notebook from now on, deleted equations must not come back
+    notebook_db.delete_equation("Calculus", "Chain Rule")
+    assert import_notebook_if_empty(notebook_db, config_path) == 0
+    assert notebook_db.sections() == ["Algebra"]
+
+def test_missing_yaml_notebook_is_skipped(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    notebook_db = make_notebook_db(monkeypatch)
+    assert import_notebook_if_empty(notebook_db, tmp_path.joinpath("notebook.yml")) == 0
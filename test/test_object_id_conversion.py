@@ -0,0 +1,14 @@
+from bson.objectid import ObjectId
+
+from mathclips.proto.pb_py_classes.uint_packed_bytes_pb2 import UintPackedBytes
+from mathclips.services.util import object_id_from_packed, packed_from_object_id, object_ids_from_packed
+
+def test_batch_conversion_matches_single():
+    # the extremes exercise the sign bit of both fields
+    object_ids = [ObjectId(), ObjectId(b"\xff" * 12), ObjectId(b"\x00" * 12), ObjectId(b"\x80" + b"\x01" * 11)]
+    packed = [packed_from_object_id(object_id) for object_id in object_ids]
+    assert packed[1] == UintPackedBytes(first_bits = 2**64 - 1, last_bits = 2**32 - 1)
+    assert object_ids_from_packed(packed) == [object_id_from_packed(uid) for uid in packed] == object_ids
+
+def test_batch_conversion_of_nothing():
+    assert object_ids_from_packed([]) == []
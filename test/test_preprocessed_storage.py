@@ -0,0 +1,32 @@
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+import mongomock.gridfs
+from PIL import Image, ImageDraw
+
+from mathclips.services.mongodb import MathSymbolImageDatabase
+from mathclips.services.util import object_id_from_packed, pixel_content_hash
+from mathclips.proto.pb_py_classes.image_pb2 import Image as ProtoImage
+
+mongomock.gridfs.enable_gridfs_integration()
+
+def test_preprocessed_copy_is_stored_once_per_key():
+    image_db = MathSymbolImageDatabase(db = mongomock.MongoClient()["mathclips_test"])
+    canvas = Image.new("RGBA", (800, 200), (0, 0, 0, 0))
+    ImageDraw.Draw(canvas).line((100, 50, 300, 120), fill = (0, 0, 0, 255), width = 5)
+    file_id = image_db.store_image(canvas, "canvas", ProtoImage.EquationType.HANDWRITTEN)
+
+    first, = image_db.get_preprocessed_images([file_id], (672, 192))
+    assert first.mode == "L" and first.size[0] < 300
+    # results stay cached under the hash of the original
+    assert first.info["pixel_hash"] == pixel_content_hash(canvas)
+
+    second, = image_db.get_preprocessed_images([file_id], (672, 192))
+    assert second.tobytes() == first.tobytes()
+    files = image_db.db[f"{image_db.preprocessed_bucket_name}.files"]
+    assert files.count_documents({}) == 1
+
+    # a model with other dimensions replaces the copy
+    resized, = image_db.get_preprocessed_images([file_id], (100, 32))
+    assert resized.size[0] <= 100
+    assert [document["_id"] for document in files.find()] == [object_id_from_packed(file_id)]
@@ -0,0 +1,49 @@
+import numpy as np
+from PIL import Image, ImageDraw
+
+from mathclips.services.preprocessing import downscale, pad_to_min_dimensions, preprocess_image, preprocessing_key
+
+def drawn_canvas() -> Image.Image:
+    # what the draw widget uploads: strokes on a transparent 800x200 RGBA canvas
+    canvas = Image.new("RGBA", (800, 200), (0, 0, 0, 0))
+    ImageDraw.Draw(canvas).line((100, 50, 300, 120), fill = (0, 0, 0, 255), width = 5)
+    canvas.info.update(filename = "canvas.png", pixel_hash = "abc")
+    return canvas
+
+def test_canvas_is_cropped_to_its_strokes():
+    preprocessed = preprocess_image(drawn_canvas(), (672, 192))
+    assert preprocessed.mode == "L"
+    # the bounding box of the 5px wide line, with its round-off
+    assert 200 <= preprocessed.size[0] <= 206 and 70 <= preprocessed.size[1] <= 76
+    pixels = np.asarray(preprocessed)
+    # dark ink on white, touching every edge of the crop
+    assert pixels.min() == 0 and pixels.max() == 255
+    assert (pixels[0] < 128).any() and (pixels[-1] < 128).any()
+    assert preprocessed.info == dict(filename = "canvas.png", pixel_hash = "abc")
+
+def test_light_text_on_dark_background_is_inverted():
+    image = Image.new("RGB", (300, 100), (0, 0, 0))
+    ImageDraw.Draw(image).rectangle((50, 40, 80, 60), fill = (255, 255, 255))
+    pixels = np.asarray(preprocess_image(image, (672, 192)))
+    assert pixels.shape == (21, 31)
+    assert (pixels == 0).all()
+
+def test_large_images_are_fit_within_the_maximum_dimensions():
+    image = Image.new("L", (3000, 2000), 255)
+    ImageDraw.Draw(image).rectangle((100, 100, 2900, 1000), outline = 0, width = 9)
+    preprocessed = preprocess_image(image, (672, 192))
+    assert preprocessed.size[0] <= 672 and preprocessed.size[1] == 192
+    assert downscale(np.zeros((3, 5000), dtype = np.uint8), (672, 192)).shape == (1, 671)
+
+def test_blank_images_are_left_alone():
+    assert preprocess_image(Image.new("L", (40, 30), 255), (672, 192)).size == (40, 30)
+
+def test_key_changes_with_model_dimensions():
+    assert preprocessing_key((672, 192)) != preprocessing_key((512, 192))
+
+def test_small_crops_are_padded_to_the_minimum_size():
+    thin_crop = np.zeros((6, 20), dtype = np.uint8)
+    padded = pad_to_min_dimensions(thin_crop, (32, 32))
+    assert padded.shape == (32, 32)
+    assert (padded[:6, :20] == 0).all() and (padded[6:] == 255).all() and (padded[:, 20:] == 255).all()
+    assert pad_to_min_dimensions(np.zeros((40, 50), dtype = np.uint8), (32, 32)).shape == (40, 50)
@@ -0,0 +1,31 @@
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("pix2tex")
+
+from mathclips.services.quantization import quantize_ocr_model, save_quantized_weights, token_accuracy
+
+def make_ocr_model() -> SimpleNamespace:
+    # stands in for LatexOCR, only its `model` attribute is quantized
+    torch.manual_seed(0)
+    return SimpleNamespace(model = torch.nn.Sequential(torch.nn.Linear(16, 32), torch.nn.ReLU(),
+                                                       torch.nn.Linear(32, 8)).eval())
+
+def test_prebuilt_quantized_weights_match_quantizing_on_load(tmp_path: Path):
+    quantized_path = tmp_path.joinpath("weights.int8.pth")
+    save_quantized_weights(make_ocr_model(), quantized_path)
+
+    inputs = torch.randn(4, 16)
+    from_prebuilt = quantize_ocr_model(make_ocr_model(), quantized_path)
+    on_load = quantize_ocr_model(make_ocr_model())
+    assert torch.allclose(from_prebuilt.model(inputs), on_load.model(inputs))
+    assert isinstance(on_load.model[0], torch.nn.quantized.dynamic.Linear)
+
+def test_token_accuracy():
+    assert token_accuracy(["x", "+", "1"], ["x", "+", "1"]) == 1.0
+    assert token_accuracy(["x", "-", "1"], ["x", "+", "1"]) == pytest.approx(2 / 3)
+    assert token_accuracy(["x"], ["x", "+", "1"]) == pytest.approx(1 / 3)
+    assert token_accuracy([], []) == 1.0
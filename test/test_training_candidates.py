@@ -0,0 +1,46 @@
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+import mongomock.gridfs
+from bson.objectid import ObjectId
+from pymongo.errors import BulkWriteError
+
+from mathclips.services.mongodb import MathSymbolImageDatabase, TrainingCandidateDatabase
+
+mongomock.gridfs.enable_gridfs_integration()
+
+def make_databases():
+    db = mongomock.MongoClient()["mathclips_test"]
+    return MathSymbolImageDatabase(db = db), TrainingCandidateDatabase(db = db)
+
+def test_seeding_skips_images_claimed_by_a_batch(monkeypatch: pytest.MonkeyPatch):
+    image_db, candidate_db = make_databases()
+    claimed_id, pending_id, unmarked_id = ObjectId(), ObjectId(), ObjectId()
+    for file_id in (claimed_id, pending_id, unmarked_id):
+        image_db.collection.insert_one(dict(file_storage_id = file_id, needs_train = True, train_label = "x"))
+    candidate_db.collection.insert_many([dict(file_storage_id = claimed_id, pending = False, batch_id = ObjectId()),
+                                         dict(file_storage_id = pending_id, pending = True, batch_id = None)])
+    marked = {}
+    # mongomock's bulk_write lags behind pymongo, only which images get marked is under test
+    monkeypatch.setattr(TrainingCandidateDatabase, "bulk_mark_candidates",
+                        lambda self, labels_by_file_id: marked.update(labels_by_file_id))
+    candidate_db.seed_from_images(image_db)
+    assert marked == {unmarked_id: "x"}
+
+def test_bulk_mark_counts_only_upserted_candidates(monkeypatch: pytest.MonkeyPatch):
+    _, candidate_db = make_databases()
+    inserted_id, duplicate_id = ObjectId(), ObjectId()
+    bulk_writes = []
+
+    def bulk_write(operations, ordered = True):
+        bulk_writes.append(operations)
+        if len(bulk_writes) == 1:
+            # a concurrent seeder inserted the second image between our filter and our insert
+            raise BulkWriteError(dict(writeErrors = [dict(index = 1, code = 11000, errmsg = "duplicate key")],
+                                      upserted = [dict(index = 0, _id = ObjectId())], nUpserted = 1))
+
+    monkeypatch.setattr(candidate_db.collection, "bulk_write", bulk_write)
+    assert candidate_db.bulk_mark_candidates({inserted_id: "x", duplicate_id: "y"}) == 1
+    # the duplicate is retried as a label update without an upsert
+    retried, = bulk_writes[1]
+    assert retried._filter == dict(file_storage_id = duplicate_id, pending = True) and not retried._upsert
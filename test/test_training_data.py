@@ -0,0 +1,31 @@
+import pytest
+
+pytest.importorskip("torch")
+pix2tex = pytest.importorskip("pix2tex")
+from PIL import Image, ImageDraw
+
+from mathclips.services.training_data import InMemoryIm2LatexDataset, pix2tex_root
+
+tokenizer_path = pix2tex_root.joinpath("model", "dataset", "tokenizer.json")
+
+def make_equation_image(text: str) -> Image.Image:
+    image = Image.new("L", (96, 48), 255)
+    ImageDraw.Draw(image).text((4, 16), text, fill = 0)
+    return image
+
+def test_from_images_yields_a_batch():
+    equations = ["x^2", "y_1", "a+b", "e^x"]
+    dataset = InMemoryIm2LatexDataset.from_images([make_equation_image(equation) for equation in equations],
+                                                  equations, tokenizer_path, batchsize = 2)
+    assert len(dataset) == 2
+    tok, images = next(dataset)
+    assert tok["input_ids"].shape[0] == 2
+    assert images.shape == (2, 1, 48, 96)
+
+def test_crops_under_the_minimum_size_are_padded_not_dropped():
+    # a tightly cropped "-", a few pixels tall
+    crops = [Image.new("L", (24, 6), 0) for _ in range(2)]
+    dataset = InMemoryIm2LatexDataset.from_images(crops, ["-", "-"], tokenizer_path, batchsize = 2)
+    assert len(dataset) == 1
+    _, images = next(dataset)
+    assert images.shape == (2, 1, 32, 32)
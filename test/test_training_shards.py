@@ -0,0 +1,85 @@
+from pathlib import Path
+from typing import List
+
+import numpy as np
+from PIL import Image
+
+from mathclips.services.training_shards import TrainingShardCache
+from mathclips.services.util import pixel_content_hash
+
+class FakeImageDatabase:
+    # the two MathSymbolImageDatabase calls the shard cache makes, counting the images it fetches
+    def __init__(self, images: dict):
+        self.images = images
+        self.fetched: List[str] = []
+
+    def get_pixel_hashes(self, file_ids):
+        return [self.images[file_id].info["pixel_hash"] if file_id in self.images else None for file_id in file_ids]
+
+    def get_images(self, file_ids):
+        self.fetched.extend(file_ids)
+        return [self.images.get(file_id) for file_id in file_ids]
+
+class FakeTokenizer:
+    def __init__(self):
+        self.num_encoded = 0
+
+    def __call__(self, labels, return_token_type_ids = False):
+        self.num_encoded += len(labels)
+        return dict(input_ids = [[ord(character) for character in label] for label in labels])
+
+def make_image(shade: int, size = (48, 40)) -> Image.Image:
+    image = Image.new("L", size, shade)
+    image.info["pixel_hash"] = pixel_content_hash(image)
+    return image
+
+def test_second_run_only_loads_new_samples(tmp_path: Path):
+    tokenizer_path = tmp_path.joinpath("tokenizer.json")
+    tokenizer_path.write_text("{}")
+    image_db = FakeImageDatabase({"a": make_image(10), "b": make_image(20), "c": make_image(30, (64, 32))})
+    tokenizer = FakeTokenizer()
+
+    cache = TrainingShardCache(tmp_path.joinpath("shards"))
+    pixels, tokens = cache.load_samples(image_db, ["a", "b"], ["x", "y+1"], tokenizer, tokenizer_path)
+    assert image_db.fetched == ["a", "b"] and tokenizer.num_encoded == 2
+    assert np.array_equal(pixels[1], np.asarray(image_db.images["b"]))
+    assert tokens[1].tolist() == [ord("y"), ord("+"), ord("1")]
+
+    # a fresh instance reads the index written by the first one
+    image_db.fetched.clear()
+    cache = TrainingShardCache(tmp_path.joinpath("shards"))
+    pixels, tokens = cache.load_samples(image_db, ["a", "b", "c"], ["x", "y+1", "z"], tokenizer, tokenizer_path)
+    assert image_db.fetched == ["c"] and tokenizer.num_encoded == 3
+    assert pixels[2].shape == (32, 64)
+    assert isinstance(pixels[0], np.memmap) or isinstance(pixels[0].base, np.memmap)
+
+def test_missing_images_are_skipped(tmp_path: Path):
+    tokenizer_path = tmp_path.joinpath("tokenizer.json")
+    tokenizer_path.write_text("{}")
+    image_db = FakeImageDatabase({"a": make_image(10)})
+    cache = TrainingShardCache(tmp_path.joinpath("shards"))
+    pixels, tokens = cache.load_samples(image_db, ["a", "gone"], ["x", "y"], FakeTokenizer(), tokenizer_path)
+    assert len(pixels) == len(tokens) == 1
+
+def test_preprocessed_pixels_are_cached_separately(tmp_path: Path):
+    tokenizer_path = tmp_path.joinpath("tokenizer.json")
+    tokenizer_path.write_text("{}")
+
+    class PreprocessingImageDatabase(FakeImageDatabase):
+        def get_preprocessed_images(self, file_ids, max_dimensions):
+            preprocessed_images = []
+            for image in self.get_images(file_ids):
+                # like the stored copies, keeps the hash of the original
+                preprocessed_images.append(image.resize((8, 8)))
+                preprocessed_images[-1].info["pixel_hash"] = image.info["pixel_hash"]
+            return preprocessed_images
+
+    image_db = PreprocessingImageDatabase({"a": make_image(10)})
+    cache = TrainingShardCache(tmp_path.joinpath("shards"))
+    raw_pixels, _ = cache.load_samples(image_db, ["a"], ["x"], FakeTokenizer(), tokenizer_path)
+    preprocessed_pixels, _ = cache.load_samples(image_db, ["a"], ["x"], FakeTokenizer(), tokenizer_path, (672, 192))
+    assert raw_pixels[0].shape == (40, 48) and preprocessed_pixels[0].shape == (8, 8)
+    assert image_db.fetched == ["a", "a"]
+    # both forms are cached now
+    cache.load_samples(image_db, ["a"], ["x"], FakeTokenizer(), tokenizer_path, (672, 192))
+    assert image_db.fetched == ["a", "a"]
@@ -0,0 +1,53 @@
+import threading
+
+from mathclips.proto.pb_py_classes.image_pb2 import Image as ProtoImage
+from mathclips.services.transport import InProcessTransport, LaneReader, QueueLanes, consume_batches
+
+def test_in_process_handoff_is_by_reference():
+    transport = InProcessTransport()
+    transport.subscribe("images")
+    message = ProtoImage(equation_name = "pythagoras")
+    transport.publish(message, "images")
+    delivery = transport.get("images", timeout = 1.0)
+    assert delivery.decode(ProtoImage) is message
+    transport.ack(delivery)
+    assert transport.queue_stats("images").message_count == 0
+
+def test_nack_requeues_at_head():
+    transport = InProcessTransport()
+    transport.subscribe("images")
+    transport.publish_many([ProtoImage(equation_name = name) for name in ("first", "second")], "images")
+    delivery = transport.get("images", timeout = 1.0)
+    transport.nack(delivery)
+    assert transport.get("images", timeout = 1.0).decode(ProtoImage).equation_name == "first"
+
+def test_get_times_out_on_empty_queue():
+    transport = InProcessTransport()
+    assert transport.get("images", timeout = 0.01) is None
+
+def test_consume_batches_groups_messages():
+    transport = InProcessTransport()
+    transport.publish_many([ProtoImage(equation_name = str(i)) for i in range(5)], "images")
+    stop_event = threading.Event()
+    batches = []
+
+    def on_batch(batch):
+        batches.append([delivery.decode(ProtoImage).equation_name for delivery in batch])
+        for delivery in batch:
+            transport.ack(delivery)
+        if sum(len(names) for names in batches) == 5:
+            stop_event.set()
+
+    consume_batches(transport, "images", on_batch, batch_size = 2, batch_wait_ms = 10, stop_event = stop_event)
+    assert batches == [["0", "1"], ["2", "3"], ["4"]]
+
+def test_lanes_interleave_by_weight():
+    transport = InProcessTransport()
+    transport.publish_many([ProtoImage(equation_name = f"bulk{i}") for i in range(4)], "bulk")
+    transport.publish_many([ProtoImage(equation_name = f"interactive{i}") for i in range(5)], "interactive")
+    reader = LaneReader(transport, QueueLanes(queue_names = ("interactive", "bulk"), weights = (2, 1)))
+    names = [reader.get(timeout = 1.0).decode(ProtoImage).equation_name for _ in range(9)]
+    assert names == ["interactive0", "interactive1", "bulk0", "interactive2", "interactive3", "bulk1",
+                     # the bulk lane gets everything once the interactive lane is empty
+                     "interactive4", "bulk2", "bulk3"]
+    assert reader.get(timeout = 0.01) is None